@@ -0,0 +1,406 @@
+"""
+Synthetic benchmarks of botanix. Nothing goes over the network: updates are generated in process
+and handled by a MainHandler over an in-process store.
+
+  python -m benchmarks.run --output results.json
+  python -m benchmarks.run --compare baseline.json --tolerance 0.2
+
+Results are printed, and written as JSON with --output. With --compare, every metric is checked
+against the same metric in a previous JSON output and the exit code is 1 if any got worse by more
+than the tolerance.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from botanix.context_codecs import BinaryContextCodec, JsonContextCodec
+from botanix.handling import BaseHandler, HandlingContext, HandlingResult, MainHandler, step_number
+from botanix.memory_store import MemoryContextStore
+from botanix.sqlite_store import SqliteContextStore
+
+SCHEMA_VERSION = 1
+
+# metrics where a higher value is better, all others are better lower
+_HIGHER_IS_BETTER = ('updates_per_sec', 'ops_per_sec')
+
+
+class OrderHandler(BaseHandler):
+  """
+  Multi-step track with a loop on step 1 and custom data
+  """
+
+  @step_number(0, '/order')
+  async def start(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('items', [])
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def item(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    if command == 'more':
+      context.put_custom('items', (context.get_custom('items') or []) + [command])
+      return HandlingResult.override_step_result(1)
+    return HandlingResult.success_result()
+
+  @step_number(2)
+  async def address(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('address', command)
+    return HandlingResult.success_result()
+
+  @step_number(3)
+  async def confirm(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+class SurveyHandler(BaseHandler):
+  """
+  Track which switches to the order track after one question
+  """
+
+  @step_number(0, '/survey')
+  async def ask(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def answer(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('answer', command)
+    return HandlingResult.new_track_result('order', 1)
+
+
+class StartHandler(BaseHandler):
+
+  @step_number(0)
+  async def start(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+class HelpHandler(BaseHandler):
+
+  @step_number(0)
+  async def help(self, command: str, update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+# (message, weight) of the messages users send
+_MESSAGES = (('/order', 12), ('/survey', 5), ('/start', 2), ('/help', 2), ('more', 25), ('tea', 30),
+             ('Baker Street 221b', 24))
+
+
+def _new_main_handler(store) -> MainHandler:
+  return MainHandler(store, OrderHandler(), SurveyHandler(), StartHandler(), HelpHandler())
+
+
+def _generate(users: int, updates: int, seed: int) -> list:
+  """
+  :return: list per user of the messages it sends
+  """
+  rnd = random.Random(seed)
+  messages = [m for m, _ in _MESSAGES]
+  weights = [w for _, w in _MESSAGES]
+  per_user = [[] for _ in range(users)]
+  for m in rnd.choices(messages, weights, k=updates):
+    per_user[rnd.randrange(users)].append(m)
+  return per_user
+
+
+def _percentile(sorted_values: list, p: float) -> float:
+  if len(sorted_values) == 0:
+    return 0.0
+  return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+async def _run_users(main_handler: MainHandler, per_user: list) -> tuple:
+  """
+  :return: latencies of the updates handled, and the number of updates which raised
+  """
+  latencies = []
+  failures = 0
+
+  async def run_user(uid: int, messages: list):
+    nonlocal failures
+    for m in messages:
+      start = time.perf_counter()
+      try:
+        await main_handler.handle(uid, m, None)
+      except Exception:
+        failures += 1  # not counted as handled, they would skew the throughput and latencies
+        continue
+      latencies.append(time.perf_counter() - start)
+
+  await asyncio.gather(*[run_user(uid, messages) for uid, messages in enumerate(per_user)])
+  return latencies, failures
+
+
+def bench_workload(users: int, updates: int, seed: int) -> dict:
+  """
+  Users send a mix of track commands, answers, /start and /help concurrently
+  """
+  per_user = _generate(users, updates, seed)
+  store = MemoryContextStore(max_contexts=users * 2)
+  main_handler = _new_main_handler(store)
+  asyncio.run(_run_users(main_handler, _generate(users, min(updates, 1000), seed + 1)))  # warm up
+  gc.collect()
+  start = time.perf_counter()
+  latencies, failures = asyncio.run(_run_users(main_handler, per_user))
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  return {
+    'users': users,
+    'updates': len(latencies),
+    'failures': failures,
+    'updates_per_sec': len(latencies) / elapsed,
+    'p50_latency_us': _percentile(latencies, 0.5) * 1e6,
+    'p99_latency_us': _percentile(latencies, 0.99) * 1e6,
+  }
+
+
+def bench_context_memory(contexts: int) -> dict:
+  """
+  Memory held by a MemoryContextStore per live context mid-track
+  """
+  store = MemoryContextStore(max_contexts=contexts)
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  for uid in range(contexts):
+    ctx = HandlingContext(uid, 'order')
+    ctx.step = 2
+    ctx.put_custom('items', ['more', 'more'])
+    ctx.put_custom('answer', 'tea')
+    store.put_context(ctx)
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return {'contexts': contexts, 'bytes_per_context': (after - before) / contexts}
+
+
+def _time_per_op(fn, number: int, repeat: int = 5) -> float:
+  """
+  :return: best of `repeat` runs of the mean seconds per call of fn
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for _ in range(number):
+      fn()
+    t = (time.perf_counter() - start) / number
+    best = t if best is None else min(best, t)
+  return best
+
+
+def bench_micro(number: int) -> dict:
+  results = {}
+
+  def build_step_table():
+    OrderHandler._build_step_table()
+
+  def ensure_steps_built():
+    OrderHandler().ensure_steps_built()
+
+  main_handler = _new_main_handler(MemoryContextStore())
+  ctx = HandlingContext(1, 'order')
+  texts = ['/order', '/Survey', '/help', 'tea', '/unknown']
+
+  def route():
+    for t in texts:
+      try:
+        main_handler._route(t, ctx)
+      except Exception:
+        pass
+
+  ctx2 = HandlingContext(1, 'order')
+  ctx2.step = 2
+  ctx2.put_custom('items', ['more', 'more'])
+  ctx2.put_custom('answer', 'tea')
+  json_codec = JsonContextCodec()
+  binary_codec = BinaryContextCodec(['order', 'survey'])
+
+  def json_round_trip():
+    HandlingContext.from_json_string(ctx2.to_json_string())
+
+  def json_codec_round_trip():
+    json_codec.decode(json_codec.encode(ctx2))
+
+  def binary_codec_round_trip():
+    binary_codec.decode(binary_codec.encode(ctx2))
+
+  for name, fn, n in (('build_step_table', build_step_table, number // 10),
+                      ('ensure_steps_built', ensure_steps_built, number),
+                      ('route_5_messages', route, number),
+                      ('context_json_round_trip', json_round_trip, number),
+                      ('json_codec_round_trip', json_codec_round_trip, number),
+                      ('binary_codec_round_trip', binary_codec_round_trip, number)):
+    results[name] = {'ns_per_op': _time_per_op(fn, max(1, n)) * 1e9}
+  return results
+
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {modules}
+print(time.perf_counter() - start, int('telegram' in sys.modules))
+"""
+
+
+def _import_seconds(modules: str, repeat: int) -> tuple:
+  """
+  :return: best of `repeat` times to import the modules in a fresh interpreter, and whether telegram
+    was imported along
+  """
+  best = None
+  telegram = False
+  for i in range(repeat + 1):
+    out = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT.format(modules=modules)], check=True,
+                         capture_output=True, text=True).stdout.split()
+    if i == 0:
+      continue  # warms up the file cache
+    seconds = float(out[0])
+    telegram = out[1] == '1'
+    best = seconds if best is None else min(best, seconds)
+  return best, telegram
+
+
+def bench_cold_start(number: int, repeat: int) -> dict:
+  """
+  What a serverless cold start pays before handling its first update: importing botanix.handling
+  in a fresh interpreter, against also importing telegram as botanix.handling used to, and defining
+  a handler class with and without a routing manifest
+  """
+  handling_seconds, telegram = _import_seconds('botanix.handling', repeat)
+  with_telegram_seconds, _ = _import_seconds('telegram, botanix.handling', repeat)
+  key = f'{OrderHandler.__module__}.{OrderHandler.__qualname__}'
+  BaseHandler._manifest_entries[key] = {
+    'members': OrderHandler.manifest_fingerprint(),
+    'steps': {str(step): [f.__name__ for f in funcs] for step, funcs in OrderHandler.get_step_table().items()}}
+  try:
+    from_manifest = _time_per_op(OrderHandler._build_step_table, max(1, number // 10))
+  finally:
+    del BaseHandler._manifest_entries[key]
+  return {
+    'import_handling_ms': handling_seconds * 1e3,
+    'import_handling_with_telegram_ms': with_telegram_seconds * 1e3,
+    'imports_telegram': telegram,
+    'step_table_inspected_us': _time_per_op(OrderHandler._build_step_table, max(1, number // 10)) * 1e6,
+    'step_table_from_manifest_us': from_manifest * 1e6,
+  }
+
+
+def bench_stores(contexts: int) -> dict:
+  results = {}
+  ctxs = []
+  for uid in range(contexts):
+    ctx = HandlingContext(uid, 'order')
+    ctx.put_custom('answer', 'tea')
+    ctxs.append(ctx)
+  uids = [c.uid for c in ctxs]
+
+  memory = MemoryContextStore(max_contexts=contexts)
+  start = time.perf_counter()
+  for c in ctxs:
+    memory.put_context(c)
+  results['memory_put'] = {'ops_per_sec': contexts / (time.perf_counter() - start)}
+  start = time.perf_counter()
+  for uid in uids:
+    memory.get_active_context(uid)
+  results['memory_get'] = {'ops_per_sec': contexts / (time.perf_counter() - start)}
+
+  with tempfile.TemporaryDirectory() as d:
+    sqlite = SqliteContextStore(os.path.join(d, 'bench.db'))
+    try:
+      start = time.perf_counter()
+      for i in range(0, contexts, 100):
+        sqlite.put_many(ctxs[i:i + 100])
+      results['sqlite_put_many_100'] = {'ops_per_sec': contexts / (time.perf_counter() - start)}
+      start = time.perf_counter()
+      for uid in uids:
+        sqlite.get_active_context(uid)
+      results['sqlite_get'] = {'ops_per_sec': contexts / (time.perf_counter() - start)}
+    finally:
+      sqlite.close()
+  return results
+
+
+def run(users: int, updates: int, seed: int, number: int, contexts: int, import_repeat: int = 5) -> dict:
+  return {
+    'schema_version': SCHEMA_VERSION,
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'seed': seed,
+    'results': {
+      'workload': bench_workload(users, updates, seed),
+      'context_memory': bench_context_memory(contexts),
+      'micro': bench_micro(number),
+      'stores': bench_stores(contexts),
+      'cold_start': bench_cold_start(number, import_repeat),
+    },
+  }
+
+
+def _flatten(results: dict, prefix: str = '') -> dict:
+  flat = {}
+  for k, v in results.items():
+    if isinstance(v, dict):
+      flat.update(_flatten(v, f'{prefix}{k}.'))
+    elif isinstance(v, float):
+      flat[prefix + k] = v
+  return flat
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+  """
+  :return: list of (metric, baseline value, current value) of the metrics which got worse by more
+    than tolerance, a fraction of the baseline value
+  """
+  regressions = []
+  old = _flatten(baseline['results'])
+  for name, value in _flatten(current['results']).items():
+    if name not in old or old[name] == 0:
+      continue
+    change = (value - old[name]) / old[name]
+    if name.endswith(_HIGHER_IS_BETTER):
+      change = -change
+    if change > tolerance:
+      regressions.append((name, old[name], value))
+  return regressions
+
+
+def main(argv: list = None) -> int:
+  parser = argparse.ArgumentParser(description='Runs the botanix benchmarks')
+  parser.add_argument('--users', type=int, default=1000, help='number of concurrent users')
+  parser.add_argument('--updates', type=int, default=50000, help='number of updates of the workload')
+  parser.add_argument('--seed', type=int, default=42)
+  parser.add_argument('--number', type=int, default=20000, help='iterations of each micro benchmark')
+  parser.add_argument('--contexts', type=int, default=10000, help='contexts of the memory and store benchmarks')
+  parser.add_argument('--import-repeat', type=int, default=5, help='fresh interpreters timed per import benchmark')
+  parser.add_argument('--output', help='file to write the results to as JSON')
+  parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fraction of regression')
+  args = parser.parse_args(argv)
+
+  current = run(args.users, args.updates, args.seed, args.number, args.contexts, args.import_repeat)
+  for name, value in _flatten(current['results']).items():
+    print(f'{name:50} {value:14.1f}')
+  failures = current['results']['workload']['failures']
+  if failures > 0:
+    print(f'FAILED {failures} updates of the workload')
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(current, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(json.load(f), current, args.tolerance)
+    for name, old, new in regressions:
+      print(f'REGRESSION {name}: {old:.1f} -> {new:.1f}')
+    if len(regressions) > 0:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict
+from botanix.handling import BaseContextStore, CompareAndSwapNotSupported, HandlingContext, VersionConflict
+
+
+class CacheStats:
+  __slots__ = ('hits', 'misses', 'evictions', 'expirations')
+
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  @property
+  def hit_ratio(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total > 0 else 0.0
+
+
+class CachingContextStore(BaseContextStore):
+  """
+  Read-through cache in front of any BaseContextStore. Recently used contexts are kept in a bounded
+  LRU and expire `ttl` seconds after they were cached.
+
+  In write-through mode (default) every put goes straight to the backing store. In write-behind mode
+  puts are only cached and kept as pending, to be written to the backing store in bulk when `flush`
+  is called or once `max_pending` contexts are pending. clear_context always invalidates the cache,
+  drops any pending write and clears the backing store immediately.
+
+  Contexts are copied in and out of the cache so that a handler mutating a context it failed to
+  handle does not corrupt the cached one. Custom values are copied shallowly.
+
+  Compare-and-swap writes are supported in write-through mode if the backing store supports them.
+  A conflict invalidates the cached context so that the next read gets the winning write.
+  """
+
+  def __init__(self, store: BaseContextStore, max_size: int = 10000, ttl: float = 60.0,
+               write_behind: bool = False, max_pending: int = 1000, clock=time.monotonic):
+    """
+    :param store: the backing store, it must be safe to call from several threads if the cache is
+    :param max_size: maximum number of cached contexts
+    :param ttl: seconds a context stays in the cache
+    :param write_behind: if True, puts are written to the backing store in bulk later
+    :param max_pending: number of pending writes which triggers a flush in write-behind mode
+    :param clock: source of time in seconds
+    """
+    self.store = store
+    self.max_size = max_size
+    self.ttl = ttl
+    self.write_behind = write_behind
+    self.max_pending = max_pending
+    self.clock = clock
+    self.stats = CacheStats()
+    self._entries = OrderedDict()  # uid -> (context, expiry)
+    self._pending = {}
+    self._generation = 0  # bumped on every write so that a slow read cannot cache a stale context
+    self._lock = threading.Lock()
+
+  def get_active_context(self, uid: int) -> HandlingContext:
+    with self._lock:
+      ctx = self._lookup(uid)
+      if ctx is not None:
+        return ctx.copy()
+      generation = self._generation
+    ctx = self.store.get_active_context(uid)
+    if ctx is not None:
+      with self._lock:
+        if generation == self._generation:
+          self._cache(ctx.copy())
+    return ctx
+
+  def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    ctx = HandlingContext(uid, track_nam)
+    self.put_context(ctx)
+    return ctx
+
+  @property
+  def supports_compare_and_swap(self) -> bool:
+    return not self.write_behind and self.store.supports_compare_and_swap
+
+  def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
+    if expected_version is None:
+      self.put_many([context])
+      return
+    if not self.supports_compare_and_swap:
+      raise CompareAndSwapNotSupported('Compare-and-swap needs write-through and a backing store supporting it')
+    try:
+      self.store.put_context(context, expected_version)
+    except VersionConflict:
+      self.invalidate(context.uid)
+      raise
+    cached = context.copy()
+    cached.mark_clean()
+    with self._lock:
+      self._generation += 1
+      self._cache(cached)
+
+  def clear_context(self, uid: int, expected_version: int = None):
+    if expected_version is None:
+      self.clear_many([uid])
+      return
+    if not self.supports_compare_and_swap:
+      raise CompareAndSwapNotSupported('Compare-and-swap needs write-through and a backing store supporting it')
+    self.invalidate(uid)
+    self.store.clear_context(uid, expected_version)
+
+  def get_many(self, uids: list) -> dict:
+    contexts = {}
+    missing = []
+    with self._lock:
+      for uid in uids:
+        ctx = self._lookup(uid)
+        if ctx is None:
+          missing.append(uid)
+        else:
+          contexts[uid] = ctx.copy()
+      generation = self._generation
+    if len(missing) > 0:
+      loaded = self.store.get_many(missing)
+      with self._lock:
+        if generation == self._generation:
+          for ctx in loaded.values():
+            self._cache(ctx.copy())
+      contexts.update(loaded)
+    return contexts
+
+  def put_many(self, contexts: list) -> None:
+    if not self.write_behind:
+      self.store.put_many(contexts)
+    to_flush = None
+    with self._lock:
+      self._generation += 1
+      for context in contexts:
+        cached = context.copy()
+        if self.write_behind:
+          self._pending[context.uid] = cached
+        else:
+          cached.mark_clean()
+        self._cache(cached)
+      if len(self._pending) >= self.max_pending:
+        to_flush = self._take_pending()
+    if to_flush is not None:
+      self._write_pending(to_flush)
+
+  def clear_many(self, uids: list):
+    with self._lock:
+      self._generation += 1
+      for uid in uids:
+        self._entries.pop(uid, None)
+        self._pending.pop(uid, None)
+    self.store.clear_many(uids)
+
+  def get_follow_ups(self) -> list:
+    self.flush()
+    return self.store.get_follow_ups()
+
+  def flush(self):
+    """
+    Writes pending contexts to the backing store when in write-behind mode
+    :return:
+    """
+    with self._lock:
+      to_flush = self._take_pending()
+    if len(to_flush) > 0:
+      self._write_pending(to_flush)
+
+  def _write_pending(self, contexts: list):
+    self.store.put_many(contexts)
+    for ctx in contexts:
+      ctx.mark_clean()
+
+  def invalidate(self, uid: int = None):
+    """
+    Drops a context, or all of them if no uid is given, from the cache without touching the backing
+    store. Pending writes are kept
+    :param uid:
+    :return:
+    """
+    with self._lock:
+      self._generation += 1
+      if uid is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(uid, None)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _lookup(self, uid: int):
+    entry = self._entries.get(uid)
+    if entry is not None:
+      if entry[1] > self.clock():
+        self._entries.move_to_end(uid)
+        self.stats.hits += 1
+        return entry[0]
+      del self._entries[uid]
+      self.stats.expirations += 1
+    pending = self._pending.get(uid)
+    if pending is not None:  # evicted or expired but not yet written
+      self._cache(pending)
+      self.stats.hits += 1
+      return pending
+    self.stats.misses += 1
+    return None
+
+  def _cache(self, ctx: HandlingContext):
+    self._entries[ctx.uid] = (ctx, self.clock() + self.ttl)
+    self._entries.move_to_end(ctx.uid)
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last=False)
+      self.stats.evictions += 1
+
+  def _take_pending(self) -> list:
+    pending = list(self._pending.values())
+    self._pending = {}
+    return pending
@@ -0,0 +1,255 @@
+import json
+import struct
+from decimal import Decimal
+from botanix.handling import HandlingContext
+
+
+class BaseContextCodec:
+  """
+  Turns a context into bytes and back. Stores accept a codec so that the wire/storage format
+  of contexts can be chosen independently of the store
+  """
+  def encode(self, context: HandlingContext) -> bytes:
+    """
+    Serialises the context
+    :param context:
+    :return:
+    """
+    raise NotImplementedError()
+
+  def decode(self, data: bytes) -> HandlingContext:
+    """
+    Deserialises a context previously encoded by the same codec
+    :param data:
+    :return: a context which is not dirty
+    """
+    raise NotImplementedError()
+
+  def encode_value(self, val) -> bytes:
+    """
+    Serialises a single custom value, for stores keeping custom values apart from the context
+    :param val:
+    :return:
+    """
+    raise NotImplementedError()
+
+  def decode_value(self, data: bytes):
+    raise NotImplementedError()
+
+
+class JsonContextCodec(BaseContextCodec):
+  """
+  The JSON representation of `HandlingContext.to_json_string`, UTF-8 encoded
+  """
+  def encode(self, context: HandlingContext) -> bytes:
+    return context.to_json_string().encode('utf-8')
+
+  def decode(self, data: bytes) -> HandlingContext:
+    if not isinstance(data, str):
+      data = bytes(data).decode('utf-8')
+    return HandlingContext.from_json_string(data)
+
+  def encode_value(self, val) -> bytes:
+    return json.dumps(val).encode('utf-8')
+
+  def decode_value(self, data: bytes):
+    return json.loads(bytes(data))
+
+
+class ContextCodecError(Exception):
+  pass
+
+
+# Value tags of the binary format. Integers 0 to 127 are stored in the tag itself (_FIXINT | n)
+_NONE = 0x00
+_FALSE = 0x01
+_TRUE = 0x02
+_INT = 0x03      # zigzag varint
+_FLOAT = 0x04    # 8 bytes little endian double
+_STR = 0x05      # varint length + UTF-8
+_BYTES = 0x06    # varint length + raw bytes
+_LIST = 0x07     # varint count + values
+_MAP = 0x08      # varint count + key/value pairs
+_DECIMAL = 0x09  # varint length + decimal string
+_FIXINT = 0x80
+
+_header = struct.Struct('<BqIq')  # schema version, uid, step, timestamp
+_double = struct.Struct('<d')
+
+
+class BinaryContextCodec(BaseContextCodec):
+  """
+  Compact binary format. Layout:
+
+    schema version (1 byte) | uid (int64) | step (uint32) | timestamp (int64) |
+    track id (varint, 0 means the track name follows as varint length + UTF-8) |
+    custom (encoded map) | last update id + 1 (varint, 0 if none) | version (varint) |
+    follow up at + 1 (varint, 0 if none)
+
+  Version 1 had no last update id, version 2 no version and version 3 no follow up, all are still
+  decoded.
+  Track names known upfront can be passed in `track_names` so that they are stored as a
+  small id instead of a string. The list is part of the format: only append to it.
+  Custom values can be None, bool, int, float, str, bytes, Decimal, list/tuple and dict.
+  """
+  version = 4
+
+  def __init__(self, track_names: list = None):
+    self.track_names = [n.lower() for n in (track_names or [])]
+    self.track_ids = {n: i + 1 for i, n in enumerate(self.track_names)}
+
+  def encode(self, context: HandlingContext) -> bytes:
+    buf = bytearray(_header.pack(self.version, context.uid, context.step, int(context.timestamp)))
+    track_id = self.track_ids.get(context.track_name)
+    if track_id is None:
+      buf.append(0)
+      _write_bytes(buf, context.track_name.encode('utf-8'))
+    else:
+      _write_varint(buf, track_id)
+    _write_value(buf, context.custom)
+    _write_varint(buf, 0 if context.last_update_id is None else context.last_update_id + 1)
+    _write_varint(buf, context.version)
+    _write_varint(buf, 0 if context.follow_up_at is None else context.follow_up_at + 1)
+    return bytes(buf)
+
+  def decode(self, data: bytes) -> HandlingContext:
+    data = memoryview(data)
+    if len(data) < _header.size:
+      raise ContextCodecError('Data is too short to be a context')
+    version, uid, step, timestamp = _header.unpack_from(data, 0)
+    if version < 1 or version > self.version:
+      raise ContextCodecError(f'Unsupported context schema version {version}')
+    track_id, pos = _read_varint(data, _header.size)
+    if track_id == 0:
+      n, pos = _read_varint(data, pos)
+      track_nam = str(data[pos:pos + n], 'utf-8')
+      pos += n
+    else:
+      track_nam = self.track_names[track_id - 1]
+    custom, pos = _read_value(data, pos)
+    last_update_id = None
+    if version >= 2:
+      n, pos = _read_varint(data, pos)
+      last_update_id = n - 1 if n > 0 else None
+    context_version = 0
+    if version >= 3:
+      context_version, pos = _read_varint(data, pos)
+    follow_up_at = None
+    if version >= 4:
+      n, pos = _read_varint(data, pos)
+      follow_up_at = n - 1 if n > 0 else None
+    return HandlingContext.from_fields(uid, track_nam, step, timestamp, custom, last_update_id, context_version,
+                                       follow_up_at)
+
+  def encode_value(self, val) -> bytes:
+    buf = bytearray()
+    _write_value(buf, val)
+    return bytes(buf)
+
+  def decode_value(self, data: bytes):
+    return _read_value(memoryview(data), 0)[0]
+
+
+def _write_varint(buf: bytearray, n: int):
+  while n > 0x7f:
+    buf.append((n & 0x7f) | 0x80)
+    n >>= 7
+  buf.append(n)
+
+
+def _read_varint(data: memoryview, pos: int):
+  result = 0
+  shift = 0
+  while True:
+    b = data[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+
+def _write_bytes(buf: bytearray, b: bytes):
+  _write_varint(buf, len(b))
+  buf += b
+
+
+def _write_value(buf: bytearray, val):
+  t = type(val)
+  if val is None:
+    buf.append(_NONE)
+  elif t is bool:
+    buf.append(_TRUE if val else _FALSE)
+  elif t is int:
+    if 0 <= val < 0x80:
+      buf.append(_FIXINT | val)
+    else:
+      buf.append(_INT)
+      _write_varint(buf, (val << 1) if val >= 0 else ((-val << 1) - 1))
+  elif t is str:
+    buf.append(_STR)
+    _write_bytes(buf, val.encode('utf-8'))
+  elif t is float:
+    buf.append(_FLOAT)
+    buf += _double.pack(val)
+  elif t is dict:
+    buf.append(_MAP)
+    _write_varint(buf, len(val))
+    for k, v in val.items():
+      _write_value(buf, k)
+      _write_value(buf, v)
+  elif t is list or t is tuple:
+    buf.append(_LIST)
+    _write_varint(buf, len(val))
+    for v in val:
+      _write_value(buf, v)
+  elif t is bytes or t is bytearray:
+    buf.append(_BYTES)
+    _write_bytes(buf, val)
+  elif t is Decimal:
+    buf.append(_DECIMAL)
+    _write_bytes(buf, str(val).encode('ascii'))
+  else:
+    raise ContextCodecError(f'Cannot encode custom value of type {t.__name__}')
+
+
+def _read_value(data: memoryview, pos: int):
+  tag = data[pos]
+  pos += 1
+  if tag >= _FIXINT:
+    return tag & 0x7f, pos
+  if tag == _STR:
+    n, pos = _read_varint(data, pos)
+    return str(data[pos:pos + n], 'utf-8'), pos + n
+  if tag == _MAP:
+    n, pos = _read_varint(data, pos)
+    d = {}
+    for _ in range(n):
+      k, pos = _read_value(data, pos)
+      d[k], pos = _read_value(data, pos)
+    return d, pos
+  if tag == _INT:
+    n, pos = _read_varint(data, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+  if tag == _NONE:
+    return None, pos
+  if tag == _FALSE:
+    return False, pos
+  if tag == _TRUE:
+    return True, pos
+  if tag == _FLOAT:
+    return _double.unpack_from(data, pos)[0], pos + 8
+  if tag == _LIST:
+    n, pos = _read_varint(data, pos)
+    l = []
+    for _ in range(n):
+      v, pos = _read_value(data, pos)
+      l.append(v)
+    return l, pos
+  if tag == _BYTES:
+    n, pos = _read_varint(data, pos)
+    return bytes(data[pos:pos + n]), pos + n
+  if tag == _DECIMAL:
+    n, pos = _read_varint(data, pos)
+    return Decimal(str(data[pos:pos + n], 'ascii')), pos + n
+  raise ContextCodecError(f'Unknown value tag {tag}')
@@ -1,16 +1,22 @@
 import datetime
 from decimal import Decimal
-import dateutil.parser
 
 def get_time_as_decimal(dt:datetime.datetime=None) -> Decimal:
   if dt is None:
-    dt = datetime.datetime.utcnow()
+    dt = datetime.datetime.now(datetime.timezone.utc)
   return Decimal(round(dt.timestamp()))
 
+def get_time_as_int(dt:datetime.datetime=None) -> int:
+  if dt is None:
+    # aware, a naive utcnow() would be read as local time by timestamp()
+    dt = datetime.datetime.now(datetime.timezone.utc)
+  return round(dt.timestamp())
+
 def get_decimal_as_time(value:Decimal) -> datetime.datetime:
   return datetime.datetime.fromtimestamp(float(value))
 
 def parse_iso(date_str:str) -> datetime.datetime:
+  import dateutil.parser  # imported on first use, it is slow to import
   return dateutil.parser.parse(date_str)
 
 def decimal_to_int_for_shallow_graph(obj:dict):
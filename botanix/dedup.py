@@ -0,0 +1,139 @@
+import math
+import time
+from collections import OrderedDict
+
+_MASK = (1 << 64) - 1
+
+
+def _mix(n: int) -> int:
+  # splitmix64 finaliser, spreads consecutive update ids over the whole bit array
+  n = (n + 0x9e3779b97f4a7c15) & _MASK
+  n = ((n ^ (n >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+  n = ((n ^ (n >> 27)) * 0x94d049bb133111eb) & _MASK
+  return n ^ (n >> 31)
+
+
+class BloomFilter:
+  """
+  Bloom filter of integers sized for `capacity` items at the given false positive rate
+  """
+  __slots__ = ('size', 'hashes', 'bits', 'count')
+
+  def __init__(self, capacity: int, error_rate: float):
+    self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    self.hashes = max(1, round(self.size / capacity * math.log(2)))
+    self.bits = bytearray((self.size + 7) // 8)
+    self.count = 0
+
+  def _positions(self, n: int):
+    h = _mix(n)
+    h1 = h & 0xffffffff
+    h2 = (h >> 32) | 1
+    for i in range(self.hashes):
+      yield (h1 + i * h2) % self.size
+
+  def add(self, n: int):
+    for p in self._positions(n):
+      self.bits[p >> 3] |= 1 << (p & 7)
+    self.count += 1
+
+  def __contains__(self, n: int) -> bool:
+    bits = self.bits
+    for p in self._positions(n):
+      if not bits[p >> 3] & (1 << (p & 7)):
+        return False
+    return True
+
+
+class UpdateDeduplicator:
+  """
+  Remembers the update_id of updates received in roughly the last `window` seconds so that updates
+  redelivered by Telegram are not handled twice.
+
+  The most recent `exact_size` ids are kept exactly in an LRU. Older ones are kept in two rotating
+  Bloom filters: the current one receives new ids and becomes the previous one when it is full or
+  `window / 2` seconds old, at which point the old previous one is dropped. Hence an id is remembered
+  for at least half a window and an id never seen is taken for a duplicate with a probability of
+  about 2 * error_rate.
+
+  MainHandler calls `begin` when an update arrives and `done` once it is handled, so that the id of an
+  update whose handling failed is not recorded and Telegram's redelivery of it is handled.
+
+  With `persist`, MainHandler also records the last update_id in the context of the user, which
+  catches duplicates across processes and restarts for users with an active context, at the cost of
+  writing the context for every update.
+  """
+
+  def __init__(self, window: float = 600, capacity: int = 100000, exact_size: int = 10000,
+               error_rate: float = 1e-6, persist: bool = False, clock=time.monotonic):
+    """
+    :param window: seconds an update id is remembered for
+    :param capacity: maximum number of update ids expected in half a window
+    :param exact_size: number of most recent update ids remembered exactly
+    :param error_rate: false positive rate of each Bloom filter
+    :param persist: if True, the last update id of each user is stored in its context
+    :param clock: source of monotonic time in seconds
+    """
+    self.window = window
+    self.capacity = capacity
+    self.exact_size = exact_size
+    self.error_rate = error_rate
+    self.persist = persist
+    self.clock = clock
+    self.duplicates = 0
+    self._recent = OrderedDict()
+    self._current = BloomFilter(capacity, error_rate)
+    self._previous = None
+    self._rotated_at = clock()
+    self._in_progress = set()
+
+  def seen(self, update_id: int) -> bool:
+    """
+    Records the update id
+    :param update_id:
+    :return: True if it had already been recorded
+    """
+    if self._contains(update_id):
+      self.duplicates += 1
+      return True
+    self._record(update_id)
+    return False
+
+  def begin(self, update_id: int) -> bool:
+    """
+    Marks the update as being handled without recording its id yet
+    :param update_id:
+    :return: True if it was already recorded or is being handled
+    """
+    if update_id in self._in_progress or self._contains(update_id):
+      self.duplicates += 1
+      return True
+    self._in_progress.add(update_id)
+    return False
+
+  def done(self, update_id: int, handled: bool):
+    """
+    Ends the handling started by `begin`
+    :param update_id:
+    :param handled: if False, e.g. handling raised, the id is forgotten so that a redelivery is handled
+    :return:
+    """
+    self._in_progress.discard(update_id)
+    if handled:
+      self._record(update_id)
+
+  def _contains(self, update_id: int) -> bool:
+    if update_id in self._recent:
+      return True
+    now = self.clock()
+    if self._current.count >= self.capacity or now - self._rotated_at >= self.window / 2:
+      self._previous = self._current
+      self._current = BloomFilter(self.capacity, self.error_rate)
+      self._rotated_at = now
+    return update_id in self._current or (self._previous is not None and update_id in self._previous)
+
+  def _record(self, update_id: int):
+    self._current.add(update_id)
+    self._recent[update_id] = None
+    if len(self._recent) > self.exact_size:
+      self._recent.popitem(last=False)
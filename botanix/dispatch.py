@@ -0,0 +1,45 @@
+import asyncio
+
+
+class _UserLock:
+  __slots__ = ('lock', 'holders')
+
+  def __init__(self):
+    self.lock = asyncio.Lock()
+    self.holders = 0  # number of tasks holding or waiting for the lock
+
+
+class UserLockPool:
+  """
+  Keeps one asyncio lock per user id so that updates of the same user are handled one at a time
+  and in the order they arrived, while updates of different users run concurrently.
+  A lock only lives while at least one update of its user is in flight, hence memory is bounded
+  by the number of users currently being served and not by the number of users ever seen.
+  """
+
+  def __init__(self):
+    self._locks = {}
+
+  async def acquire(self, uid: int):
+    entry = self._locks.get(uid)
+    if entry is None:
+      entry = self._locks[uid] = _UserLock()
+    entry.holders += 1
+    try:
+      await entry.lock.acquire()
+    except BaseException:
+      self._forget(uid, entry)
+      raise
+
+  def release(self, uid: int):
+    entry = self._locks[uid]
+    entry.lock.release()
+    self._forget(uid, entry)
+
+  def _forget(self, uid: int, entry: _UserLock):
+    entry.holders -= 1
+    if entry.holders == 0:
+      del self._locks[uid]
+
+  def __len__(self):
+    return len(self._locks)
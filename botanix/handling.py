@@ -1,8 +1,21 @@
+from __future__ import annotations
+import asyncio
 import json
 from botanix.conversion_helper import *
-from telegram import Update
+from botanix.dedup import UpdateDeduplicator
+from botanix.dispatch import UserLockPool
+from botanix.instrumentation import BaseInstrumentation, instrument_store
+from botanix.outbox import Outbox, OutgoingMessage
+from typing import TYPE_CHECKING
 import inspect
+import math
+import random
 import re
+import time
+
+if TYPE_CHECKING:
+  # only a type hint: importing telegram takes longer than importing botanix
+  from telegram import Update
 
 
 class UnhandledMessage(Exception):
@@ -10,22 +23,176 @@ class UnhandledMessage(Exception):
     super().__init__(args)
 
 
+class VersionConflict(Exception):
+  """
+  Raised by a store when a conditional write finds the stored context at another version than expected
+  """
+
+
+class CompareAndSwapNotSupported(Exception):
+  """
+  Raised when optimistic concurrency is asked of a store which cannot write conditionally
+  """
+
+
 class HandlingContext:
+  """
+  Keeps track of where a user is in its journey along with the custom values of the track.
+  Changes to step, track_name and custom values put via put_custom are tracked so that
+  MainHandler only writes the context to the store when something has actually changed.
+  A newly created context is dirty until it is stored.
+  The timestamp is in epoch seconds and MainHandler refreshes it each time it stores the context,
+  so stores can use it to expire abandoned contexts.
+  The version is that of the stored context it was read from, 0 if none. Stores supporting
+  compare-and-swap increase it on every write.
+  Stores may keep custom values apart from the rest of the context and load them only when `custom`
+  is first used (see `defer_custom`). The keys changed by put_custom are tracked so that such stores
+  can write only those.
+  follow_up_at is the epoch second at which a Scheduler dispatches a follow-up to the current step,
+  None if none is pending. It is stored with the context so that pending follow-ups survive a restart.
+  """
+  __slots__ = ('uid', '_track_name', '_custom', '_custom_loader', '_changed_keys', 'timestamp', '_step', 'is_dirty',
+               '_replies', 'last_update_id', 'version', '_follow_up_at')
+
   def __init__(self, uid:int, track_nam:str, step:int=0):
     self.uid = uid
-    self.track_name = track_nam
-    self.custom = {}
-    self.timestamp = get_time_as_decimal()
-    self.step = step
+    self._track_name = track_nam
+    self._custom = {}
+    self._custom_loader = None
+    self._changed_keys = None  # None: all custom values are new
+    self.timestamp = get_time_as_int()
+    self._step = step
+    self.is_dirty = True
+    self._replies = None
+    self.last_update_id = None
+    self.version = 0
+    self._follow_up_at = None
+
+  @property
+  def step(self) -> int:
+    return self._step
+
+  @step.setter
+  def step(self, step:int):
+    if step != self._step:
+      self._step = step
+      self.is_dirty = True
+
+  @property
+  def follow_up_at(self) -> int:
+    return self._follow_up_at
+
+  @follow_up_at.setter
+  def follow_up_at(self, follow_up_at: int):
+    if follow_up_at != self._follow_up_at:
+      self._follow_up_at = follow_up_at
+      self.is_dirty = True
+
+  @property
+  def custom(self) -> dict:
+    if self._custom is None:
+      self._custom = self._custom_loader()
+      self._custom_loader = None
+    return self._custom
+
+  @custom.setter
+  def custom(self, custom: dict):
+    self._custom = custom
+    self._custom_loader = None
+    self._changed_keys = None
+
+  @property
+  def is_custom_loaded(self) -> bool:
+    return self._custom is not None
+
+  @property
+  def changed_keys(self):
+    """
+    Keys put with put_custom since the context was read from the store, or None if the custom
+    values were never stored as a whole (a new context, or `custom` was replaced)
+    """
+    return self._changed_keys
+
+  def defer_custom(self, loader):
+    """
+    Makes custom values load on first use. For stores keeping custom values apart
+    :param loader: callable without argument returning the custom dictionary
+    :return:
+    """
+    self._custom = None
+    self._custom_loader = loader
+    self._changed_keys = set()
+
+  @property
+  def track_name(self) -> str:
+    return self._track_name
+
+  @track_name.setter
+  def track_name(self, track_nam:str):
+    if track_nam != self._track_name:
+      self._track_name = track_nam
+      self.is_dirty = True
 
   def put_custom(self, key:str, val):
     """
-    Puts a custom value in the context
+    Puts a custom value in the context. Mutating `custom` directly is not tracked as a change
     :param key:
     :param val: must be serialisable
     :return:
     """
-    self.custom[key] = val
+    custom = self.custom
+    if key not in custom or custom[key] != val:
+      custom[key] = val
+      self.is_dirty = True
+      if self._changed_keys is not None:
+        self._changed_keys.add(key)
+
+  def reply(self, text:str, chat_id:int=None, **kwargs):
+    """
+    Queues a message to be sent by the outbox of MainHandler once the update is handled and the
+    context is stored. Replies are not stored with the context and are dropped if handling raises
+    :param text:
+    :param chat_id: defaults to the user
+    :param kwargs: any other argument of Bot.send_message, e.g. reply_markup
+    :return:
+    """
+    if self._replies is None:
+      self._replies = []
+    self._replies.append(OutgoingMessage(self.uid if chat_id is None else chat_id, text, kwargs))
+
+  def take_replies(self) -> list:
+    """
+    Returns the queued replies and empties the queue
+    :return:
+    """
+    replies = self._replies
+    self._replies = None
+    return replies or []
+
+  def record_update(self, update_id:int):
+    """
+    Records the update_id of the update being handled so that a redelivery can be recognised
+    :param update_id:
+    :return:
+    """
+    if update_id != self.last_update_id:
+      self.last_update_id = update_id
+      self.is_dirty = True
+
+  def mark_clean(self):
+    """
+    Marks the context as being in sync with the store
+    :return:
+    """
+    self.is_dirty = False
+    self._changed_keys = set()
+
+  def touch(self):
+    """
+    Sets the timestamp to now
+    :return:
+    """
+    self.timestamp = get_time_as_int()
 
   def move_to_next(self):
     self.step += 1
@@ -34,21 +201,77 @@ class HandlingContext:
     self.step = step
 
   def get_custom(self, key:str):
-    if key in self.custom:
-      return self.custom[key]
-    return None
+    return self.custom.get(key)
 
   def to_json_string(self) -> str:
-    cop = self.__dict__.copy()
-    decimal_to_int_for_shallow_graph(cop)
-    return json.dumps(cop)
+    dic = {
+      'uid': self.uid,
+      'track_name': self._track_name,
+      'custom': self.custom,
+      'timestamp': int(self.timestamp),
+      'step': self._step
+    }
+    if self.last_update_id is not None:
+      dic['last_update_id'] = self.last_update_id
+    if self.version != 0:
+      dic['version'] = self.version
+    if self._follow_up_at is not None:
+      dic['follow_up_at'] = self._follow_up_at
+    return json.dumps(dic)
 
   @staticmethod
   def from_json_string(json_s:str):
     dic = json.loads(json_s)
-    ctx = HandlingContext(123, 'dummy')
-    ctx.__dict__ = dic
-    ctx.timestamp = Decimal(ctx.timestamp)
+    return HandlingContext.from_fields(dic['uid'], dic['track_name'], dic['step'],
+                                       dic['timestamp'], dic['custom'], dic.get('last_update_id'),
+                                       dic.get('version', 0), dic.get('follow_up_at'))
+
+  def to_string(self) -> str:
+    """
+    Serialises the context into its default text representation (JSON)
+    :return:
+    """
+    return self.to_json_string()
+
+  @staticmethod
+  def from_string(s:str):
+    return HandlingContext.from_json_string(s)
+
+  def copy(self):
+    """
+    Returns a copy of the context as stored, keeping its changed keys so that the copy can still be
+    written key by key. Custom values are copied shallowly, or still loaded on first use if they
+    were not loaded yet
+    :return:
+    """
+    ctx = HandlingContext.from_fields(self.uid, self._track_name, self._step, self.timestamp,
+                                      None if self._custom is None else dict(self._custom),
+                                      self.last_update_id, self.version, self._follow_up_at)
+    if self._custom is None:
+      ctx._custom_loader = self._custom_loader
+    ctx._changed_keys = None if self._changed_keys is None else set(self._changed_keys)
+    return ctx
+
+  @classmethod
+  def from_fields(cls, uid:int, track_nam:str, step:int, timestamp, custom:dict, last_update_id:int=None,
+                  version:int=0, follow_up_at:int=None):
+    """
+    Creates a context, as loaded from a store, straight from its fields. Used by codecs and stores
+    :return: a context which is not dirty
+    """
+    ctx = cls.__new__(cls)
+    ctx.uid = uid
+    ctx._track_name = track_nam
+    ctx._custom = custom
+    ctx._custom_loader = None
+    ctx._changed_keys = set()
+    ctx.timestamp = int(timestamp)
+    ctx._step = step
+    ctx.is_dirty = False
+    ctx._replies = None
+    ctx.last_update_id = last_update_id
+    ctx.version = version
+    ctx._follow_up_at = follow_up_at
     return ctx
 
 
@@ -60,18 +283,26 @@ class HandlingContext:
 #   4) Handling it and saying that it is terminal and no more interaction are required
 #   5) Handling it and changing the track while changing the step as well
 class HandlingResult:
+  __slots__ = ('handled', 'unhandled_message', 'is_terminal', 'step_override', 'new_track_name', 'is_duplicate',
+               'is_timed_out', 'is_overloaded', 'follow_up_after')
+
   def __init__(self, handled:bool=False, unhandled_message:str=None,
                is_terminal:bool=False, step_override:int=None,
-               new_track_name:str=None):
+               new_track_name:str=None, is_duplicate:bool=False,
+               is_timed_out:bool=False, is_overloaded:bool=False, follow_up_after:float=None):
     self.handled = handled
     self.unhandled_message = unhandled_message
     self.is_terminal = is_terminal
     self.step_override = step_override
     self.new_track_name = new_track_name
+    self.is_duplicate = is_duplicate
+    self.is_timed_out = is_timed_out
+    self.is_overloaded = is_overloaded
+    self.follow_up_after = follow_up_after
 
   @staticmethod
   def success_result():
-    return HandlingResult(handled=True)
+    return _SUCCESS
 
   @staticmethod
   def unhandled_result(message:str):
@@ -79,7 +310,7 @@ class HandlingResult:
 
   @staticmethod
   def terminal_result():
-    return HandlingResult(handled=True, is_terminal=True)
+    return _TERMINAL
 
   @staticmethod
   def override_step_result(new_step:int):
@@ -89,6 +320,77 @@ class HandlingResult:
   def new_track_result(new_track_name:str, new_step:int=0):
     return HandlingResult(handled=True, step_override=new_step, new_track_name=new_track_name)
 
+  @staticmethod
+  def follow_up_result(after:float, new_step:int=None):
+    """
+    Handled, moving to the next step (or new_step), and asks for a follow-up: if the user has not
+    moved on `after` seconds later, the Scheduler of MainHandler sends a FollowUp to the step the
+    user is then at, with MainHandler.follow_up_command as the command. Any other handled update of
+    the user cancels the follow-up
+    """
+    return HandlingResult(handled=True, step_override=new_step, follow_up_after=after)
+
+  @staticmethod
+  def duplicate_result():
+    """
+    Returned by MainHandler for an update it has already received, without handling it again
+    """
+    return _DUPLICATE
+
+  @staticmethod
+  def timed_out_result():
+    """
+    Returned by MainHandler when the step handler did not finish within its deadline and was
+    cancelled. The step is not advanced and nothing is stored
+    """
+    return _TIMED_OUT
+
+  @staticmethod
+  def overloaded_result():
+    """
+    Returned by MainHandler for a command starting a track while too many updates are in flight
+    """
+    return _OVERLOADED
+
+
+class _SharedHandlingResult(HandlingResult):
+  """
+  Immutable result shared by all callers of success_result and terminal_result
+  """
+  __slots__ = ()
+
+  def __init__(self, **kwargs):
+    result = HandlingResult(**kwargs)
+    for name in HandlingResult.__slots__:
+      object.__setattr__(self, name, getattr(result, name))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('Shared results are immutable, create a new HandlingResult instead')
+
+  def __delattr__(self, name):
+    raise AttributeError('Shared results are immutable, create a new HandlingResult instead')
+
+
+_SUCCESS = _SharedHandlingResult(handled=True)
+_TERMINAL = _SharedHandlingResult(handled=True, is_terminal=True)
+_DUPLICATE = _SharedHandlingResult(unhandled_message='Duplicate update', is_duplicate=True)
+_TIMED_OUT = _SharedHandlingResult(unhandled_message='Step did not finish in time', is_timed_out=True)
+_OVERLOADED = _SharedHandlingResult(unhandled_message='Too busy to start a track, try again later',
+                                    is_overloaded=True)
+
+
+class FollowUp:
+  """
+  The update handlers receive when a follow-up they asked for with HandlingResult.follow_up_result
+  is due. `due` is the epoch second it was due at
+  """
+  __slots__ = ('uid', 'due')
+  update_id = None
+
+  def __init__(self, uid: int, due: int):
+    self.uid = uid
+    self.due = due
+
 
 """
 A decorator for defining the track name if naming convention of the class name is not followed
@@ -100,13 +402,94 @@ def track_name(name: str):
     return cls
   return real_track_name_fn
 
-def step_number(step:int, expected_command:str=None):
+"""
+A decorator for defining the step a method handles. When a step has more than one method,
+`expected_command` routes the exact command to the method while `command_pattern` routes every
+command fully matching the regular expression. Methods with neither (or with '*' as the expected
+command) accept any command. `deadline` is the same as the `deadline` decorator
+"""
+def step_number(step:int, expected_command:str=None, command_pattern:str=None, deadline:float=None):
   def real_step_number(fn):
     setattr(fn, 'step_number', step)
     setattr(fn, 'expected_command', expected_command)
+    setattr(fn, 'command_pattern', command_pattern)
+    if deadline is not None:
+      setattr(fn, 'deadline_seconds', deadline)
     return fn
   return real_step_number
 
+"""
+A decorator for defining the seconds a step may take before MainHandler cancels it. On a method it
+applies to its step (the largest one if the methods of a step disagree), on a class inheriting
+BaseHandler to every step of the track without a deadline of its own
+"""
+def deadline(seconds: float):
+  def real_deadline(obj):
+    setattr(obj, 'deadline_seconds', seconds)
+    return obj
+  return real_deadline
+
+
+class _StepIndex:
+  """
+  Routing index of the methods of one step, built once per handler class. Literal expected
+  commands are looked up in a dictionary and all command patterns are tried in one pass of a
+  combined regular expression.
+  """
+  __slots__ = ('single', 'exact', 'patterns', 'combined', 'wildcards', 'deadline')
+
+  def __init__(self, funcs: tuple):
+    self.single = funcs[0] if len(funcs) == 1 else None
+    deadlines = [f.deadline_seconds for f in funcs if getattr(f, 'deadline_seconds', None) is not None]
+    self.deadline = max(deadlines) if len(deadlines) > 0 else None
+    self.exact = {}
+    self.patterns = []
+    self.wildcards = []
+    for f in funcs:
+      pattern = getattr(f, 'command_pattern', None)
+      expected_command = getattr(f, 'expected_command', None)
+      if pattern is not None:
+        self.patterns.append((re.compile(pattern), f))
+      elif expected_command is None or expected_command == '*':
+        self.wildcards.append(f)
+      else:
+        self.exact.setdefault(expected_command, []).append(f)
+    self.combined = None
+    # groups are renumbered in the combined expression, which would break numbered backreferences
+    if len(self.patterns) > 1 and all(p.groups == 0 for p, _ in self.patterns):
+      try:
+        self.combined = re.compile('|'.join(f'(?P<_p{i}>{p.pattern})' for i, (p, _) in enumerate(self.patterns)))
+      except re.error:
+        pass  # e.g. inline flags or clashing group names, patterns are then tried one by one
+
+  def candidates(self, command: str):
+    """
+    Yields the methods that can handle the command in the order they should be tried
+    :param command:
+    :return:
+    """
+    if self.single is not None:
+      yield self.single
+      return
+    exact = self.exact.get(command)
+    if exact is not None:
+      yield from exact
+    if len(self.patterns) > 0:
+      start = 0
+      if self.combined is not None:
+        m = self.combined.fullmatch(command)
+        if m is None:
+          start = len(self.patterns)
+        else:
+          # alternatives are tried in order so no pattern before the matching one can match
+          start = int(m.lastgroup[2:])
+          yield self.patterns[start][1]
+          start += 1
+      for p, f in self.patterns[start:]:
+        if p.fullmatch(command) is not None:
+          yield f
+    yield from self.wildcards
+
 
 
 # This is the base class for handlers. A handler class will inherit BaseHandler
@@ -121,40 +504,44 @@ def step_number(step:int, expected_command:str=None):
 # DO NOT override the Handle of the base class as the magic of finding the right method happens there.
 # Step numbers are 0-based with the entry to a track is 0 (e.g. handle_0) and so on.
 # The level the user is at would then be matched to the step of the track.
-# At runtime, all these methods will be discovered (when main handler calls `ensure_tracks_built`)
+# The step table of each handler class is discovered once when the class is defined (see `get_step_table`)
+# and shared by all its instances, so creating handler instances is cheap.
 # Steps within the track will be routed via the _<n> (where <n> is step) in the name
 #
 #
 class BaseHandler:
-  handler_method_pattern = '[_A-Za-z0-9]+_(\d+)'
+  handler_method_pattern = r'[_A-Za-z0-9]+_(\d+)'
+  _handler_method_regex = re.compile(handler_method_pattern)
+  _step_handlers: dict = None
+  # '<module>.<qualified class name>' -> entry of a routing manifest, see botanix.manifest
+  _manifest_entries: dict = {}
 
   def __init__(self):
-    self.step_handlers:dict = None
+    self._step_handlers = None
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    # built and validated when the class is defined
+    cls._step_table = cls._build_step_table()
+    cls._step_index = {step: _StepIndex(funcs) for step, funcs in cls._step_table.items()}
 
   async def handle(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
-    self.ensure_steps_built()
     uid = context.uid
     step = context.step
-    if step not in self.step_handlers:
+    index = self.get_step_index().get(step)
+    if index is None:
       raise UnhandledMessage(
         f'Step {step} does not exist in class {self.__class__.__name__}. Command was {command} and user id {uid}')
-    last_result = HandlingResult.success_result()
-    hs = self.step_handlers[step]
-    if len(hs) == 1:
-      return await hs[0](command, update, context)
-    else: #multiple handler
-
-      # first try based on expected command
-      for h in hs:
-        if command == h.expected_command:
-          return await h(command, update, context)
-      # then try based on wildcard
-      for h in hs:
-        if h.expected_command == '*':
-          return await h(command, update, context)
-
-      # if it gets here, then it will try all of them
-      raise UnhandledMessage()
+    # chain of responsibility: candidates are tried until one of them handles the update
+    result = None
+    for h in index.candidates(command):
+      result = await h(self, command, update, context)
+      if result.handled:
+        return result
+    if result is None:
+      raise UnhandledMessage(
+        f'No method of step {step} in class {self.__class__.__name__} accepts command {command} from user id {uid}')
+    return result
 
   def get_class_name(self):
     if hasattr(self.__class__, 'track_name'):
@@ -162,28 +549,141 @@ class BaseHandler:
     else:
       return self.__class__.__name__.lower().replace('handler', '')
 
-  def ensure_steps_built(self):
-    if self.step_handlers is not None:
-      return
-    self.step_handlers = {}
-    for name, func in inspect.getmembers(self, inspect.ismethod):
+  @classmethod
+  def get_step_table(cls) -> dict:
+    """
+    Returns the step table of the class, shared by all its instances
+    :return: dictionary of step number to the tuple of functions handling that step
+    """
+    table = cls.__dict__.get('_step_table')
+    if table is None:
+      table = cls._step_table = cls._build_step_table()
+    return table
+
+  @classmethod
+  def get_step_index(cls) -> dict:
+    """
+    Returns the routing index of each step of the class, shared by all its instances
+    :return: dictionary of step number to its index
+    """
+    index = cls.__dict__.get('_step_index')
+    if index is None:
+      index = cls._step_index = {step: _StepIndex(funcs) for step, funcs in cls.get_step_table().items()}
+    return index
+
+  @classmethod
+  def get_deadline(cls, step: int):
+    """
+    :return: seconds the step may take, None if it has no deadline
+    """
+    index = cls.get_step_index().get(step)
+    if index is not None and index.deadline is not None:
+      return index.deadline
+    return getattr(cls, 'deadline_seconds', None)
+
+  @classmethod
+  def _build_step_table(cls) -> dict:
+    entry = BaseHandler._manifest_entries.get(f'{cls.__module__}.{cls.__qualname__}')
+    if entry is not None:
+      table = cls._step_table_from_manifest(entry)
+      if table is not None:
+        return table
+    steps = {}
+    for name, func in inspect.getmembers(cls, inspect.isfunction):
+      if isinstance(inspect.getattr_static(cls, name), staticmethod):
+        continue
       step = None
       if hasattr(func, 'step_number'):
         step = func.step_number
       else:
-        m = re.match(BaseHandler.handler_method_pattern, name)
+        m = cls._handler_method_regex.match(name)
         if m is not None:
           step = int(m.groups()[0])
       if step is not None:
-        if step not in self.step_handlers:
-          self.step_handlers[step] = []
-        self.step_handlers[step].append(func)
+        if not isinstance(step, int) or step < 0:
+          raise ValueError(f'Step of {cls.__name__}.{name} must be a non-negative integer but was {step}')
+        steps.setdefault(step, []).append(func)
+    cls._validate_steps(steps)
+    # candidates of a step are tried in the order they are declared, bases first
+    order = {}
+    for klass in reversed(cls.__mro__):
+      for name in klass.__dict__:
+        order.setdefault(name, len(order))
+    return {step: tuple(sorted(funcs, key=lambda f: order.get(f.__name__, len(order))))
+            for step, funcs in steps.items()}
+
+  @classmethod
+  def _validate_steps(cls, steps: dict):
+    for step, funcs in steps.items():
+      expected_commands = [f.expected_command for f in funcs
+                           if getattr(f, 'expected_command', None) not in (None, '*')
+                           and getattr(f, 'command_pattern', None) is None]
+      if len(expected_commands) != len(set(expected_commands)):
+        raise ValueError(f'Step {step} of {cls.__name__} has more than one method for the same expected command')
+
+  @classmethod
+  def manifest_fingerprint(cls) -> str:
+    """
+    Methods of the class and of its bases with their routing attributes (step number, expected
+    command and command pattern), which tell whether a routing manifest still matches the class
+    """
+    members = []
+    for klass in cls.__mro__:
+      for name, f in klass.__dict__.items():
+        if inspect.isfunction(f):
+          members.append(f'{klass.__qualname__}.{name}({getattr(f, "step_number", None)!r},'
+                         f'{getattr(f, "expected_command", None)!r},{getattr(f, "command_pattern", None)!r})')
+    return ','.join(members)
+
+  @classmethod
+  def _step_table_from_manifest(cls, entry: dict):
+    """
+    Builds the step table from the method names of a manifest entry without inspecting the class
+    :return: None if the entry does not match the class any more, e.g. methods were added or renamed
+    """
+    if entry['members'] != cls.manifest_fingerprint():
+      return None
+    table = {}
+    for step, names in entry['steps'].items():
+      funcs = []
+      for name in names:
+        f = cls.__dict__.get(name)
+        if f is None:
+          f = getattr(cls, name, None)
+        if not inspect.isfunction(f):
+          return None
+        funcs.append(f)
+      table[int(step)] = tuple(funcs)
+    cls._validate_steps(table)
+    return table
+
+  @property
+  def step_handlers(self) -> dict:
+    """
+    Step table bound to this instance
+    :return: dictionary of step number to the list of bound methods handling that step
+    """
+    self.ensure_steps_built()
+    return self._step_handlers
+
+  def ensure_steps_built(self):
+    if self._step_handlers is not None:
+      return
+    self._step_handlers = {step: [f.__get__(self) for f in funcs]
+                           for step, funcs in self.get_step_table().items()}
 
 
 class BaseContextStore:
   """
-  Main interface for context store/repository
+  Main interface for context store/repository.
+
+  Stores which set `supports_compare_and_swap` accept an `expected_version` in put_context and
+  clear_context: the write only happens if the stored context is at that version (0 meaning there
+  is none) and raises VersionConflict otherwise. A successful put stores the context with its
+  version increased by one, and updates `context.version` accordingly.
   """
+  supports_compare_and_swap = False
+
   def get_active_context(self, uid: int) -> HandlingContext:
     """
     Returns active contex
@@ -193,6 +693,90 @@ class BaseContextStore:
     pass
 
   def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    """
+    Creates, stores and returns a new context. MainHandler does not use it: it creates
+    the context itself and stores it with a single put_context once the step is handled
+    :param uid:
+    :param track_nam:
+    :return:
+    """
+    pass
+
+  def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
+    """
+    Updates the stored context
+    :param context:
+    :param expected_version: only with supports_compare_and_swap, see the class
+    :return:
+    """
+    pass
+
+  def clear_context(self, uid: int, expected_version: int = None):
+    """
+    Deletes stored context
+    :param uid:
+    :param expected_version: only with supports_compare_and_swap, see the class
+    :return:
+    """
+    pass
+
+  def get_many(self, uids: list) -> dict:
+    """
+    Returns active contexts of several users. Stores able to fetch in bulk should override
+    this, by default it calls get_active_context for each uid
+    :param uids:
+    :return: dictionary of uid to its context. Users with no active context are left out
+    """
+    contexts = {}
+    for uid in uids:
+      ctx = self.get_active_context(uid)
+      if ctx is not None:
+        contexts[uid] = ctx
+    return contexts
+
+  def put_many(self, contexts: list) -> None:
+    """
+    Updates several stored contexts. By default it calls put_context for each context
+    :param contexts:
+    :return:
+    """
+    for ctx in contexts:
+      self.put_context(ctx)
+
+  def clear_many(self, uids: list):
+    """
+    Deletes stored contexts of several users. By default it calls clear_context for each uid
+    :param uids:
+    :return:
+    """
+    for uid in uids:
+      self.clear_context(uid)
+
+  def get_follow_ups(self) -> list:
+    """
+    Lists the pending follow-ups of active contexts, so that a Scheduler can recover them after a
+    restart. Stores which cannot list their contexts keep this default and recover none
+    :return: list of (uid, follow_up_at)
+    """
+    return []
+
+
+class AsyncBaseContextStore:
+  """
+  Awaitable counterpart of BaseContextStore. MainHandler detects stores inheriting
+  this class and awaits their operations instead of calling them on the event loop
+  """
+  supports_compare_and_swap = False
+
+  async def get_active_context(self, uid: int) -> HandlingContext:
+    """
+    Returns active contex
+    :param uid:
+    :return:
+    """
+    pass
+
+  async def new_context(self, uid: int, track_nam: str) -> HandlingContext:
     """
     Creates, stores and returns a new context
     :param uid:
@@ -201,69 +785,591 @@ class BaseContextStore:
     """
     pass
 
-  def put_context(self, context: HandlingContext) -> None:
+  async def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
     """
     Updates the stored context
     :param context:
+    :param expected_version: only with supports_compare_and_swap, see BaseContextStore
     :return:
     """
     pass
 
-  def clear_context(self, uid: int):
+  async def clear_context(self, uid: int, expected_version: int = None):
     """
     Deletes stored context
     :param uid:
+    :param expected_version: only with supports_compare_and_swap, see BaseContextStore
     :return:
     """
     pass
 
+  async def get_many(self, uids: list) -> dict:
+    """
+    Returns active contexts of several users. By default it awaits get_active_context for each uid
+    :param uids:
+    :return: dictionary of uid to its context. Users with no active context are left out
+    """
+    contexts = {}
+    for uid in uids:
+      ctx = await self.get_active_context(uid)
+      if ctx is not None:
+        contexts[uid] = ctx
+    return contexts
+
+  async def put_many(self, contexts: list) -> None:
+    """
+    Updates several stored contexts. By default it awaits put_context for each context
+    :param contexts:
+    :return:
+    """
+    for ctx in contexts:
+      await self.put_context(ctx)
+
+  async def clear_many(self, uids: list):
+    """
+    Deletes stored contexts of several users. By default it awaits clear_context for each uid
+    :param uids:
+    :return:
+    """
+    for uid in uids:
+      await self.clear_context(uid)
+
+  async def get_follow_ups(self) -> list:
+    """
+    Lists the pending follow-ups of active contexts. Optional, see BaseContextStore.get_follow_ups
+    :return: list of (uid, follow_up_at)
+    """
+    return []
 
 
 class MainHandler:
   command_pattern = '^/([A-Za-z0-9]+)$'  # like /start or /Register
   generic_handler_names = ['help', 'start']
+  follow_up_command = '[FOLLOW-UP]'
 
-  def __init__(self, store: BaseContextStore, *list_of_handlers: BaseHandler):
+  def __init__(self, store, *list_of_handlers: BaseHandler, per_user_ordering: bool = False,
+               outbox: Outbox = None, deduplicator: UpdateDeduplicator = None,
+               instrumentation: BaseInstrumentation = None, optimistic_concurrency: bool = False,
+               max_conflict_retries: int = 5, conflict_backoff: float = 0.01, default_deadline: float = None,
+               max_in_flight: int = None, scheduler=None):
+    """
+    :param store: either a BaseContextStore or an AsyncBaseContextStore
+    :param list_of_handlers:
+    :param per_user_ordering: if True, concurrent updates of the same user are handled one by one
+      in arrival order while updates of different users still run concurrently
+    :param outbox: sends the replies handlers queue with HandlingContext.reply
+    :param deduplicator: if set, updates whose update_id was already received are not handled again
+    :param instrumentation: if set, receives timings of store and handler calls, e.g. a Metrics
+    :param optimistic_concurrency: if True, contexts are written only if nobody else wrote them since
+      they were read, so that several processes can serve the same users. On conflict the update is
+      handled again from a fresh read. The store must support compare-and-swap
+    :param max_conflict_retries: handling attempts after the first one before VersionConflict is raised
+    :param conflict_backoff: upper bound in seconds of the random wait before the first retry, doubled
+      at every retry
+    :param default_deadline: seconds a step may take when neither the step nor its track declare a
+      deadline (see the `deadline` decorator), None for no limit. A step past its deadline is
+      cancelled: the step is not advanced, nothing is stored and its replies are dropped
+    :param max_in_flight: when more updates than this are being handled, commands starting a track
+      other than /start and /help are rejected with HandlingResult.overloaded_result() while updates
+      of tracks already started are still handled. None for no limit
+    :param scheduler: a botanix.scheduler.Scheduler dispatching the follow-ups handlers ask for
+    """
     self.handlers = {}
     self.store = store
+    self.is_async_store = isinstance(store, AsyncBaseContextStore)
+    self.instrumentation = instrumentation
+    if optimistic_concurrency and not getattr(store, 'supports_compare_and_swap', False):
+      raise CompareAndSwapNotSupported(f'{type(store).__name__} does not support compare-and-swap writes')
+    self.optimistic_concurrency = optimistic_concurrency
+    self.max_conflict_retries = max_conflict_retries
+    self.conflict_backoff = conflict_backoff
+    self.conflicts = 0
+    self.default_deadline = default_deadline
+    self.max_in_flight = max_in_flight
+    self.in_flight = 0
+    self.timeouts = 0
+    self.shed = 0
+    self._store = store if instrumentation is None else \
+      instrument_store(store, instrumentation, self.is_async_store)
+    self.user_locks = UserLockPool() if per_user_ordering else None
+    self.outbox = outbox
+    self.deduplicator = deduplicator
+    self.scheduler = scheduler
+    if scheduler is not None:
+      scheduler.attach(self)
     for h in list_of_handlers:
-      self.handlers[h.get_class_name()] = h
+      track_nam = h.get_class_name()
+      if track_nam in self.handlers:
+        raise ValueError(f'More than one handler registered for track {track_nam}')
+      h.get_step_table()
+      self.handlers[track_nam] = h
+    self._command_regex = re.compile(self.command_pattern)
+    # index of every command that starts a track, e.g. '/register' -> 'register'
+    self._command_routes = {}
+    for track_nam in self.handlers:
+      m = self._command_regex.match('/' + track_nam)
+      if m is not None and m.groups()[0] == track_nam:
+        self._command_routes['/' + track_nam] = track_nam
 
   async def handle(self, uid: int, message_text: str, update: Update) -> HandlingResult:
-    if message_text is None or len(message_text) == 0:
-      message_text = '[NON-TEXT-CONTENT]'
+    update_id = None
+    if self.deduplicator is not None:
+      update_id = getattr(update, 'update_id', None)
+      if update_id is not None and self.deduplicator.begin(update_id):
+        return HandlingResult.duplicate_result()
+    self.in_flight += 1
+    result = None
+    try:
+      if self.user_locks is None:
+        result = await self._handle(uid, message_text, update, update_id)
+        return result
+      await self.user_locks.acquire(uid)
+      try:
+        result = await self._handle(uid, message_text, update, update_id)
+        return result
+      finally:
+        self.user_locks.release(uid)
+    finally:
+      self.in_flight -= 1
+      if update_id is not None:
+        self.deduplicator.done(update_id, MainHandler._is_done(result))
+
+  async def handle_update(self, update) -> HandlingResult:
+    """
+    Handles an update taking the user id and text from it
+    :param update: an UpdateView (see botanix.updates), which handlers receive as their update
+    :return:
+    """
+    if update.uid is None:
+      return HandlingResult.unhandled_result('Update has no user or chat')
+    return await self.handle(update.uid, update.text, update)
+
+  async def _handle(self, uid: int, message_text: str, update: Update, update_id: int = None) -> HandlingResult:
+    if not self.optimistic_concurrency:
+      return await self._handle_once(uid, message_text, update, update_id)
+    attempt = 0
+    while True:
+      try:
+        return await self._handle_once(uid, message_text, update, update_id)
+      except VersionConflict:
+        self.conflicts += 1
+        if attempt >= self.max_conflict_retries:
+          raise
+        await asyncio.sleep(random.random() * self.conflict_backoff * 2 ** attempt)
+        attempt += 1
+
+  async def _handle_once(self, uid: int, message_text: str, update: Update, update_id: int = None) -> HandlingResult:
+    message_text = MainHandler._normalise_text(message_text)
+    stored = await self._get_context(uid)
+    if self._is_recorded(stored, update_id):
+      return HandlingResult.duplicate_result()
+    if MainHandler._is_stale_follow_up(stored, update):
+      return HandlingResult.unhandled_result('Follow-up is no longer pending')
+    route = self._route(message_text, stored)
+    if route is None:
+      return HandlingResult.unhandled_result('Your choice does not exist.')
+    track_nam, is_command = route
+    ctx = stored
+    if is_command:  # this is a top level command (start of a track)
+      if self._is_overloaded(track_nam):
+        return HandlingResult.overloaded_result()
+      ctx = self._new_track_context(uid, track_nam, stored)
+    return await self._do_handle(uid, message_text, update, ctx, track_nam, stored is not None,
+                                 self._update_id_to_record(ctx, is_command, update_id))
+
+  async def handle_many(self, updates) -> list:
+    """
+    Handles a batch of updates, e.g. a burst received from getUpdates. Updates are grouped by user:
+    those of the same user are handled in order and different users are handled concurrently.
+    Contexts are loaded with one `get_many` call and written back with one `put_many` and one
+    `clear_many` call, instead of a few store round trips per update.
+    :param updates: iterable of (uid, message_text, update) tuples
+    :return: list of results in the same order as updates. If handling an update raised, the exception
+      is put in its place and the rest of the batch is still handled and stored
+    """
+    updates = list(updates)
+    results = [None] * len(updates)
+    by_user = {}
+    for i, (uid, message_text, update) in enumerate(updates):
+      update_id = None
+      if self.deduplicator is not None:
+        update_id = getattr(update, 'update_id', None)
+        if update_id is not None and self.deduplicator.begin(update_id):
+          results[i] = HandlingResult.duplicate_result()
+          continue
+      by_user.setdefault(uid, []).append((i, message_text, update, update_id))
+    uids = list(by_user)
+    in_flight = len(updates)
+    self.in_flight += in_flight
+    stored = False
+    try:
+      await self._handle_by_user(uids, by_user, results)
+      stored = True
+      return results
+    finally:
+      self.in_flight -= in_flight
+      if self.deduplicator is not None:
+        # if the contexts could not be stored, none of the updates is handled
+        for items in by_user.values():
+          for i, _, _, update_id in items:
+            if update_id is not None:
+              self.deduplicator.done(update_id, stored and MainHandler._is_done(results[i]))
+
+  async def _handle_by_user(self, uids: list, by_user: dict, results: list) -> list:
+    if self.user_locks is not None:
+      uids.sort()  # always acquire in the same order so that concurrent batches cannot deadlock
+      for uid in uids:
+        await self.user_locks.acquire(uid)
+    try:
+      if self.optimistic_concurrency:
+        # conditional writes are per context, so users are handled one update at a time
+        await asyncio.gather(*[self._handle_user_updates(uid, by_user[uid], results) for uid in uids])
+        return results
+      contexts = await self._get_many(uids)
+      outcomes = await asyncio.gather(*[self._handle_user_batch(uid, by_user[uid], contexts.get(uid), results)
+                                        for uid in uids])
+      to_put = []
+      to_clear = []
+      replies = []
+      for uid, (ctx, changed, user_replies) in zip(uids, outcomes):
+        replies += user_replies
+        if changed:
+          if ctx is None:
+            to_clear.append(uid)
+          else:
+            to_put.append(ctx)
+      if len(to_put) > 0:
+        for ctx in to_put:
+          ctx.touch()
+        await self._put_many(to_put)
+        for ctx in to_put:
+          ctx.mark_clean()
+      if len(to_clear) > 0:
+        await self._clear_many(to_clear)
+      if self.scheduler is not None:
+        for ctx in to_put:
+          self.scheduler.set(ctx.uid, ctx.follow_up_at)
+        for uid in to_clear:
+          self.scheduler.set(uid, None)
+      self._send_replies(replies)
+    finally:
+      if self.user_locks is not None:
+        for uid in uids:
+          self.user_locks.release(uid)
+    return results
+
+  async def _handle_user_updates(self, uid: int, items: list, results: list):
+    for i, message_text, update, update_id in items:
+      try:
+        results[i] = await self._handle(uid, message_text, update, update_id)
+      except Exception as ex:
+        results[i] = ex
+
+  async def _handle_user_batch(self, uid: int, items: list, ctx: HandlingContext, results: list):
+    """
+    Handles updates of one user against an in-memory context without touching the store
+    :return: tuple of the context to be stored (None if it must be cleared) and whether the store needs a write
+    """
+    had_stored = ctx is not None
+    changed = False
+    replies = []
+    for i, message_text, update, update_id in items:
+      # restored if the update fails or times out, as handle would not store anything then
+      previous, previous_changed, snapshot = ctx, changed, None
+      context = None
+      try:
+        message_text = MainHandler._normalise_text(message_text)
+        if self._is_recorded(ctx, update_id):
+          results[i] = HandlingResult.duplicate_result()
+          continue
+        if MainHandler._is_stale_follow_up(ctx, update):
+          results[i] = HandlingResult.unhandled_result('Follow-up is no longer pending')
+          continue
+        route = self._route(message_text, ctx)
+        if route is None:
+          results[i] = HandlingResult.unhandled_result('Your choice does not exist.')
+          continue
+        track_nam, is_command = route
+        context = ctx
+        if is_command:
+          if self._is_overloaded(track_nam):
+            results[i] = HandlingResult.overloaded_result()
+            continue
+          context = self._new_track_context(uid, track_nam, ctx)
+          if context.is_dirty:
+            ctx = context
+            changed = True
+        record_update_id = self._update_id_to_record(context, is_command, update_id)
+        from_step = context.step
+        # the context may be left half changed by a failed or cancelled step
+        snapshot = MainHandler._snapshot(context) if context is previous else None
+        result = await self._invoke(track_nam, message_text, update, context, self._deadline(track_nam, from_step))
+        if result.is_timed_out:
+          ctx = previous if snapshot is None else snapshot
+          changed = previous_changed
+          context.take_replies()
+          results[i] = result
+          continue
+        if record_update_id is not None:
+          context.record_update(record_update_id)
+        if result.is_terminal:
+          ctx = None
+          changed = had_stored
+        elif result.handled:
+          MainHandler._apply_result(context, result)
+          self._apply_follow_up(context, result)
+        if self.instrumentation is not None and result.handled:
+          self.instrumentation.on_transition(uid, track_nam, from_step, None if result.is_terminal else context.step)
+        if not result.is_terminal and context.is_dirty:
+          ctx = context
+          changed = True
+        replies += context.take_replies()
+        results[i] = result
+      except Exception as ex:
+        if context is not None:
+          context.take_replies()
+        ctx = previous if snapshot is None else snapshot
+        changed = previous_changed
+        results[i] = ex
+    return ctx, changed, replies
+
+  def _route(self, message_text: str, ctx: HandlingContext):
+    """
+    Finds the track an update belongs to
+    :param message_text:
+    :param ctx: active context of the user
+    :return: tuple of the track name and whether the update is a top level command, or None if there
+      is no command and no active track
+    """
     lower_message_text = message_text.lower()
-    ctx = self.store.get_active_context(uid)
-    m = re.match(MainHandler.command_pattern, lower_message_text)
+    class_command = self._command_routes.get(lower_message_text)
+    if class_command is not None:
+      return class_command, True
+    m = self._command_regex.match(lower_message_text)
     if m is None:
       if ctx is None:
-        return HandlingResult.unhandled_result('Your choice does not exist.')
-      else:
-        track_nam = ctx.track_name
-        if track_nam not in self.handlers:
-          raise UnhandledMessage(f'Could not find a handler for command {message_text}')
-        return await self._do_handle(uid, message_text, update, ctx, track_nam)
-    else:  # this is a top level command (start of a track)
-      class_command = m.groups()[0]  # is the same as track_name
-      if class_command not in self.handlers:
-        raise UnhandledMessage(f'Could not find a handler for command {message_text}')
-      if class_command in MainHandler.generic_handler_names:
-        ctx = HandlingContext(uid, track_nam=class_command) # create a dummy context and not store since they do not have follow up
-      else:
-        ctx = self.store.new_context(uid, class_command)  # renew context
-      return await self._do_handle(uid, message_text, update, ctx, class_command)
-
-  async def _do_handle(self, uid: int, command: str, update: Update, context: HandlingContext, class_command: str) -> HandlingResult:
-    result = await self.handlers[class_command].handle( command, update, context)
-    if result.handled and not result.is_terminal:
-      if result.step_override is None:
-        context.move_to_next()  # increase the step
-      else:
-        context.override_step(result.step_override)
-        if result.new_track_name is not None:
-          context.track_name = result.new_track_name
-      self.store.put_context(context)
+        return None
+      track_nam = ctx.track_name
+      if track_nam not in self.handlers:
+        raise self._unknown_command(message_text)
+      return track_nam, False
+    class_command = m.groups()[0]  # is the same as track_name
+    if class_command not in self.handlers:
+      raise self._unknown_command(message_text)
+    return class_command, True
+
+  @staticmethod
+  def _normalise_text(message_text: str) -> str:
+    if message_text is None or len(message_text) == 0:
+      return '[NON-TEXT-CONTENT]'
+    return message_text
+
+  @staticmethod
+  def _apply_result(context: HandlingContext, result: HandlingResult):
+    if result.step_override is None:
+      context.move_to_next()  # increase the step
+    else:
+      context.override_step(result.step_override)
+      if result.new_track_name is not None:
+        context.track_name = result.new_track_name
+
+  def _is_overloaded(self, track_nam: str) -> bool:
+    if self.max_in_flight is None or self.in_flight <= self.max_in_flight \
+        or track_nam in MainHandler.generic_handler_names:
+      return False
+    self.shed += 1
+    if self.instrumentation is not None:
+      self.instrumentation.on_shed(track_nam)
+    return True
+
+  def _deadline(self, track_nam: str, step: int):
+    deadline = self.handlers[track_nam].get_deadline(step)
+    return self.default_deadline if deadline is None else deadline
+
+  @staticmethod
+  def _snapshot(context: HandlingContext) -> HandlingContext:
+    snapshot = context.copy()
+    snapshot.is_dirty = context.is_dirty
+    return snapshot
+
+  @staticmethod
+  def _is_done(result) -> bool:
+    """
+    Whether an update was handled for good, so that a redelivery of it is a duplicate. It is not if
+    handling raised (the result is None or an exception), timed out or was shed
+    """
+    return isinstance(result, HandlingResult) and not result.is_timed_out and not result.is_overloaded
+
+  @staticmethod
+  def _is_stale_follow_up(ctx: HandlingContext, update) -> bool:
+    """
+    Whether the update is a follow-up which is not pending any more, e.g. the user moved on since
+    """
+    return type(update) is FollowUp and (ctx is None or ctx.follow_up_at != update.due)
+
+  def _apply_follow_up(self, context: HandlingContext, result: HandlingResult):
+    if result.follow_up_after is not None:
+      clock = time.time if self.scheduler is None else self.scheduler.clock
+      context.follow_up_at = math.ceil(clock() + result.follow_up_after)
+    else:
+      context.follow_up_at = None
+
+  def _is_recorded(self, ctx: HandlingContext, update_id: int) -> bool:
+    return update_id is not None and ctx is not None and ctx.last_update_id is not None \
+      and update_id <= ctx.last_update_id
+
+  def _update_id_to_record(self, ctx: HandlingContext, is_command: bool, update_id: int):
+    """
+    Returns the update id to persist in the context, if the deduplicator persists them. Generic
+    tracks' dummy contexts are not stored so they do not record it
+    """
+    if update_id is None or not self.deduplicator.persist:
+      return None
+    return update_id if (not is_command or ctx.is_dirty) else None
+
+  def _new_track_context(self, uid: int, track_nam: str, stored: HandlingContext = None) -> HandlingContext:
+    ctx = HandlingContext(uid, track_nam=track_nam)
+    if stored is not None:
+      ctx.version = stored.version  # replaces the stored context
+    if track_nam in MainHandler.generic_handler_names:
+      # a dummy context which is not stored since generic tracks do not have follow up
+      ctx.mark_clean()
+    return ctx
+
+  async def _do_handle(self, uid: int, command: str, update: Update, context: HandlingContext,
+                       class_command: str, had_stored: bool, record_update_id: int = None) -> HandlingResult:
+    from_step = context.step
+    result = await self._invoke(class_command, command, update, context, self._deadline(class_command, from_step))
+    if result.is_timed_out:
+      context.take_replies()
+      return result
+    if record_update_id is not None:
+      context.record_update(record_update_id)
+    if not result.is_terminal and result.handled:
+      MainHandler._apply_result(context, result)
+      self._apply_follow_up(context, result)
+    if self.instrumentation is not None and result.handled:
+      self.instrumentation.on_transition(uid, class_command, from_step, None if result.is_terminal else context.step)
     if result.is_terminal:
-      self.store.clear_context(uid)
+      if had_stored:
+        await self._clear_context(uid, context.version)
+        if self.scheduler is not None:
+          self.scheduler.set(uid, None)
+    else:
+      if context.is_dirty:
+        context.touch()
+        await self._put_context(context)
+        context.mark_clean()
+        if self.scheduler is not None:
+          self.scheduler.set(uid, context.follow_up_at)
+    self._send_replies(context.take_replies())
+    return result
+
+  async def _invoke(self, track_nam: str, command: str, update: Update, context: HandlingContext,
+                    deadline: float = None) -> HandlingResult:
+    handler = self.handlers[track_nam]
+    instrumentation = self.instrumentation
+    if instrumentation is None and deadline is None:
+      return await handler.handle(command, update, context)
+    step = context.step
+    start = time.perf_counter()
+    try:
+      if deadline is None:
+        result = await handler.handle(command, update, context)
+      else:
+        result = await _call_with_deadline(handler.handle(command, update, context), deadline)
+    except _DeadlineExceeded:
+      self.timeouts += 1
+      if instrumentation is not None:
+        instrumentation.on_deadline_exceeded(track_nam, step, deadline)
+      return HandlingResult.timed_out_result()
+    except UnhandledMessage:
+      if instrumentation is not None:
+        instrumentation.on_unhandled_message(track_nam, step)
+      raise
+    except Exception as ex:
+      if instrumentation is not None:
+        instrumentation.on_handler_error(track_nam, step, ex)
+      raise
+    if instrumentation is not None:
+      instrumentation.on_handler(track_nam, step, result, time.perf_counter() - start)
     return result
 
+  def _unknown_command(self, message_text: str) -> UnhandledMessage:
+    if self.instrumentation is not None:
+      self.instrumentation.on_unhandled_message(None, None)
+    return UnhandledMessage(f'Could not find a handler for command {message_text}')
+
+  def _send_replies(self, replies: list):
+    if len(replies) == 0:
+      return
+    if self.outbox is None:
+      raise RuntimeError('Handler queued replies but MainHandler has no outbox to send them')
+    self.outbox.submit(replies)
+
+  async def _get_context(self, uid: int) -> HandlingContext:
+    if self.is_async_store:
+      return await self._store.get_active_context(uid)
+    return self._store.get_active_context(uid)
+
+  async def _put_context(self, context: HandlingContext) -> None:
+    if self.optimistic_concurrency:
+      args = (context, context.version)
+    else:
+      args = (context,)
+    if self.is_async_store:
+      await self._store.put_context(*args)
+    else:
+      self._store.put_context(*args)
+
+  async def _clear_context(self, uid: int, expected_version: int) -> None:
+    if self.optimistic_concurrency:
+      args = (uid, expected_version)
+    else:
+      args = (uid,)
+    if self.is_async_store:
+      await self._store.clear_context(*args)
+    else:
+      self._store.clear_context(*args)
+
+  async def _get_many(self, uids: list) -> dict:
+    if self.is_async_store:
+      return await self._store.get_many(uids)
+    return self._store.get_many(uids)
+
+  async def _put_many(self, contexts: list) -> None:
+    if self.is_async_store:
+      await self._store.put_many(contexts)
+    else:
+      self._store.put_many(contexts)
+
+  async def _clear_many(self, uids: list):
+    if self.is_async_store:
+      await self._store.clear_many(uids)
+    else:
+      self._store.clear_many(uids)
+
+
+class _DeadlineExceeded(Exception):
+  pass
+
+
+async def _call_with_deadline(coro, seconds: float):
+  """
+  Awaits the coroutine for at most `seconds` and cancels it after that. Unlike asyncio.wait_for, a
+  TimeoutError raised by the coroutine itself is not mistaken for the deadline
+  """
+  task = asyncio.ensure_future(coro)
+  try:
+    done, _ = await asyncio.wait((task,), timeout=seconds)
+  except asyncio.CancelledError:
+    task.cancel()
+    raise
+  if len(done) == 0:
+    task.cancel()
+    try:
+      await task
+    except asyncio.CancelledError:
+      pass
+    raise _DeadlineExceeded()
+  return task.result()
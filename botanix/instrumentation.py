@@ -0,0 +1,251 @@
+import bisect
+import time
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class BaseInstrumentation:
+  """
+  Hooks MainHandler calls on its hot path. Every hook does nothing by default, override the ones
+  you need. Hooks run inline on the event loop so they must be fast and must not raise.
+
+  MainHandler only calls them when created with `instrumentation=`, without it the cost is one
+  `is None` check per handler call.
+  """
+
+  def on_store(self, operation: str, seconds: float):
+    """
+    :param operation: one of get, put, clear, get_many, put_many and clear_many
+    :param seconds: duration of the store call
+    """
+
+  def on_handler(self, track_nam: str, step: int, result, seconds: float):
+    """
+    Called after a step handler returned
+    :param track_nam:
+    :param step: step of the context before the handler ran
+    :param result: HandlingResult
+    :param seconds: duration of the handler call
+    """
+
+  def on_unhandled_message(self, track_nam: str, step: int):
+    """
+    Called when UnhandledMessage is raised
+    :param track_nam: None if no track matched the command
+    :param step: None if no track matched the command
+    """
+
+  def on_handler_error(self, track_nam: str, step: int, ex: Exception):
+    """
+    Called when a step handler raised anything but UnhandledMessage
+    """
+
+  def on_transition(self, uid: int, track_nam: str, from_step: int, to_step: int):
+    """
+    Called once the state change of a handled update is known, before it is stored
+    :param to_step: None if the track ended
+    """
+
+  def on_deadline_exceeded(self, track_nam: str, step: int, deadline: float):
+    """
+    Called when a step handler was cancelled because it did not finish within its deadline
+    """
+
+  def on_shed(self, track_nam: str):
+    """
+    Called when a command starting a track was rejected because MainHandler was overloaded
+    """
+
+
+class Histogram:
+  """
+  Counts observations per bucket so that `observe` is a single increment. `cumulative_counts` gives
+  the cumulative counts Prometheus expects
+  """
+  __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+  def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value: float):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative_counts(self) -> list:
+    total = 0
+    cumulative = []
+    for c in self.counts:
+      total += c
+      cumulative.append(total)
+    return cumulative
+
+
+class Metrics(BaseInstrumentation):
+  """
+  In-process metrics of a MainHandler: latency histograms per track and step and per store
+  operation, counts of handled, unhandled and terminal results, of UnhandledMessage, of handler
+  errors, of steps cancelled at their deadline and of rejected tracks. `to_prometheus` renders them in
+  the Prometheus text exposition format.
+  """
+
+  def __init__(self, buckets: tuple = DEFAULT_BUCKETS, prefix: str = 'botanix'):
+    """
+    :param buckets: upper bounds in seconds of the histogram buckets
+    :param prefix: prefix of the metric names
+    """
+    self.buckets = tuple(sorted(buckets))
+    self.prefix = prefix
+    self.handler_seconds = {}  # (track, step) -> Histogram
+    self.store_seconds = {}  # operation -> Histogram
+    self.results = {}  # (track, outcome) -> count
+    self.unhandled_messages = {}  # track -> count
+    self.handler_errors = {}  # (track, exception class name) -> count
+    self.deadlines_exceeded = {}  # (track, step) -> count
+    self.shed = {}  # track -> count
+
+  def on_store(self, operation: str, seconds: float):
+    h = self.store_seconds.get(operation)
+    if h is None:
+      h = self.store_seconds[operation] = Histogram(self.buckets)
+    h.observe(seconds)
+
+  def on_handler(self, track_nam: str, step: int, result, seconds: float):
+    key = (track_nam, step)
+    h = self.handler_seconds.get(key)
+    if h is None:
+      h = self.handler_seconds[key] = Histogram(self.buckets)
+    h.observe(seconds)
+    if result.is_terminal:
+      outcome = 'terminal'
+    elif result.handled:
+      outcome = 'handled'
+    else:
+      outcome = 'unhandled'
+    key = (track_nam, outcome)
+    self.results[key] = self.results.get(key, 0) + 1
+
+  def on_unhandled_message(self, track_nam: str, step: int):
+    key = track_nam or ''
+    self.unhandled_messages[key] = self.unhandled_messages.get(key, 0) + 1
+
+  def on_handler_error(self, track_nam: str, step: int, ex: Exception):
+    key = (track_nam, type(ex).__name__)
+    self.handler_errors[key] = self.handler_errors.get(key, 0) + 1
+
+  def on_deadline_exceeded(self, track_nam: str, step: int, deadline: float):
+    key = (track_nam, step)
+    self.deadlines_exceeded[key] = self.deadlines_exceeded.get(key, 0) + 1
+
+  def on_shed(self, track_nam: str):
+    self.shed[track_nam] = self.shed.get(track_nam, 0) + 1
+
+  def to_prometheus(self) -> str:
+    """
+    :return: all metrics in the Prometheus text exposition format (version 0.0.4)
+    """
+    lines = []
+    p = self.prefix
+    self._write_histograms(lines, f'{p}_handler_seconds', 'Duration of step handler calls',
+                           {(('track', t), ('step', s)): h for (t, s), h in self.handler_seconds.items()})
+    self._write_histograms(lines, f'{p}_store_seconds', 'Duration of context store calls',
+                           {(('operation', o),): h for o, h in self.store_seconds.items()})
+    self._write_counters(lines, f'{p}_results_total', 'Results of step handlers',
+                         {(('track', t), ('outcome', o)): n for (t, o), n in self.results.items()})
+    self._write_counters(lines, f'{p}_unhandled_messages_total', 'UnhandledMessage raised, track is empty '
+                         'when no track matched', {(('track', t),): n for t, n in self.unhandled_messages.items()})
+    self._write_counters(lines, f'{p}_handler_errors_total', 'Exceptions raised by step handlers',
+                         {(('track', t), ('exception', e)): n for (t, e), n in self.handler_errors.items()})
+    self._write_counters(lines, f'{p}_deadline_exceeded_total', 'Step handlers cancelled at their deadline',
+                         {(('track', t), ('step', s)): n for (t, s), n in self.deadlines_exceeded.items()})
+    self._write_counters(lines, f'{p}_shed_total', 'Commands starting a track rejected while overloaded',
+                         {(('track', t),): n for t, n in self.shed.items()})
+    return '\n'.join(lines) + '\n'
+
+  @staticmethod
+  def _write_histograms(lines: list, name: str, help_text: str, histograms: dict):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for labels, h in sorted(histograms.items(), key=lambda kv: str(kv[0])):
+      base = _format_labels(labels)
+      for le, c in zip(h.buckets + (float('inf'),), h.cumulative_counts()):
+        bound = '+Inf' if le == float('inf') else repr(float(le))
+        lines.append(f'{name}_bucket{{{base},le="{bound}"}} {c}')
+      lines.append(f'{name}_sum{{{base}}} {h.sum!r}')
+      lines.append(f'{name}_count{{{base}}} {h.count}')
+
+  @staticmethod
+  def _write_counters(lines: list, name: str, help_text: str, counters: dict):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for labels, n in sorted(counters.items(), key=lambda kv: str(kv[0])):
+      lines.append(f'{name}{{{_format_labels(labels)}}} {n}')
+
+
+def _format_labels(labels: tuple) -> str:
+  return ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+
+
+def _escape(value) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _InstrumentedStore:
+  """
+  Times the calls MainHandler makes to a BaseContextStore
+  """
+
+  def __init__(self, store, instrumentation: BaseInstrumentation):
+    self.store = store
+    self.instrumentation = instrumentation
+
+  def _timed(self, operation: str, method, *args):
+    start = time.perf_counter()
+    try:
+      return method(*args)
+    finally:
+      self.instrumentation.on_store(operation, time.perf_counter() - start)
+
+  def get_active_context(self, uid: int):
+    return self._timed('get', self.store.get_active_context, uid)
+
+  def put_context(self, context, *expected_version):
+    return self._timed('put', self.store.put_context, context, *expected_version)
+
+  def clear_context(self, uid: int, *expected_version):
+    return self._timed('clear', self.store.clear_context, uid, *expected_version)
+
+  def get_many(self, uids: list) -> dict:
+    return self._timed('get_many', self.store.get_many, uids)
+
+  def put_many(self, contexts: list):
+    return self._timed('put_many', self.store.put_many, contexts)
+
+  def clear_many(self, uids: list):
+    return self._timed('clear_many', self.store.clear_many, uids)
+
+
+class _AsyncInstrumentedStore(_InstrumentedStore):
+  """
+  Times the calls MainHandler makes to an AsyncBaseContextStore
+  """
+
+  async def _timed(self, operation: str, method, *args):
+    start = time.perf_counter()
+    try:
+      return await method(*args)
+    finally:
+      self.instrumentation.on_store(operation, time.perf_counter() - start)
+
+
+def instrument_store(store, instrumentation: BaseInstrumentation, is_async: bool):
+  """
+  :return: a proxy of store reporting the duration of each call to instrumentation.on_store
+  """
+  if is_async:
+    return _AsyncInstrumentedStore(store, instrumentation)
+  return _InstrumentedStore(store, instrumentation)
@@ -0,0 +1,86 @@
+"""
+Routing manifest: the step tables of handler classes computed at build time, so that a cold process
+(e.g. a serverless container) defines its handler classes without inspecting them.
+
+  python -m botanix.manifest mybot.handlers -o botanix-manifest.json
+
+then, before the handler modules are imported:
+
+  from botanix.manifest import load_manifest
+  load_manifest('botanix-manifest.json')
+
+A class whose methods or their routing decorators changed since the manifest was built, in the
+class or one of its bases, is inspected as usual. Rebuild the manifest as part of packaging so that
+it stays in sync.
+"""
+import argparse
+import importlib
+import inspect
+import json
+import sys
+from botanix.handling import BaseHandler
+
+MANIFEST_VERSION = 1
+
+
+def _subclasses(cls) -> list:
+  found = []
+  for sub in cls.__subclasses__():
+    found.append(sub)
+    found += _subclasses(sub)
+  return found
+
+
+def build_manifest(module_names: list) -> dict:
+  """
+  Imports the modules and collects the step tables of the BaseHandler subclasses they define
+  :param module_names: e.g. ['mybot.handlers']
+  :return: the manifest, which can be dumped as JSON
+  """
+  for name in module_names:
+    importlib.import_module(name)
+  handlers = {}
+  for cls in _subclasses(BaseHandler):
+    if cls.__module__ not in module_names:
+      continue
+    names = {f: name for name, f in inspect.getmembers(cls, inspect.isfunction)}
+    handlers[f'{cls.__module__}.{cls.__qualname__}'] = {
+      'members': cls.manifest_fingerprint(),
+      'steps': {str(step): [names[f] for f in funcs] for step, funcs in sorted(cls.get_step_table().items())},
+    }
+  return {'version': MANIFEST_VERSION, 'handlers': handlers}
+
+
+def write_manifest(module_names: list, path: str) -> dict:
+  manifest = build_manifest(module_names)
+  with open(path, 'w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  return manifest
+
+
+def load_manifest(path: str) -> int:
+  """
+  Makes handler classes defined from now on take their step table from the manifest
+  :param path: file written by write_manifest
+  :return: number of handler classes in the manifest
+  """
+  with open(path) as f:
+    manifest = json.load(f)
+  if manifest.get('version') != MANIFEST_VERSION:
+    raise ValueError(f'Unsupported manifest version {manifest.get("version")} in {path}')
+  BaseHandler._manifest_entries.update(manifest['handlers'])
+  return len(manifest['handlers'])
+
+
+def main(argv: list = None) -> int:
+  parser = argparse.ArgumentParser(description='Writes the routing manifest of handler modules')
+  parser.add_argument('modules', nargs='+', help='modules defining BaseHandler subclasses')
+  parser.add_argument('-o', '--output', default='botanix-manifest.json', help='manifest file to write')
+  args = parser.parse_args(argv)
+  manifest = write_manifest(args.modules, args.output)
+  print(f'{len(manifest["handlers"])} handler classes written to {args.output}')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
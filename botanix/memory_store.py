@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+from botanix.handling import BaseContextStore, HandlingContext, VersionConflict
+
+
+class _Shard:
+  __slots__ = ('contexts', 'lock')
+
+  def __init__(self):
+    self.contexts = OrderedDict()  # ordered by time of last write, oldest first
+    self.lock = threading.Lock()
+
+
+class MemoryContextStore(BaseContextStore):
+  """
+  In-process context store for single node bots. Contexts are spread over shards by uid, each with
+  its own lock, to reduce contention between threads.
+
+  Memory is bounded by `max_contexts`: when a shard is full, the context written least recently is
+  evicted. Contexts whose timestamp (the time MainHandler last wrote them) is older than `ttl`
+  seconds are considered abandoned. They are expired lazily when read and by `sweep`, which only
+  looks at the oldest contexts of each shard so its cost is proportional to what it removes.
+  `start_sweeper` runs sweep periodically on a background thread.
+
+  Writes can be made conditional on the stored version (compare-and-swap), which makes the store
+  usable with MainHandler's optimistic concurrency.
+  """
+  supports_compare_and_swap = True
+
+  def __init__(self, max_contexts: int = 1000000, ttl: float = None, shards: int = 16, clock=time.time):
+    """
+    :param max_contexts: maximum number of contexts kept
+    :param ttl: seconds after which a context not written is expired, None to never expire
+    :param shards: number of shards
+    :param clock: source of epoch time in seconds
+    """
+    self.shards = [_Shard() for _ in range(shards)]
+    self.max_per_shard = max(1, -(-max_contexts // shards))
+    self.ttl = ttl
+    self.clock = clock
+    self.evictions = 0
+    self.expirations = 0
+    self._sweeper = None
+    self._stop_sweeper = threading.Event()
+
+  def _shard(self, uid: int) -> _Shard:
+    return self.shards[uid % len(self.shards)]
+
+  def _is_expired(self, ctx: HandlingContext, now: float) -> bool:
+    return self.ttl is not None and ctx.timestamp + self.ttl <= now
+
+  def get_active_context(self, uid: int) -> HandlingContext:
+    shard = self._shard(uid)
+    with shard.lock:
+      ctx = shard.contexts.get(uid)
+      if ctx is None:
+        return None
+      if self._is_expired(ctx, self.clock()):
+        del shard.contexts[uid]
+        self.expirations += 1
+        return None
+      return ctx.copy()
+
+  def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    ctx = HandlingContext(uid, track_nam)
+    self.put_context(ctx)
+    return ctx
+
+  def _stored_version(self, shard: _Shard, uid: int) -> int:
+    ctx = shard.contexts.get(uid)
+    return 0 if ctx is None or self._is_expired(ctx, self.clock()) else ctx.version
+
+  def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
+    shard = self._shard(context.uid)
+    with shard.lock:
+      if expected_version is not None:
+        version = self._stored_version(shard, context.uid)
+        if version != expected_version:
+          raise VersionConflict(f'Context of user {context.uid} is at version {version}, not {expected_version}')
+      context.version = (context.version if expected_version is None else expected_version) + 1
+      stored = context.copy()
+      stored.mark_clean()
+      shard.contexts[context.uid] = stored
+      shard.contexts.move_to_end(context.uid)
+      while len(shard.contexts) > self.max_per_shard:
+        shard.contexts.popitem(last=False)
+        self.evictions += 1
+
+  def clear_context(self, uid: int, expected_version: int = None):
+    shard = self._shard(uid)
+    with shard.lock:
+      if expected_version is not None:
+        version = self._stored_version(shard, uid)
+        if version != expected_version:
+          raise VersionConflict(f'Context of user {uid} is at version {version}, not {expected_version}')
+      shard.contexts.pop(uid, None)
+
+  def get_follow_ups(self) -> list:
+    follow_ups = []
+    now = self.clock()
+    for shard in self.shards:
+      with shard.lock:
+        follow_ups += [(uid, ctx.follow_up_at) for uid, ctx in shard.contexts.items()
+                       if ctx.follow_up_at is not None and not self._is_expired(ctx, now)]
+    return follow_ups
+
+  def sweep(self, max_per_shard: int = 1000) -> int:
+    """
+    Removes expired contexts, starting from the oldest of each shard
+    :param max_per_shard: maximum number of contexts removed from each shard in this call
+    :return: number of contexts removed
+    """
+    if self.ttl is None:
+      return 0
+    removed = 0
+    now = self.clock()
+    for shard in self.shards:
+      with shard.lock:
+        contexts = shard.contexts
+        for _ in range(max_per_shard):
+          if len(contexts) == 0:
+            break
+          uid = next(iter(contexts))
+          if not self._is_expired(contexts[uid], now):
+            break
+          del contexts[uid]
+          removed += 1
+    self.expirations += removed
+    return removed
+
+  def start_sweeper(self, interval: float = 1.0, max_per_shard: int = 1000):
+    """
+    Starts sweeping expired contexts every `interval` seconds on a daemon thread
+    :param interval:
+    :param max_per_shard:
+    :return:
+    """
+    if self._sweeper is not None:
+      return
+    self._stop_sweeper.clear()
+
+    def run():
+      while not self._stop_sweeper.wait(interval):
+        self.sweep(max_per_shard)
+
+    self._sweeper = threading.Thread(target=run, name='botanix-memory-store-sweeper', daemon=True)
+    self._sweeper.start()
+
+  def close(self):
+    """
+    Stops the background sweeper if running
+    :return:
+    """
+    if self._sweeper is not None:
+      self._stop_sweeper.set()
+      self._sweeper.join()
+      self._sweeper = None
+
+  def __len__(self):
+    return sum(len(shard.contexts) for shard in self.shards)
@@ -0,0 +1,223 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class OutgoingMessage:
+  __slots__ = ('chat_id', 'text', 'kwargs')
+
+  def __init__(self, chat_id: int, text: str, kwargs: dict = None):
+    self.chat_id = chat_id
+    self.text = text
+    self.kwargs = kwargs or {}
+
+
+class TokenBucket:
+  """
+  Allows `rate` operations per second on average with bursts of up to `capacity`
+  """
+  __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+  def __init__(self, rate: float, capacity: float, now: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = now
+
+  def _refill(self, now: float):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def delay(self, now: float) -> float:
+    """
+    Seconds to wait before a token is available
+    """
+    self._refill(now)
+    return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+  def take(self, now: float):
+    self._refill(now)
+    self.tokens -= 1
+
+  def is_full(self, now: float) -> bool:
+    self._refill(now)
+    return self.tokens >= self.capacity
+
+
+class OutboxStats:
+  __slots__ = ('sent', 'coalesced', 'retries', 'failed')
+
+  def __init__(self):
+    self.sent = 0
+    self.coalesced = 0
+    self.retries = 0
+    self.failed = 0
+
+
+class Outbox:
+  """
+  Sends the replies handlers put on their context with `HandlingContext.reply`, once MainHandler has
+  stored the new state, so handler latency does not include calls to Telegram.
+
+  Sending respects Telegram's limits with token buckets, one global and one per chat. Chats are served
+  concurrently by up to `max_concurrency` senders but messages of the same chat are sent one at a time
+  and in order. Consecutive plain texts waiting for the same chat are coalesced into one message.
+  When Telegram answers with a retry-after (429), the message is retried after the given delay.
+  """
+
+  def __init__(self, bot, global_rate: float = 30, per_chat_rate: float = 1, global_burst: float = 30,
+               per_chat_burst: float = 1, max_concurrency: int = 16, coalesce: bool = True,
+               max_message_length: int = 4096, separator: str = '\n\n', max_retries: int = 3,
+               clock=time.monotonic):
+    """
+    :param bot: telegram Bot, or anything with an awaitable send_message(chat_id=, text=, **kwargs)
+    :param global_rate: messages per second over all chats
+    :param per_chat_rate: messages per second to one chat
+    :param global_burst:
+    :param per_chat_burst:
+    :param max_concurrency: maximum number of messages being sent at a time
+    :param coalesce: if True, consecutive texts to the same chat are joined while waiting
+    :param max_message_length: coalesced texts stay within Telegram's message length
+    :param separator: put between coalesced texts
+    :param max_retries: retries of a message after retry-after answers
+    :param clock: source of monotonic time in seconds
+    """
+    self.bot = bot
+    self.per_chat_rate = per_chat_rate
+    self.per_chat_burst = per_chat_burst
+    self.max_concurrency = max_concurrency
+    self.coalesce = coalesce
+    self.max_message_length = max_message_length
+    self.separator = separator
+    self.max_retries = max_retries
+    self.clock = clock
+    self.stats = OutboxStats()
+    self.global_bucket = TokenBucket(global_rate, global_burst, clock())
+    self._chat_buckets = {}
+    self._prune_threshold = 4096
+    self._chats = {}  # chat id -> deque of messages waiting
+    self._ready = None
+    self._senders = []
+    self._pending = 0
+    self._idle = None
+
+  def submit(self, messages: list):
+    """
+    Queues messages for sending. Must be called from the event loop
+    :param messages: list of OutgoingMessage
+    :return:
+    """
+    if len(messages) == 0:
+      return
+    self._ensure_started()
+    for m in messages:
+      q = self._chats.get(m.chat_id)
+      if q is None:
+        q = self._chats[m.chat_id] = deque()
+        self._ready.put_nowait(m.chat_id)  # a chat is scheduled once while it has messages
+      q.append(m)
+      self._pending += 1
+    self._idle.clear()
+
+  async def flush(self):
+    """
+    Waits until all queued messages are sent or have failed
+    :return:
+    """
+    if self._idle is not None:
+      await self._idle.wait()
+
+  async def stop(self, flush: bool = True):
+    if flush:
+      await self.flush()
+    for t in self._senders:
+      t.cancel()
+    await asyncio.gather(*self._senders, return_exceptions=True)
+    self._senders = []
+
+  def _ensure_started(self):
+    if len(self._senders) == 0:
+      self._ready = asyncio.Queue()
+      self._idle = asyncio.Event()
+      for chat_id in self._chats:
+        self._ready.put_nowait(chat_id)
+      self._senders = [asyncio.create_task(self._send_loop()) for _ in range(self.max_concurrency)]
+
+  async def _send_loop(self):
+    while True:
+      chat_id = await self._ready.get()
+      try:
+        await self._send_next(chat_id)
+      except Exception:
+        logger.exception('Outbox failed to send to chat %s', chat_id)
+      finally:
+        q = self._chats.get(chat_id)
+        if q is not None:
+          if len(q) > 0:
+            self._ready.put_nowait(chat_id)
+          else:
+            del self._chats[chat_id]
+        if self._pending == 0:
+          self._idle.set()
+        if self._pending == 0 or len(self._chat_buckets) > self._prune_threshold:
+          self._prune_buckets()
+
+  async def _send_next(self, chat_id: int):
+    bucket = self._chat_buckets.get(chat_id)
+    if bucket is None:
+      bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, self.clock())
+    while True:
+      delay = max(bucket.delay(self.clock()), self.global_bucket.delay(self.clock()))
+      if delay <= 0:
+        break
+      await asyncio.sleep(delay)
+    now = self.clock()
+    bucket.take(now)
+    self.global_bucket.take(now)
+    text, kwargs, count = self._take(self._chats[chat_id])
+    attempt = 0
+    try:
+      while True:
+        try:
+          await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+          self.stats.sent += 1
+          return
+        except Exception as ex:
+          retry_after = getattr(ex, 'retry_after', None)
+          if retry_after is None or attempt >= self.max_retries:
+            self.stats.failed += 1
+            raise
+          if isinstance(retry_after, datetime.timedelta):
+            retry_after = retry_after.total_seconds()
+          attempt += 1
+          self.stats.retries += 1
+          await asyncio.sleep(retry_after)
+    finally:
+      self._pending -= count
+
+  def _take(self, q: deque) -> tuple:
+    """
+    Pops the next message of a chat, joined with the texts following it if they can be coalesced
+    :return: tuple of text, keyword arguments and the number of messages taken
+    """
+    m = q.popleft()
+    if not self.coalesce or len(m.kwargs) > 0:
+      return m.text, m.kwargs, 1
+    texts = [m.text]
+    length = len(m.text)
+    while len(q) > 0 and len(q[0].kwargs) == 0 and \
+        length + len(self.separator) + len(q[0].text) <= self.max_message_length:
+      length += len(self.separator) + len(q[0].text)
+      texts.append(q.popleft().text)
+    self.stats.coalesced += len(texts) - 1
+    return self.separator.join(texts), m.kwargs, len(texts)
+
+  def _prune_buckets(self):
+    now = self.clock()
+    for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._chats and b.is_full(now)]:
+      del self._chat_buckets[chat_id]
+    self._prune_threshold = max(4096, 2 * len(self._chat_buckets))
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import ssl
+import urllib.parse
+from botanix.handling import MainHandler
+from botanix.updates import parse_update
+
+logger = logging.getLogger(__name__)
+
+
+class PollingRunner:
+  """
+  Receives updates with long polling (getUpdates) and handles them with MainHandler.handle_many,
+  so updates of different users in a batch are handled concurrently and in order per user.
+
+  By default the next getUpdates is only sent once the batch has been handled, so Telegram only ever
+  gets the offset after the handled prefix and updates of a batch interrupted by a crash are
+  redelivered (at-least-once delivery). With `pipeline`, the next request is already waiting on the
+  network while the current batch is handled, which saves a round trip per batch, but Telegram treats
+  its offset as confirming the batch in flight: those updates are lost on a crash. In both modes
+  `committed_offset` and `on_commit` only ever reflect updates which have been handled.
+  """
+
+  def __init__(self, main_handler: MainHandler, token: str, base_url: str = 'https://api.telegram.org',
+               timeout: int = 30, limit: int = 100, allowed_updates: list = None, pipeline: bool = False,
+               offset: int = None, on_commit=None, retry_delay: float = 1.0):
+    """
+    :param main_handler:
+    :param token: bot token
+    :param base_url: Bot API server, e.g. a local Bot API server or a fake one in tests
+    :param timeout: long polling timeout in seconds
+    :param limit: maximum number of updates per request
+    :param allowed_updates: update types to receive, None for Telegram's default
+    :param pipeline: if True, poll for the next batch while the current one is handled, at the cost of
+      losing that batch on a crash
+    :param offset: offset to start from, e.g. the last committed offset persisted by on_commit
+    :param on_commit: optional callable receiving the offset after each handled batch
+    :param retry_delay: seconds to wait after a failed getUpdates
+    """
+    self.main_handler = main_handler
+    self.url = f'{base_url.rstrip("/")}/bot{token}/getUpdates'
+    self.timeout = timeout
+    self.limit = limit
+    self.allowed_updates = allowed_updates
+    self.pipeline = pipeline
+    self.committed_offset = offset
+    self.on_commit = on_commit
+    self.retry_delay = retry_delay
+    self.handled = 0
+    self.failed = 0
+    self._stopping = False
+    self._fetch = None
+
+  async def run(self):
+    """
+    Polls and handles updates until `stop` is called
+    :return:
+    """
+    self._stopping = False
+    received_offset = self.committed_offset
+    self._fetch = asyncio.create_task(self._get_updates(received_offset))
+    try:
+      while not self._stopping:
+        try:
+          updates = await self._fetch
+        except asyncio.CancelledError:
+          if self._stopping:
+            break
+          raise
+        except Exception:
+          logger.exception('getUpdates failed')
+          await asyncio.sleep(self.retry_delay)
+          self._fetch = asyncio.create_task(self._get_updates(received_offset))
+          continue
+        if received_offset is not None:
+          updates = [u for u in updates if u['update_id'] >= received_offset]
+        if len(updates) == 0:
+          self._fetch = asyncio.create_task(self._get_updates(received_offset))
+          continue
+        received_offset = updates[-1]['update_id'] + 1
+        if self.pipeline:
+          self._fetch = asyncio.create_task(self._get_updates(received_offset))
+        await self._dispatch(updates)
+        self._commit(received_offset)
+        if not self.pipeline:
+          self._fetch = asyncio.create_task(self._get_updates(received_offset))
+    finally:
+      if self._fetch is not None and not self._fetch.done():
+        self._fetch.cancel()
+
+  def stop(self):
+    """
+    Stops polling once the batch being handled, if any, is done
+    :return:
+    """
+    self._stopping = True
+    if self._fetch is not None and not self._fetch.done():
+      self._fetch.cancel()
+
+  async def _dispatch(self, updates: list):
+    items = []
+    for u in updates:
+      try:
+        uid, message_text, update = parse_update(u)
+      except Exception:
+        self.failed += 1
+        logger.exception('Could not parse update %s', u.get('update_id'))
+        continue
+      if uid is None:
+        logger.warning('Ignoring update %s without user or chat', u.get('update_id'))
+        continue
+      items.append((uid, message_text, update))
+    results = await self.main_handler.handle_many(items)
+    for r in results:
+      if isinstance(r, Exception):
+        self.failed += 1
+        logger.error('Failed to handle update', exc_info=r)
+      else:
+        self.handled += 1
+
+  def _commit(self, offset: int):
+    self.committed_offset = offset
+    if self.on_commit is not None:
+      self.on_commit(offset)
+
+  async def _get_updates(self, offset: int) -> list:
+    params = {'timeout': self.timeout, 'limit': self.limit}
+    if offset is not None:
+      params['offset'] = offset
+    if self.allowed_updates is not None:
+      params['allowed_updates'] = json.dumps(self.allowed_updates)
+    url = f'{self.url}?{urllib.parse.urlencode(params)}'
+    j = json.loads(await asyncio.wait_for(_http_get(url), self.timeout + 10))
+    if not j.get('ok'):
+      raise RuntimeError(f'getUpdates failed: {j.get("description")}')
+    return j['result']
+
+
+async def _http_get(url: str) -> bytes:
+  """
+  Minimal HTTP/1.1 GET on asyncio streams, so that a pending long poll can be cancelled
+  """
+  parts = urllib.parse.urlsplit(url)
+  secure = parts.scheme == 'https'
+  port = parts.port or (443 if secure else 80)
+  reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                                 ssl=ssl.create_default_context() if secure else None)
+  try:
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept: application/json\r\n'
+                 f'Connection: close\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, _, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      body = bytearray()
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+          break
+        body += await reader.readexactly(size)
+        await reader.readline()
+      body = bytes(body)
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read()
+    if status >= 500:
+      raise RuntimeError(f'getUpdates failed with status {status}')
+    return body  # Bot API errors below 500 carry a JSON description
+  finally:
+    writer.close()
@@ -0,0 +1,295 @@
+"""
+Record and replay of the updates a MainHandler receives.
+
+Log format: the magic bytes below, then one record per update:
+
+  record length (uint32, excluding itself) | arrival time (float64, epoch seconds) | uid (int64) |
+  text length (int32, -1 if None) | text (UTF-8) | raw update (JSON, the rest of the record)
+
+A record is written with a single write so a log cut short by a crash only loses its last record.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from botanix.handling import MainHandler
+from botanix.updates import UpdateView
+
+MAGIC = b'BTXLOG1\n'
+_record_header = struct.Struct('<Idqi')  # length, arrival time, uid, text length
+_fixed_size = _record_header.size - 4  # part of the header counted in the record length
+
+
+class RecordedUpdate:
+  __slots__ = ('arrival', 'uid', 'text', 'raw')
+
+  def __init__(self, arrival: float, uid: int, text: str, raw: bytes):
+    self.arrival = arrival
+    self.uid = uid
+    self.text = text
+    self.raw = raw
+
+  def to_update(self):
+    """
+    :return: the telegram Update parsed from the raw JSON, None if it was not recorded
+    """
+    if len(self.raw) == 0:
+      return None
+    from telegram import Update
+    return Update.de_json(json.loads(self.raw), None)
+
+  def to_view(self):
+    """
+    :return: an UpdateView of the raw JSON, as handlers receive live updates, None if it was not recorded
+    """
+    if len(self.raw) == 0:
+      return None
+    return UpdateView.from_body(self.raw)
+
+
+class UpdateLogWriter:
+  """
+  Appends updates to a log. Writes are buffered, call `flush` or `close` to make sure they are on disk
+  """
+
+  def __init__(self, path: str, buffer_size: int = 1 << 16):
+    self.path = path
+    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+    self._file = open(path, 'ab', buffering=buffer_size)
+    if is_new:
+      self._file.write(MAGIC)
+    self.records = 0
+
+  def append(self, uid: int, text: str, raw: bytes, arrival: float = None):
+    text_bytes = b'' if text is None else text.encode('utf-8')
+    header = _record_header.pack(_fixed_size + len(text_bytes) + len(raw), time.time() if arrival is None else arrival,
+                                 uid, -1 if text is None else len(text_bytes))
+    self._file.write(b''.join((header, text_bytes, raw)))
+    self.records += 1
+
+  def flush(self):
+    self._file.flush()
+
+  def close(self):
+    self._file.close()
+
+
+class UpdateLog:
+  """
+  Reads a log through a memory map. Iterating yields RecordedUpdate in the order they were written
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._file = open(path, 'rb')
+    size = os.fstat(self._file.fileno()).st_size
+    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+    if self._map[:len(MAGIC)] != MAGIC:
+      self.close()
+      raise ValueError(f'{path} is not an update log')
+
+  def __iter__(self):
+    data = self._map
+    pos = len(MAGIC)
+    end = len(data)
+    while pos + _record_header.size <= end:
+      length, arrival, uid, text_length = _record_header.unpack_from(data, pos)
+      record_end = pos + 4 + length
+      if record_end > end:
+        break  # incomplete last record
+      text_start = pos + _record_header.size
+      raw_start = text_start + max(0, text_length)
+      text = None if text_length < 0 else data[text_start:raw_start].decode('utf-8')
+      yield RecordedUpdate(arrival, uid, text, data[raw_start:record_end])
+      pos = record_end
+
+  def close(self):
+    if isinstance(self._map, mmap.mmap):
+      self._map.close()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class RecordingMainHandler:
+  """
+  Middleware in front of a MainHandler which appends every update it receives to a log, then hands
+  it over. It can be passed wherever a MainHandler is expected, e.g. to WebhookServer or PollingRunner
+  """
+
+  def __init__(self, main_handler: MainHandler, writer: UpdateLogWriter):
+    self.main_handler = main_handler
+    self.writer = writer
+
+  def _record(self, uid: int, message_text: str, update):
+    to_json = getattr(update, 'to_json', None)
+    raw = b'' if to_json is None else to_json().encode('utf-8')
+    self.writer.append(uid, message_text, raw)
+
+  async def handle(self, uid: int, message_text: str, update):
+    self._record(uid, message_text, update)
+    return await self.main_handler.handle(uid, message_text, update)
+
+  async def handle_update(self, update):
+    """
+    Records then hands over an update taking the user id and text from it, see MainHandler.handle_update
+    """
+    if update.uid is not None:  # not handled, hence not recorded
+      self._record(update.uid, update.text, update)
+    return await self.main_handler.handle_update(update)
+
+  async def handle_many(self, updates) -> list:
+    updates = list(updates)
+    for uid, message_text, update in updates:
+      self._record(uid, message_text, update)
+    return await self.main_handler.handle_many(updates)
+
+  def close(self):
+    self.writer.close()
+
+
+class FakeBot:
+  """
+  Stands in for telegram Bot while replaying: sends nothing, records what would have been sent and
+  optionally simulates the latency of the Bot API
+  """
+
+  def __init__(self, latency: float = 0.0):
+    self.latency = latency
+    self.sent = []
+
+  async def send_message(self, chat_id, text: str, **kwargs):
+    if self.latency > 0:
+      await asyncio.sleep(self.latency)
+    self.sent.append((chat_id, text, kwargs))
+
+  def __getattr__(self, name: str):
+    # any other Bot API method does nothing
+    if name.startswith('_'):
+      raise AttributeError(name)
+
+    async def call(*args, **kwargs):
+      if self.latency > 0:
+        await asyncio.sleep(self.latency)
+    return call
+
+
+class ReplayStats:
+  __slots__ = ('updates', 'failed', 'elapsed', 'latencies')
+
+  def __init__(self):
+    self.updates = 0
+    self.failed = 0
+    self.elapsed = 0.0
+    self.latencies = []
+
+  @property
+  def updates_per_sec(self) -> float:
+    return self.updates / self.elapsed if self.elapsed > 0 else 0.0
+
+  def percentile(self, p: float) -> float:
+    if len(self.latencies) == 0:
+      return 0.0
+    values = sorted(self.latencies)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+async def replay(log: UpdateLog, main_handler: MainHandler, speed: float = None, batch_size: int = 100) -> ReplayStats:
+  """
+  Feeds the updates of a log to a MainHandler. Handlers receive UpdateViews, like live updates
+  :param log:
+  :param main_handler:
+  :param speed: None to replay as fast as possible, in batches of `batch_size` handled with
+    handle_many, measuring only the throughput since updates of a batch are not timed on their own.
+    Otherwise updates are handled at their original timing divided by speed (2 is twice as fast),
+    each as its own task so they overlap like in production: create the MainHandler with
+    per_user_ordering=True to keep updates of a user in order
+  :param batch_size:
+  :return:
+  """
+  stats = ReplayStats()
+  start = time.perf_counter()
+  if speed is None:
+    batch = []
+    for r in log:
+      batch.append((r.uid, r.text, r.to_view()))
+      if len(batch) == batch_size:
+        await _replay_batch(main_handler, batch, stats)
+        batch = []
+    if len(batch) > 0:
+      await _replay_batch(main_handler, batch, stats)
+  else:
+    tasks = []
+    first = None
+    for r in log:
+      if first is None:
+        first = r.arrival
+      delay = (r.arrival - first) / speed - (time.perf_counter() - start)
+      if delay > 0:
+        await asyncio.sleep(delay)
+      tasks.append(asyncio.create_task(_replay_one(main_handler, r.uid, r.text, r.to_view(), stats)))
+    await asyncio.gather(*tasks)
+  stats.elapsed = time.perf_counter() - start
+  return stats
+
+
+async def _replay_batch(main_handler: MainHandler, batch: list, stats: ReplayStats):
+  results = await main_handler.handle_many(batch)
+  stats.updates += len(batch)
+  stats.failed += sum(1 for r in results if isinstance(r, Exception))
+
+
+async def _replay_one(main_handler: MainHandler, uid: int, text: str, update, stats: ReplayStats):
+  t = time.perf_counter()
+  try:
+    await main_handler.handle(uid, text, update)
+  except Exception:
+    stats.failed += 1
+  stats.latencies.append(time.perf_counter() - t)
+  stats.updates += 1
+
+
+def _new_store(spec: str):
+  if spec == 'memory':
+    from botanix.memory_store import MemoryContextStore
+    return MemoryContextStore()
+  if spec.startswith('sqlite:'):
+    from botanix.sqlite_store import SqliteContextStore
+    return SqliteContextStore(spec[len('sqlite:'):])
+  raise ValueError(f'Unknown store {spec}, expected memory or sqlite:<path>')
+
+
+def main(argv: list = None) -> int:
+  parser = argparse.ArgumentParser(description='Replays an update log through a MainHandler')
+  parser.add_argument('log', help='update log written by RecordingMainHandler')
+  parser.add_argument('factory', help='module:function receiving (store, bot) and returning the MainHandler')
+  parser.add_argument('--store', default='memory', help='memory or sqlite:<path>')
+  parser.add_argument('--speed', type=float, help='replay at the original timing divided by speed')
+  parser.add_argument('--bot-latency', type=float, default=0.0, help='seconds each fake Bot API call takes')
+  args = parser.parse_args(argv)
+
+  module_name, _, function_name = args.factory.partition(':')
+  factory = getattr(importlib.import_module(module_name), function_name)
+  main_handler = factory(_new_store(args.store), FakeBot(args.bot_latency))
+  with UpdateLog(args.log) as log:
+    stats = asyncio.run(replay(log, main_handler, args.speed))
+  result = {'updates': stats.updates, 'failed': stats.failed, 'elapsed': stats.elapsed,
+            'updates_per_sec': stats.updates_per_sec}
+  if len(stats.latencies) > 0:
+    result['p50_latency_us'] = stats.percentile(0.5) * 1e6
+    result['p99_latency_us'] = stats.percentile(0.99) * 1e6
+  print(json.dumps(result))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
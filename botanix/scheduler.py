@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import math
+import time
+from botanix.handling import FollowUp, MainHandler
+
+logger = logging.getLogger(__name__)
+
+
+class _Timer:
+  __slots__ = ('key', 'when', 'tick', 'slot')
+
+  def __init__(self, key, when: float, tick: int):
+    self.key = key
+    self.when = when
+    self.tick = tick
+    self.slot = None  # the dictionary of the wheel slot holding the timer
+
+
+class TimingWheel:
+  """
+  Hierarchical timing wheel holding one timer per key. Level 0 has `size` slots of one tick each,
+  a slot of level n spans size**n ticks. A timer is put in the lowest level whose range covers it
+  and moves down a level each time the level above turns to its slot, so `schedule` and `cancel`
+  are O(1) and each timer is moved at most `levels` times before it is due.
+
+  Timers further away than size**levels ticks wait in an overflow which is looked at once per turn
+  of the top level. Time is only advanced by `advance`, so the wheel can be driven by any clock.
+  """
+
+  def __init__(self, tick: float = 1.0, size: int = 64, levels: int = 6, now: float = 0.0):
+    """
+    :param tick: seconds of a slot of level 0, the precision of the timers
+    :param size: slots per level, a power of 2
+    :param levels: number of levels
+    :param now: current time, timers due before it are due on the next advance
+    """
+    if size & (size - 1) != 0:
+      raise ValueError(f'Size must be a power of 2 but was {size}')
+    self.tick = tick
+    self.size = size
+    self.levels = levels
+    self._bits = size.bit_length() - 1
+    self._mask = size - 1
+    self._wheels = [[{} for _ in range(size)] for _ in range(levels)]
+    self._due = {}
+    self._overflow = {}
+    self._timers = {}
+    self._now = math.floor(now / tick)
+
+  def __len__(self):
+    return len(self._timers)
+
+  def __contains__(self, key):
+    return key in self._timers
+
+  def when(self, key):
+    """
+    :return: the time the timer of the key is due at, None if it has none
+    """
+    timer = self._timers.get(key)
+    return None if timer is None else timer.when
+
+  def schedule(self, key, when: float):
+    """
+    Sets the timer of the key, replacing the one it had
+    :param key:
+    :param when: time it is due at, in the unit of the clock driving the wheel
+    :return:
+    """
+    timer = self._timers.get(key)
+    if timer is not None:
+      if timer.when == when:
+        return
+      del timer.slot[key]
+    timer = self._timers[key] = _Timer(key, when, math.ceil(when / self.tick))
+    self._place(timer)
+
+  def cancel(self, key) -> bool:
+    """
+    :return: False if the key had no timer
+    """
+    timer = self._timers.pop(key, None)
+    if timer is None:
+      return False
+    del timer.slot[key]
+    return True
+
+  def _place(self, timer: _Timer, cascading: bool = False):
+    delta = timer.tick - self._now
+    # the slot of the current tick was already taken, unless the timer moves down while advancing
+    if delta < 0 or (delta == 0 and not cascading):
+      slot = self._due
+    else:
+      slot = None
+      for level in range(self.levels):
+        if delta < 1 << (self._bits * (level + 1)):
+          slot = self._wheels[level][(timer.tick >> (self._bits * level)) & self._mask]
+          break
+      if slot is None:
+        slot = self._overflow
+    slot[timer.key] = timer
+    timer.slot = slot
+
+  def advance(self, now: float) -> list:
+    """
+    Moves the wheel to `now` and removes the timers due by then
+    :param now:
+    :return: list of (key, when) of the due timers, in no particular order
+    """
+    target = math.floor(now / self.tick)
+    expired = self._take(self._due)
+    if len(self._timers) == 0:
+      self._now = max(self._now, target)
+      return expired
+    while self._now < target:
+      self._now += 1
+      index = self._now & self._mask
+      if index == 0:
+        self._cascade()
+      expired += self._take(self._wheels[0][index])
+    return expired
+
+  def _cascade(self):
+    for level in range(1, self.levels):
+      index = (self._now >> (self._bits * level)) & self._mask
+      self._move_down(self._wheels[level][index])
+      if index != 0:
+        return
+    self._move_down(self._overflow)
+
+  def _move_down(self, slot: dict):
+    if len(slot) == 0:
+      return
+    timers = list(slot.values())
+    slot.clear()
+    for timer in timers:
+      self._place(timer, True)
+
+  def _take(self, slot: dict) -> list:
+    if len(slot) == 0:
+      return []
+    expired = []
+    for key, timer in slot.items():
+      del self._timers[key]
+      expired.append((key, timer.when))
+    slot.clear()
+    return expired
+
+
+class Scheduler:
+  """
+  Dispatches the follow-ups handlers ask for with HandlingResult.follow_up_result. Pending follow-ups
+  are kept in a TimingWheel keyed by uid, MainHandler sets and cancels them as it stores contexts.
+  A due follow-up is handled by MainHandler as an update with MainHandler.follow_up_command as its
+  text and a FollowUp as its update, which goes to the step the user is at. MainHandler ignores it if
+  the context does not have that follow-up pending any more.
+
+  The time of a pending follow-up is also stored in the context, so `start` recovers them from the
+  store after a restart (with stores implementing get_follow_ups). Follow-ups due while the process
+  was down are dispatched right away.
+  """
+
+  def __init__(self, tick: float = 1.0, wheel_size: int = 64, levels: int = 6, max_concurrency: int = 100,
+               clock=time.time):
+    """
+    :param tick: seconds between two looks at the wheel, the precision of follow-ups
+    :param wheel_size: slots per level of the wheel
+    :param levels: levels of the wheel
+    :param max_concurrency: maximum number of follow-ups handled at once
+    :param clock: source of epoch time in seconds
+    """
+    self.tick = tick
+    self.clock = clock
+    self.max_concurrency = max_concurrency
+    self.wheel = TimingWheel(tick, wheel_size, levels, clock())
+    self.main_handler = None
+    self.fired = 0
+    self.failed = 0
+    self._task = None
+
+  def attach(self, main_handler: MainHandler):
+    """
+    Called by MainHandler when the scheduler is passed to it
+    """
+    self.main_handler = main_handler
+
+  @property
+  def pending(self) -> int:
+    return len(self.wheel)
+
+  def set(self, uid: int, when: float):
+    """
+    Sets the follow-up of a user, or cancels it if `when` is None
+    """
+    if when is None:
+      self.wheel.cancel(uid)
+    else:
+      self.wheel.schedule(uid, when)
+
+  async def recover(self) -> int:
+    """
+    Sets the follow-ups pending in the store of the MainHandler
+    :return: number of follow-ups recovered
+    """
+    store = self.main_handler.store
+    if self.main_handler.is_async_store:
+      follow_ups = await store.get_follow_ups()
+    else:
+      follow_ups = store.get_follow_ups()
+    for uid, when in follow_ups:
+      self.wheel.schedule(uid, when)
+    return len(follow_ups)
+
+  async def fire_due(self) -> int:
+    """
+    Handles the follow-ups due by now
+    :return: number of follow-ups handled
+    """
+    due = self.wheel.advance(self.clock())
+    if len(due) == 0:
+      return 0
+    semaphore = asyncio.Semaphore(self.max_concurrency)
+    await asyncio.gather(*[self._fire(uid, when, semaphore) for uid, when in due])
+    return len(due)
+
+  async def _fire(self, uid: int, when: float, semaphore: asyncio.Semaphore):
+    async with semaphore:
+      try:
+        await self.main_handler.handle(uid, MainHandler.follow_up_command, FollowUp(uid, when))
+        self.fired += 1
+      except Exception:
+        self.failed += 1
+        logger.exception('Follow-up of user %s failed', uid)
+
+  async def start(self, recover: bool = True):
+    """
+    Recovers pending follow-ups from the store, then looks for due ones every tick
+    :param recover: if False, follow-ups stored before are not recovered
+    :return:
+    """
+    if self.main_handler is None:
+      raise RuntimeError('Scheduler must be passed to a MainHandler before it is started')
+    if recover:
+      await self.recover()
+    self._task = asyncio.create_task(self._run())
+
+  async def _run(self):
+    while True:
+      await asyncio.sleep(self.tick)
+      try:
+        await self.fire_due()
+      except Exception:
+        logger.exception('Scheduler failed to fire follow-ups')
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+      self._task = None
@@ -0,0 +1,326 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+from botanix.handling import HandlingResult
+from botanix.updates import UpdateView
+
+logger = logging.getLogger(__name__)
+
+# messages on the pipes start with one of these bytes
+_UPDATE = b'U'  # front -> worker, followed by the update JSON
+_METRICS = b'M'  # front -> worker request, worker -> front answer followed by JSON
+_STOP = b'S'  # front -> worker
+_ACK = b'A'  # worker -> front, followed by the number of updates done
+_count = struct.Struct('<I')
+# framing of multiprocessing connections, which workers read and write with recv_bytes/send_bytes
+_frame = struct.Struct('!i')
+
+
+class _Worker:
+  __slots__ = ('shard', 'process', 'conn', 'in_flight', 'sent', 'done', 'restarts', 'lost', 'room',
+               'metrics_waiter', 'stopping', 'outgoing', 'incoming')
+
+  def __init__(self, shard: int):
+    self.shard = shard
+    self.process = None
+    self.conn = None
+    self.in_flight = 0
+    self.sent = 0
+    self.done = 0
+    self.restarts = 0
+    self.lost = 0
+    self.room = asyncio.Event()
+    self.room.set()
+    self.metrics_waiter = None
+    self.stopping = False
+    self.outgoing = bytearray()  # frames waiting for room in the pipe
+    self.incoming = bytearray()  # bytes read and not yet a whole frame
+
+
+class ShardedRunner:
+  """
+  Runs K worker processes, each with its own MainHandler built by `factory(shard)`, so that handling
+  uses K cores. Updates are routed to the worker of `uid % K`, hence updates of a user always go to
+  the same worker and stay in order without locking across processes. Each worker reads the updates
+  waiting on its pipe as one batch and handles it with `handle_many`.
+
+  Updates travel as raw JSON bytes over one pipe per worker, no pickling involved. The front process
+  never blocks on a pipe: it writes and reads without blocking from its event loop, and buffers what a
+  busy worker cannot take yet, up to max_in_flight updates. A worker which dies is restarted; the
+  updates it had not acknowledged are lost and counted in `lost`.
+
+  `handle` and `handle_many` make the runner usable in place of a MainHandler, e.g. by WebhookServer
+  or PollingRunner: their results only mean the update was passed to its worker, what the worker
+  did with it shows in `metrics`.
+  """
+
+  def __init__(self, factory, workers: int = None, max_in_flight: int = 1000, max_batch: int = 100,
+               start_method: str = None):
+    """
+    :param factory: callable receiving the shard number and returning the MainHandler of that worker.
+      It is called in the worker process so it must be picklable, e.g. a module level function
+    :param workers: number of worker processes, the number of CPUs by default
+    :param max_in_flight: updates sent to a worker and not yet handled before `submit` waits
+    :param max_batch: maximum number of updates a worker handles at once
+    :param start_method: multiprocessing start method, the platform's default if None
+    """
+    self.factory = factory
+    self.workers = workers or os.cpu_count() or 1
+    self.max_in_flight = max_in_flight
+    self.max_batch = max_batch
+    self.mp = multiprocessing.get_context(start_method)
+    self._workers = []
+    self._loop = None
+
+  def shard_of(self, uid: int) -> int:
+    return uid % self.workers
+
+  async def start(self):
+    self._loop = asyncio.get_running_loop()
+    self._workers = [_Worker(i) for i in range(self.workers)]
+    for w in self._workers:
+      self._spawn(w)
+
+  def _spawn(self, w: _Worker):
+    front, back = self.mp.Pipe(duplex=True)
+    w.process = self.mp.Process(target=_worker_main, args=(w.shard, self.factory, back, self.max_batch),
+                                name=f'botanix-shard-{w.shard}', daemon=True)
+    w.process.start()
+    back.close()
+    os.set_blocking(front.fileno(), False)
+    w.conn = front
+    w.in_flight = 0
+    w.outgoing.clear()
+    w.incoming.clear()
+    w.room.set()
+    self._loop.add_reader(front.fileno(), self._on_readable, w)
+
+  def _write(self, w: _Worker, msg: bytes):
+    """
+    Sends a message to the worker, or queues it until the pipe has room
+    """
+    if w.conn.closed:
+      return  # the worker exited, it is being restarted or stopped
+    frame = _frame.pack(len(msg)) + msg
+    if len(w.outgoing) == 0:
+      try:
+        n = os.write(w.conn.fileno(), frame)
+      except BlockingIOError:
+        n = 0
+      except OSError:
+        return  # the reader sees the worker exit
+      if n == len(frame):
+        return
+      frame = frame[n:]
+      self._loop.add_writer(w.conn.fileno(), self._on_writable, w)
+    w.outgoing += frame
+
+  def _on_writable(self, w: _Worker):
+    try:
+      n = os.write(w.conn.fileno(), w.outgoing)
+    except BlockingIOError:
+      return
+    except OSError:
+      n = len(w.outgoing)  # the reader sees the worker exit
+    del w.outgoing[:n]
+    if len(w.outgoing) == 0:
+      self._loop.remove_writer(w.conn.fileno())
+
+  def _on_readable(self, w: _Worker):
+    try:
+      data = os.read(w.conn.fileno(), 1 << 16)
+    except BlockingIOError:
+      return
+    except OSError:
+      data = b''
+    w.incoming += data
+    while len(w.incoming) >= _frame.size:
+      size = _frame.unpack_from(w.incoming)[0]
+      if len(w.incoming) < _frame.size + size:
+        break
+      msg = bytes(w.incoming[_frame.size:_frame.size + size])
+      del w.incoming[:_frame.size + size]
+      self._on_message(w, msg)
+    if len(data) == 0:
+      self._on_exit(w)
+
+  def _on_message(self, w: _Worker, msg: bytes):
+    kind = msg[:1]
+    if kind == _ACK:
+      n = _count.unpack_from(msg, 1)[0]
+      w.in_flight -= n
+      w.done += n
+      if w.in_flight < self.max_in_flight:
+        w.room.set()
+    elif kind == _METRICS and w.metrics_waiter is not None and not w.metrics_waiter.done():
+      w.metrics_waiter.set_result(json.loads(msg[1:]))
+
+  def _close(self, w: _Worker):
+    self._loop.remove_reader(w.conn.fileno())
+    self._loop.remove_writer(w.conn.fileno())
+    w.conn.close()
+
+  def _on_exit(self, w: _Worker):
+    self._close(w)
+    w.process.join(1)
+    if w.metrics_waiter is not None and not w.metrics_waiter.done():
+      w.metrics_waiter.set_result(None)
+    if w.stopping:
+      return
+    w.lost += w.in_flight
+    w.restarts += 1
+    logger.error('Worker of shard %s exited with %s, restarting it. %s updates lost',
+                 w.shard, w.process.exitcode, w.in_flight)
+    self._spawn(w)
+
+  async def submit(self, body) -> bool:
+    """
+    Sends an update to the worker of its user. Waits while that worker has max_in_flight updates
+    :param body: JSON of the update as bytes/str, or an UpdateView
+    :return: False if the update has no user or chat and was dropped
+    """
+    view = body if isinstance(body, UpdateView) else UpdateView.from_body(body)
+    if view.uid is None:
+      return False
+    if isinstance(body, UpdateView):
+      raw = body.to_json().encode('utf-8')
+    elif isinstance(body, str):
+      raw = body.encode('utf-8')
+    else:
+      raw = bytes(body)
+    await self._send(self._workers[self.shard_of(view.uid)], raw)
+    return True
+
+  async def _send(self, w: _Worker, raw: bytes):
+    while w.in_flight >= self.max_in_flight:
+      w.room.clear()
+      await w.room.wait()
+    w.in_flight += 1
+    w.sent += 1
+    self._write(w, _UPDATE + raw)
+
+  async def handle(self, uid: int, message_text: str, update) -> HandlingResult:
+    """
+    Passes the update to its worker, in place of MainHandler.handle
+    :param update: an UpdateView, or anything with a to_json method
+    :return: success once the update is sent
+    """
+    await self._send(self._workers[self.shard_of(uid)], update.to_json().encode('utf-8'))
+    return HandlingResult.success_result()
+
+  async def handle_many(self, updates) -> list:
+    results = []
+    for uid, message_text, update in updates:
+      results.append(await self.handle(uid, message_text, update))
+    return results
+
+  async def metrics(self) -> list:
+    """
+    :return: per worker, a dictionary of its counters. Those of a worker which did not answer
+      within a second only have the counters kept by the front process
+    """
+    waiters = []
+    for w in self._workers:
+      w.metrics_waiter = self._loop.create_future()
+      self._write(w, _METRICS)
+      waiters.append(w.metrics_waiter)
+    done, _ = await asyncio.wait(waiters, timeout=1)
+    results = []
+    for w, waiter in zip(self._workers, waiters):
+      m = waiter.result() if waiter in done else None
+      m = dict(m or {})
+      m.update({'shard': w.shard, 'sent': w.sent, 'done': w.done, 'in_flight': w.in_flight,
+                'restarts': w.restarts, 'lost': w.lost})
+      results.append(m)
+    return results
+
+  async def stop(self, drain: bool = True, timeout: float = 30):
+    """
+    Stops the workers
+    :param drain: if True, workers handle the updates already sent to them before exiting
+    :param timeout: seconds to wait for workers to exit before killing them
+    :return:
+    """
+    for w in self._workers:
+      w.stopping = True
+      if drain:
+        self._write(w, _STOP)
+      else:
+        w.process.terminate()
+    await asyncio.gather(*[self._loop.run_in_executor(None, w.process.join, timeout) for w in self._workers])
+    for w in self._workers:
+      if w.process.is_alive():
+        logger.warning('Worker of shard %s did not stop in time, killing it', w.shard)
+        w.process.kill()
+        w.process.join()
+      if not w.conn.closed:
+        self._close(w)
+
+
+def _worker_main(shard: int, factory, conn, max_batch: int):
+  asyncio.run(_worker_loop(factory(shard), conn, max_batch))
+
+
+async def _worker_loop(main_handler, conn, max_batch: int):
+  loop = asyncio.get_running_loop()
+  stats = {'pid': os.getpid(), 'handled': 0, 'failed': 0, 'ignored': 0, 'batches': 0}
+  stopping = False
+  while not stopping:
+    try:
+      messages = [await loop.run_in_executor(None, conn.recv_bytes)]
+    except EOFError:
+      break  # the front process is gone
+    while len(messages) < max_batch and conn.poll():
+      messages.append(conn.recv_bytes())
+    items = []
+    for msg in messages:
+      kind = msg[:1]
+      if kind == _UPDATE:
+        items.append(msg[1:])
+      elif kind == _METRICS:
+        conn.send_bytes(_METRICS + _worker_metrics(main_handler, stats).encode('utf-8'))
+      elif kind == _STOP:
+        stopping = True
+    if len(items) > 0:
+      await _handle_batch(main_handler, items, stats)
+      conn.send_bytes(_ACK + _count.pack(len(items)))
+  outbox = getattr(main_handler, 'outbox', None)
+  if outbox is not None:
+    await outbox.stop()
+  close = getattr(main_handler.store, 'close', None)
+  if close is not None:
+    close()
+  conn.close()
+
+
+async def _handle_batch(main_handler, items: list, stats: dict):
+  batch = []
+  for raw in items:
+    try:
+      view = UpdateView.from_body(raw)
+    except Exception:
+      stats['failed'] += 1
+      logger.exception('Could not parse update')
+      continue
+    if view.uid is None:
+      stats['ignored'] += 1
+    else:
+      batch.append((view.uid, view.text, view))
+  stats['batches'] += 1
+  for r in await main_handler.handle_many(batch):
+    if isinstance(r, Exception):
+      stats['failed'] += 1
+      logger.error('Failed to handle update', exc_info=r)
+    else:
+      stats['handled'] += 1
+
+
+def _worker_metrics(main_handler, stats: dict) -> str:
+  m = dict(stats)
+  to_prometheus = getattr(main_handler.instrumentation, 'to_prometheus', None)
+  if to_prometheus is not None:
+    m['prometheus'] = to_prometheus()
+  return json.dumps(m)
@@ -0,0 +1,330 @@
+import queue
+import sqlite3
+import threading
+import time
+from functools import partial
+from botanix.context_codecs import BaseContextCodec, BinaryContextCodec
+from botanix.handling import BaseContextStore, HandlingContext, VersionConflict
+
+_CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS contexts (uid INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, ' \
+                'data BLOB NOT NULL, version INTEGER NOT NULL DEFAULT 0, follow_up_at INTEGER)'
+# columns added after the first release, created on tables which do not have them yet
+_ADD_COLUMNS = (('version', 'ALTER TABLE contexts ADD COLUMN version INTEGER NOT NULL DEFAULT 0'),
+                ('follow_up_at', 'ALTER TABLE contexts ADD COLUMN follow_up_at INTEGER'))
+_CREATE_INDEX = 'CREATE INDEX IF NOT EXISTS contexts_timestamp ON contexts (timestamp)'
+_CREATE_FOLLOW_UP_INDEX = 'CREATE INDEX IF NOT EXISTS contexts_follow_up ON contexts (follow_up_at) ' \
+                          'WHERE follow_up_at IS NOT NULL'
+_SELECT = 'SELECT data, version FROM contexts WHERE uid = ? AND timestamp > ?'
+_SELECT_FOLLOW_UPS = 'SELECT uid, follow_up_at FROM contexts WHERE follow_up_at IS NOT NULL AND timestamp > ?'
+_UPSERT = 'INSERT OR REPLACE INTO contexts (uid, timestamp, data, version, follow_up_at) VALUES (?, ?, ?, ?, ?)'
+# writes only if the stored version is the expected one, or if none is expected and the stored one has expired
+_CONDITIONAL_UPSERT = 'INSERT INTO contexts (uid, timestamp, data, version, follow_up_at) VALUES (?, ?, ?, ?, ?) ' \
+                      'ON CONFLICT (uid) DO UPDATE SET timestamp = excluded.timestamp, data = excluded.data, ' \
+                      'version = excluded.version, follow_up_at = excluded.follow_up_at ' \
+                      'WHERE contexts.version = ? OR (? = 0 AND contexts.timestamp <= ?)'
+_DELETE = 'DELETE FROM contexts WHERE uid = ?'
+# like in the other stores, a missing or expired context is at version 0
+_CONDITIONAL_DELETE = 'DELETE FROM contexts WHERE uid = ? AND version = ? AND timestamp > ?'
+# expects version 0: changes a row if there is none yet or if it is at version 0 or expired, then it is deleted
+_CONDITIONAL_DELETE_NONE = "INSERT INTO contexts (uid, timestamp, data) VALUES (?, 0, x'') " \
+                           'ON CONFLICT (uid) DO UPDATE SET timestamp = 0 ' \
+                           'WHERE contexts.version = 0 OR contexts.timestamp <= ?'
+_DELETE_EXPIRED = 'DELETE FROM contexts WHERE timestamp <= ?'
+# custom values kept apart from the contexts, one row per key (split_custom)
+_CREATE_CUSTOM_TABLE = 'CREATE TABLE IF NOT EXISTS context_custom (uid INTEGER NOT NULL, key NOT NULL, ' \
+                       'value BLOB NOT NULL, PRIMARY KEY (uid, key)) WITHOUT ROWID'
+_SELECT_CUSTOM = 'SELECT key, value FROM context_custom WHERE uid = ?'
+_UPSERT_CUSTOM = 'INSERT OR REPLACE INTO context_custom (uid, key, value) VALUES (?, ?, ?)'
+_DELETE_CUSTOM = 'DELETE FROM context_custom WHERE uid = ?'
+_DELETE_CUSTOM_KEY = 'DELETE FROM context_custom WHERE uid = ? AND key = ?'
+_DELETE_EXPIRED_CUSTOM = 'DELETE FROM context_custom WHERE uid IN (SELECT uid FROM contexts WHERE timestamp <= ?)'
+_MAX_VARIABLES = 500  # stays below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+
+
+class _Write:
+  __slots__ = ('statements', 'conditional', 'done', 'error')
+
+  def __init__(self, statements: list, conditional: bool = False):
+    self.statements = statements  # list of (sql, rows)
+    # every row of the first statement must change a row of the table, otherwise the others are skipped
+    self.conditional = conditional
+    self.done = threading.Event()
+    self.error = None
+
+
+class SqliteContextStore(BaseContextStore):
+  """
+  Durable context store on a local SQLite database in WAL mode.
+
+  Reads use a long-lived connection. Writes are handed to a single writer thread which groups all the
+  writes arriving within `commit_interval` seconds (up to `max_batch`) into one transaction: each
+  put_context/clear_context blocks until the transaction holding it is committed, but many callers
+  share the cost of one commit. Calls must therefore come from several threads to be grouped, e.g.
+  by wrapping the store in a ThreadPoolContextStore. SQL statements are constant so they are
+  compiled once and reused from the statement cache of each connection.
+
+  Contexts whose timestamp is older than `ttl` seconds are treated as expired and can be removed in
+  bulk with `purge_expired`, which uses the index on the timestamp.
+
+  The time of a pending follow-up is kept in its own indexed column so that `get_follow_ups` does
+  not read every context.
+
+  Each row has a version, which makes conditional writes (compare-and-swap) possible. A conditional
+  write which loses does not fail the other writes committed with it.
+
+  With `split_custom`, custom values are not part of the encoded context but stored one row per key
+  in a separate table. Reading a context then only reads its track, step and timestamp, its custom
+  values are read when first used, and writing it only writes the keys changed by put_custom. This
+  suits tracks collecting many or large custom values over their steps. It changes what is stored so
+  a database must always be opened with the same setting.
+  """
+  supports_compare_and_swap = True
+
+  def __init__(self, path: str, codec: BaseContextCodec = None, ttl: float = None,
+               commit_interval: float = 0.002, max_batch: int = 1000, clock=time.time, split_custom: bool = False):
+    """
+    :param path: database file
+    :param codec: codec of the stored contexts, BinaryContextCodec by default
+    :param ttl: seconds after which a context not written is expired, None to never expire
+    :param commit_interval: seconds the writer waits to group more writes into a transaction
+    :param max_batch: maximum number of writes in a transaction
+    :param clock: source of epoch time in seconds
+    :param split_custom: if True, custom values are stored apart and read lazily, see above
+    """
+    self.codec = codec or BinaryContextCodec()
+    self.ttl = ttl
+    self.commit_interval = commit_interval
+    self.max_batch = max_batch
+    self.clock = clock
+    self.split_custom = split_custom
+    self.commits = 0
+    self._write_conn = self._connect(path)
+    self._write_conn.execute('PRAGMA journal_mode=WAL')
+    self._write_conn.execute(_CREATE_TABLE)
+    columns = [c[1] for c in self._write_conn.execute('PRAGMA table_info(contexts)')]
+    for column, sql in _ADD_COLUMNS:
+      if column not in columns:
+        self._write_conn.execute(sql)  # table created by an earlier release
+    self._write_conn.execute(_CREATE_INDEX)
+    self._write_conn.execute(_CREATE_FOLLOW_UP_INDEX)
+    if split_custom:
+      self._write_conn.execute(_CREATE_CUSTOM_TABLE)
+    self._read_conn = self._connect(path)
+    self._read_lock = threading.Lock()
+    self._queue = queue.Queue()
+    self._writer = threading.Thread(target=self._write_loop, name='botanix-sqlite-writer', daemon=True)
+    self._writer.start()
+
+  @staticmethod
+  def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=32)
+    conn.execute('PRAGMA synchronous=NORMAL')  # durable in WAL mode apart from power loss
+    return conn
+
+  def _min_timestamp(self) -> int:
+    return -2 ** 63 if self.ttl is None else int(self.clock() - self.ttl)
+
+  def get_active_context(self, uid: int) -> HandlingContext:
+    with self._read_lock:
+      row = self._read_conn.execute(_SELECT, (uid, self._min_timestamp())).fetchone()
+    return None if row is None else self._decode(row)
+
+  def _decode(self, row: tuple) -> HandlingContext:
+    ctx = self.codec.decode(row[0])
+    ctx.version = row[1]
+    if self.split_custom:
+      ctx.defer_custom(partial(self._load_custom, ctx.uid))
+    return ctx
+
+  def _load_custom(self, uid: int) -> dict:
+    with self._read_lock:
+      rows = self._read_conn.execute(_SELECT_CUSTOM, (uid,)).fetchall()
+    return {key: self.codec.decode_value(value) for key, value in rows}
+
+  def _encode(self, context: HandlingContext) -> bytes:
+    if not self.split_custom:
+      return self.codec.encode(context)
+    header = HandlingContext.from_fields(context.uid, context.track_name, context.step, context.timestamp, {},
+                                         context.last_update_id, context.version, context.follow_up_at)
+    return self.codec.encode(header)
+
+  def _custom_statements(self, contexts: list) -> list:
+    """
+    Statements writing the custom values of the contexts: only the changed keys of contexts whose
+    custom values were stored as a whole before, all of them otherwise
+    """
+    replaced = []
+    upserts = []
+    deletes = []
+    for ctx in contexts:
+      keys = ctx.changed_keys
+      if keys is None:
+        replaced.append((ctx.uid,))
+        keys = ctx.custom.keys()
+      elif len(keys) == 0:
+        continue
+      custom = ctx.custom
+      for key in keys:
+        if key in custom:
+          upserts.append((ctx.uid, key, self.codec.encode_value(custom[key])))
+        else:
+          deletes.append((ctx.uid, key))
+    return [(sql, rows) for sql, rows in ((_DELETE_CUSTOM, replaced), (_DELETE_CUSTOM_KEY, deletes),
+                                          (_UPSERT_CUSTOM, upserts)) if len(rows) > 0]
+
+  def get_many(self, uids: list) -> dict:
+    contexts = {}
+    min_timestamp = self._min_timestamp()
+    for i in range(0, len(uids), _MAX_VARIABLES):
+      chunk = uids[i:i + _MAX_VARIABLES]
+      sql = f'SELECT data, version FROM contexts WHERE uid IN ({",".join("?" * len(chunk))}) AND timestamp > ?'
+      with self._read_lock:
+        rows = self._read_conn.execute(sql, (*chunk, min_timestamp)).fetchall()
+      for row in rows:
+        ctx = self._decode(row)
+        contexts[ctx.uid] = ctx
+    return contexts
+
+  def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    ctx = HandlingContext(uid, track_nam)
+    self.put_context(ctx)
+    return ctx
+
+  def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
+    if expected_version is None:
+      self.put_many([context])
+      return
+    previous = context.version
+    context.version = expected_version + 1
+    try:
+      statements = [(_CONDITIONAL_UPSERT, [(context.uid, int(context.timestamp), self._encode(context),
+                                            context.version, context.follow_up_at, expected_version,
+                                            expected_version, self._min_timestamp())])]
+      if self.split_custom:
+        statements += self._custom_statements([context])
+      self._write(statements, conditional=True)
+    except Exception:
+      context.version = previous
+      raise
+
+  def put_many(self, contexts: list) -> None:
+    previous = [ctx.version for ctx in contexts]
+    for ctx in contexts:
+      ctx.version += 1
+    try:
+      statements = [(_UPSERT, [(ctx.uid, int(ctx.timestamp), self._encode(ctx), ctx.version, ctx.follow_up_at)
+                               for ctx in contexts])]
+      if self.split_custom:
+        statements += self._custom_statements(contexts)
+      self._write(statements)
+    except Exception:
+      for ctx, version in zip(contexts, previous):
+        ctx.version = version
+      raise
+
+  def clear_context(self, uid: int, expected_version: int = None):
+    if expected_version is None:
+      self.clear_many([uid])
+    else:
+      if expected_version == 0:
+        statements = [(_CONDITIONAL_DELETE_NONE, [(uid, self._min_timestamp())]), (_DELETE, [(uid,)])]
+      else:
+        statements = [(_CONDITIONAL_DELETE, [(uid, expected_version, self._min_timestamp())])]
+      if self.split_custom:
+        statements.append((_DELETE_CUSTOM, [(uid,)]))
+      self._write(statements, conditional=True)
+
+  def clear_many(self, uids: list):
+    rows = [(uid,) for uid in uids]
+    self._write([(_DELETE, rows), (_DELETE_CUSTOM, rows)] if self.split_custom else [(_DELETE, rows)])
+
+  def get_follow_ups(self) -> list:
+    with self._read_lock:
+      return self._read_conn.execute(_SELECT_FOLLOW_UPS, (self._min_timestamp(),)).fetchall()
+
+  def purge_expired(self) -> None:
+    """
+    Deletes all expired contexts
+    :return:
+    """
+    if self.ttl is not None:
+      rows = [(self._min_timestamp(),)]
+      self._write([(_DELETE_EXPIRED_CUSTOM, rows), (_DELETE_EXPIRED, rows)] if self.split_custom
+                  else [(_DELETE_EXPIRED, rows)])
+
+  def _write(self, statements: list, conditional: bool = False):
+    if len(statements[0][1]) == 0:
+      return
+    w = _Write(statements, conditional)
+    self._queue.put(w)
+    w.done.wait()
+    if w.error is not None:
+      raise w.error
+
+  def _write_loop(self):
+    while True:
+      w = self._queue.get()
+      if w is None:
+        return
+      batch = [w]
+      stopping = False
+      deadline = time.monotonic() + self.commit_interval
+      while len(batch) < self.max_batch:
+        try:
+          w = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+          break
+        if w is None:
+          stopping = True
+          break
+        batch.append(w)
+      self._commit(batch)
+      if stopping:
+        return
+
+  def _commit(self, batch: list):
+    conn = self._write_conn
+    try:
+      conn.execute('BEGIN')
+      for w in batch:
+        self._execute(w)
+      conn.execute('COMMIT')
+      self.commits += 1
+    except Exception:
+      if conn.in_transaction:
+        conn.execute('ROLLBACK')
+      # retry one by one so that a bad write does not fail the others grouped with it
+      for w in batch:
+        w.error = None
+        try:
+          conn.execute('BEGIN')
+          self._execute(w)
+          conn.execute('COMMIT')
+          self.commits += 1
+        except Exception as ex:
+          if conn.in_transaction:
+            conn.execute('ROLLBACK')
+          w.error = ex
+    for w in batch:
+      w.done.set()
+
+  def _execute(self, w: _Write):
+    sql, rows = w.statements[0]
+    changed = self._write_conn.executemany(sql, rows).rowcount
+    if w.conditional and changed != len(rows):
+      # nothing was written so the transaction can still be committed with the other writes
+      w.error = VersionConflict(f'Context of user {rows[0][0]} is not at the expected version')
+      return
+    for sql, rows in w.statements[1:]:
+      self._write_conn.executemany(sql, rows)
+
+  def close(self):
+    """
+    Commits pending writes, stops the writer and closes the database
+    :return:
+    """
+    if self._writer.is_alive():
+      self._queue.put(None)
+      self._writer.join()
+    self._write_conn.close()
+    self._read_conn.close()
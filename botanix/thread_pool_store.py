@@ -0,0 +1,61 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from botanix.handling import AsyncBaseContextStore, BaseContextStore, HandlingContext
+
+
+class ThreadPoolContextStore(AsyncBaseContextStore):
+  """
+  Adapts a synchronous BaseContextStore to AsyncBaseContextStore by running each of its
+  operations on a bounded thread pool. The event loop stays free while the store waits on
+  network I/O so updates from different users can overlap their store round trips.
+  """
+
+  def __init__(self, store: BaseContextStore, max_workers: int = 8, executor: ThreadPoolExecutor = None):
+    """
+    :param store: the synchronous store to wrap. It must be safe to call from several threads
+    :param max_workers: upper bound of concurrent store operations
+    :param executor: optionally an existing executor to use instead of creating one
+    """
+    self.store = store
+    self.owns_executor = executor is None
+    self.executor = executor or ThreadPoolExecutor(max_workers=max_workers,
+                                                   thread_name_prefix='botanix-store')
+
+  async def _run(self, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+  async def get_active_context(self, uid: int) -> HandlingContext:
+    return await self._run(self.store.get_active_context, uid)
+
+  async def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    return await self._run(self.store.new_context, uid, track_nam)
+
+  @property
+  def supports_compare_and_swap(self) -> bool:
+    return self.store.supports_compare_and_swap
+
+  async def put_context(self, context: HandlingContext, *expected_version) -> None:
+    await self._run(self.store.put_context, context, *expected_version)
+
+  async def clear_context(self, uid: int, *expected_version):
+    await self._run(self.store.clear_context, uid, *expected_version)
+
+  async def get_many(self, uids: list) -> dict:
+    return await self._run(self.store.get_many, uids)
+
+  async def put_many(self, contexts: list) -> None:
+    await self._run(self.store.put_many, contexts)
+
+  async def clear_many(self, uids: list):
+    await self._run(self.store.clear_many, uids)
+
+  async def get_follow_ups(self) -> list:
+    return await self._run(self.store.get_follow_ups)
+
+  def close(self):
+    """
+    Shuts down the thread pool if it was created by this adapter
+    :return:
+    """
+    if self.owns_executor:
+      self.executor.shutdown(wait=True)
@@ -0,0 +1,86 @@
+import json
+
+try:
+  import orjson
+  _loads = orjson.loads
+except ImportError:
+  _loads = json.loads
+
+# update types whose payload is the effective message
+_MESSAGE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'business_message',
+                  'edited_business_message')
+
+
+class UpdateView:
+  """
+  Lightweight view of an update received from Telegram. The fields MainHandler needs are read
+  straight from the JSON and the telegram Update is only built when first needed: either through
+  `update` or by reading any attribute of Update on the view itself (e.g. `view.effective_user`), so
+  it can be passed to handlers in place of an Update.
+  JSON is parsed with orjson when it is installed.
+  """
+  __slots__ = ('data', 'update_id', 'uid', 'chat_id', 'text', 'date', '_update')
+
+  def __init__(self, data: dict):
+    """
+    :param data: update already parsed as a dictionary
+    """
+    self.data = data
+    self.update_id = data.get('update_id')
+    self._update = None
+    payload = None
+    message = None
+    for k, v in data.items():
+      if k != 'update_id' and isinstance(v, dict):
+        payload = v
+        message = v if k in _MESSAGE_TYPES else v.get('message')
+        break
+    user = None if payload is None else (payload.get('from') or payload.get('user'))
+    chat = None if payload is None else payload.get('chat')
+    if chat is None and message is not None:
+      chat = message.get('chat')
+    self.chat_id = None if chat is None else chat.get('id')
+    self.uid = self.chat_id if user is None else user.get('id')
+    self.text = None if message is None else message.get('text')
+    self.date = None if message is None else message.get('date')
+
+  @classmethod
+  def from_body(cls, body, loads=None) -> 'UpdateView':
+    """
+    :param body: JSON of the update as str/bytes or already parsed as a dictionary
+    :param loads: JSON parser, orjson if installed or json by default
+    :return:
+    """
+    if isinstance(body, (str, bytes, bytearray, memoryview)):
+      if isinstance(body, memoryview):
+        body = bytes(body)
+      body = (loads or _loads)(body)
+    return cls(body)
+
+  @property
+  def update(self):
+    """
+    The telegram Update, built on first access
+    """
+    if self._update is None:
+      from telegram import Update
+      self._update = Update.de_json(self.data, None)
+    return self._update
+
+  def to_json(self) -> str:
+    return json.dumps(self.data)
+
+  def __getattr__(self, name: str):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.update, name)
+
+
+def parse_update(body) -> tuple:
+  """
+  Extracts what MainHandler.handle needs from an update received from Telegram
+  :param body: JSON of the update as str/bytes or already parsed as a dictionary
+  :return: tuple of (uid, message text, UpdateView). uid is None if the update has no user or chat
+  """
+  view = UpdateView.from_body(body)
+  return view.uid, view.text, view
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from botanix.handling import MainHandler
+from botanix.updates import parse_update
+
+logger = logging.getLogger(__name__)
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookStats:
+  __slots__ = ('accepted', 'shed', 'handled', 'failed')
+
+  def __init__(self):
+    self.accepted = 0
+    self.shed = 0
+    self.handled = 0
+    self.failed = 0
+
+
+class WebhookServer:
+  """
+  Long-running asyncio HTTP server receiving Telegram webhook updates for one MainHandler.
+
+  A request is acknowledged as soon as its body is put on a bounded queue, and a pool of worker
+  tasks takes updates off the queue and handles them. When the queue is full the server either
+  sheds the update by answering 503, so that Telegram redelivers it later, or, with
+  `block_when_full`, holds the response until there is room, which slows Telegram down.
+
+  Updates of the same user may be picked up by different workers, so create the MainHandler with
+  `per_user_ordering=True` when running more than one worker.
+  """
+
+  def __init__(self, main_handler: MainHandler, path: str = '/', host: str = '0.0.0.0', port: int = 8443,
+               workers: int = 16, queue_size: int = 1000, secret_token: str = None,
+               block_when_full: bool = False, max_body_size: int = 1 << 20):
+    """
+    :param main_handler:
+    :param path: path of the webhook
+    :param host:
+    :param port: 0 to pick a free port, see `port` once started
+    :param workers: number of updates handled concurrently
+    :param queue_size: maximum number of updates waiting to be handled
+    :param secret_token: if set, requests must carry it in X-Telegram-Bot-Api-Secret-Token
+    :param block_when_full: if True, wait for room in the queue instead of answering 503
+    :param max_body_size: larger requests are rejected
+    """
+    self.main_handler = main_handler
+    self.path = path
+    self.host = host
+    self.port = port
+    self.workers = workers
+    self.secret_token = secret_token
+    self.block_when_full = block_when_full
+    self.max_body_size = max_body_size
+    self.stats = WebhookStats()
+    self.queue = asyncio.Queue(maxsize=queue_size)
+    self._server = None
+    self._worker_tasks = []
+    self._connections = set()  # tasks serving a connection
+    self._idle = set()  # those waiting for the next request of a kept-alive connection
+    self._closing = False
+
+  async def start(self):
+    self._closing = False
+    self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+    self._server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+    self.port = self._server.sockets[0].getsockname()[1]
+
+  async def serve_forever(self):
+    if self._server is None:
+      await self.start()
+    try:
+      await self._server.serve_forever()
+    finally:
+      await self.stop()
+
+  async def stop(self, drain: bool = True):
+    """
+    Stops accepting requests and stops the workers
+    :param drain: if True, updates already queued are handled first
+    :return:
+    """
+    if self._server is not None:
+      self._closing = True
+      self._server.close()
+      # kept-alive connections are closed, since Python 3.12 wait_closed waits for them. Requests
+      # being received are answered first
+      for t in self._idle:
+        t.cancel()
+      await asyncio.gather(*self._connections, return_exceptions=True)
+      await self._server.wait_closed()
+      self._server = None
+    if drain:
+      await self.queue.join()
+    for t in self._worker_tasks:
+      t.cancel()
+    await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+    self._worker_tasks = []
+
+  async def _work(self):
+    while True:
+      body = await self.queue.get()
+      try:
+        uid, message_text, update = parse_update(body)
+        if uid is None:
+          logger.warning('Ignoring update without user or chat')
+        else:
+          result = await self.main_handler.handle(uid, message_text, update)
+          if not result.handled:
+            logger.debug('Update of user %s not handled: %s', uid, result.unhandled_message)
+        self.stats.handled += 1
+      except Exception:
+        self.stats.failed += 1
+        logger.exception('Failed to handle update')
+      finally:
+        self.queue.task_done()
+
+  async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    task = asyncio.current_task()
+    self._connections.add(task)
+    try:
+      keep_alive = True
+      while keep_alive and not self._closing:
+        self._idle.add(task)
+        try:
+          request_line = await reader.readline()
+        finally:
+          self._idle.discard(task)
+        if len(request_line) == 0:
+          break
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b'\r\n', b'\n', b''):
+            break
+          name, _, value = line.decode('latin-1').partition(':')
+          headers[name.strip().lower()] = value.strip()
+        parts = request_line.decode('latin-1').split()
+        keep_alive = headers.get('connection', '').lower() != 'close' and not self._closing
+        length = int(headers.get('content-length', '0') or '0')
+        if length > self.max_body_size:
+          await self._respond(writer, 413, False)
+          break
+        body = await reader.readexactly(length) if length > 0 else b''
+        status = await self._accept(parts, headers, body)
+        await self._respond(writer, status, keep_alive)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+      pass
+    finally:
+      self._connections.discard(task)
+      writer.close()
+
+  async def _accept(self, parts: list, headers: dict, body: bytes) -> int:
+    if len(parts) < 2:
+      return 400
+    if parts[1].split('?')[0] != self.path:
+      return 404
+    if parts[0] != 'POST':
+      return 405
+    if self.secret_token is not None and headers.get('x-telegram-bot-api-secret-token') != self.secret_token:
+      return 403
+    if self.block_when_full:
+      await self.queue.put(body)
+    else:
+      try:
+        self.queue.put_nowait(body)
+      except asyncio.QueueFull:
+        self.stats.shed += 1
+        return 503
+    self.stats.accepted += 1
+    return 200
+
+  @staticmethod
+  async def _respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+    writer.write(f'HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Length: 0\r\n'
+                 f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
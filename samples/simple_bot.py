@@ -1,7 +1,9 @@
 import traceback
 
 from botanix.handling import *
-from telegram import Bot
+from botanix.context_codecs import BaseContextCodec, JsonContextCodec
+from botanix.updates import UpdateView
+from telegram import Bot, Update
 import re
 import boto3
 from botocore.exceptions import ClientError
@@ -106,8 +108,9 @@ def register_user(first_name:str, surname:str, email:str):
 # But considering its simplicity, it is suitable for a sample
 class S3ContextStore(BaseContextStore):
 
-  def __init__(self, bucket_name:str, prefix:str=None):
+  def __init__(self, bucket_name:str, prefix:str=None, codec:BaseContextCodec=None):
     self.prefix = prefix
+    self.codec = codec or JsonContextCodec()
     s3 = boto3.resource('s3')
     self.bucket = s3.Bucket(bucket_name)
 
@@ -129,8 +132,7 @@ class S3ContextStore(BaseContextStore):
   def get_active_context(self, uid: int) -> HandlingContext:
     o = self.bucket.Object(self._get_name(str(uid)))
     try:
-      jtext = o.get()['Body'].read().decode('utf-8')
-      return HandlingContext.from_json_string(jtext)
+      return self.codec.decode(o.get()['Body'].read())
     except ClientError as e:
       if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
         return None
@@ -139,7 +141,7 @@ class S3ContextStore(BaseContextStore):
 
   def put_context(self, context: HandlingContext):
     o = self.bucket.Object(self._get_name(str(context.uid)))
-    o.put(Body=context.to_json_string())
+    o.put(Body=self.codec.encode(context))
 
 async def do_handle(event, context):
   try:
@@ -151,16 +153,13 @@ async def do_handle(event, context):
     s3 = S3ContextStore('botanix-context-store')
     m = MainHandler(s3, HelpHandler(bot),
                     StartHandler(bot), RegisterHandler(bot))
-    u, uid, epoch = extract(body)
-    if u.effective_user is None:
-      print(f'No user for update {u}')
-    elif u.effective_message is None:
-      print(f'No message for update {u}')
+    u = UpdateView.from_body(body)
+    if u.uid is None:
+      print(f'No user for update {body}')
     else:
-      uid = u.effective_user.id
-      message = u.effective_message.text
+      uid = u.uid
       try:
-        result = await m.handle(uid, message, u)
+        result = await m.handle_update(u)
         if not result.handled:
           print(result.unhandled_message)
       except Exception as ex:
@@ -180,21 +179,3 @@ async def do_handle(event, context):
 def webhook_handler(event, context):
   loop = asyncio.get_event_loop()
   return loop.run_until_complete(asyncio.gather(do_handle(event, context)))
-
-def extract(body: str) -> (Update, int, int):
-  j = json.loads(body)
-  u = Update.de_json(j, None)
-  uid = None
-  epoch = -1
-  if u.effective_user is None:
-    if u.channel_post is None:
-      print(f'WARNING: cannot decipher this: {body}')
-      return None, None, None
-    else:
-      uid = u.channel_post.chat.id
-      epoch = u.channel_post.date
-  else:
-    uid = u.effective_user.id
-    epoch = u.message.date
-
-  return u, uid, epoch
\ No newline at end of file
@@ -6,7 +6,7 @@ setup(
     license='MIT',
     author="Ali Kheyrollahi",
     author_email='aliostad@gmail.com',
-    packages=find_packages(exclude=['tests', 'samples']),
+    packages=find_packages(exclude=['tests', 'samples', 'benchmarks']),
     url='https://github.com/aliostad/botanix',
     keywords='Telegram bot',
     install_requires=[
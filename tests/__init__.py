@@ -1,4 +1,78 @@
-from botanix.handling import BaseContextStore, HandlingContext
+import contextlib
+import json
+import os
+import time
+from botanix.handling import BaseContextStore, BaseHandler, HandlingContext, HandlingResult
+from telegram import Update
+
+
+class FakeClock:
+  """
+  Clock for stores, caches and schedulers which only moves when `now` is set
+  """
+
+  def __init__(self, now: float = 0.0):
+    self.now = now
+
+  def __call__(self) -> float:
+    return self.now
+
+
+class FormHandler(BaseHandler):
+  """
+  Three-step form: /form, then a name stored in custom ('bad' raises, 'again' stays on the step),
+  then anything ends the track
+  """
+  async def handle_0(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  async def handle_1(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command == 'bad':
+      raise ValueError('bad input')
+    if command == 'again':
+      return HandlingResult.override_step_result(1)
+    context.put_custom('name', command)
+    return HandlingResult.success_result()
+
+  async def handle_2(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+def make_update(update_id: int, uid: int, text: str) -> dict:
+  """
+  :return: a text message update from a private chat, as Telegram sends it
+  """
+  return {'update_id': update_id,
+          'message': {'message_id': update_id, 'date': 1700000000, 'text': text,
+                      'chat': {'id': uid, 'type': 'private'},
+                      'from': {'id': uid, 'is_bot': False, 'first_name': 'Ali'}}}
+
+
+def make_update_body(update_id: int, uid: int, text: str) -> bytes:
+  """
+  :return: make_update as the JSON body of a request
+  """
+  return json.dumps(make_update(update_id, uid, text)).encode('utf-8')
+
+
+@contextlib.contextmanager
+def pinned_timezone(name: str):
+  """
+  Runs the block with the local time zone of the process set to `name`, e.g. 'Asia/Tokyo'
+  """
+  previous = os.environ.get('TZ')
+  os.environ['TZ'] = name
+  time.tzset()
+  try:
+    yield
+  finally:
+    if previous is None:
+      del os.environ['TZ']
+    else:
+      os.environ['TZ'] = previous
+    time.tzset()
+
+
 class DictionaryBasedContextStore(BaseContextStore):
 
   def __init__(self):
@@ -25,14 +99,13 @@ class DictionaryBasedContextStore(BaseContextStore):
     self.contexts[uid] = HandlingContext(uid, track_name)
     return self.contexts[uid]
 
-  def put_context(self, uid: int, context: HandlingContext) -> None:
+  def put_context(self, context: HandlingContext) -> None:
     """
     Updates the stored context
-    :param uid:
     :param context:
     :return:
     """
-    self.contexts[uid] = context
+    self.contexts[context.uid] = context
 
   def clear_context(self, uid: int):
     """
@@ -40,4 +113,42 @@ class DictionaryBasedContextStore(BaseContextStore):
     :param uid:
     :return:
     """
-    self.contexts.clear()
\ No newline at end of file
+    self.contexts.pop(uid, None)
+
+
+class CountingStore(BaseContextStore):
+
+  def __init__(self):
+    self.contexts = {}
+    self.calls = []
+
+  def get_active_context(self, uid: int) -> HandlingContext:
+    self.calls.append('get')
+    return self.contexts.get(uid)
+
+  def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    self.calls.append('new')
+    self.contexts[uid] = HandlingContext(uid, track_nam)
+    return self.contexts[uid]
+
+  def put_context(self, context: HandlingContext) -> None:
+    self.calls.append('put')
+    self.contexts[context.uid] = context
+
+  def clear_context(self, uid: int):
+    self.calls.append('clear')
+    self.contexts.pop(uid, None)
+
+  def get_many(self, uids: list) -> dict:
+    self.calls.append('get_many')
+    return {uid: self.contexts[uid] for uid in uids if uid in self.contexts}
+
+  def put_many(self, contexts: list) -> None:
+    self.calls.append('put_many')
+    for ctx in contexts:
+      self.contexts[ctx.uid] = ctx
+
+  def clear_many(self, uids: list):
+    self.calls.append('clear_many')
+    for uid in uids:
+      self.contexts.pop(uid, None)
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, AsyncBaseContextStore
+from botanix.thread_pool_store import ThreadPoolContextStore
+from tests import DictionaryBasedContextStore
+from telegram import Update
+
+
+class SlowDictionaryStore(DictionaryBasedContextStore):
+
+  def __init__(self, delay: float):
+    super().__init__()
+    self.delay = delay
+    self.lock = threading.Lock()
+    self.concurrent = 0
+    self.max_concurrent = 0
+
+  def get_active_context(self, uid: int) -> HandlingContext:
+    with self.lock:
+      self.concurrent += 1
+      self.max_concurrent = max(self.max_concurrent, self.concurrent)
+    time.sleep(self.delay)
+    with self.lock:
+      self.concurrent -= 1
+    return super().get_active_context(uid)
+
+
+class InMemoryAsyncStore(AsyncBaseContextStore):
+
+  def __init__(self):
+    self.contexts = {}
+
+  async def get_active_context(self, uid: int) -> HandlingContext:
+    return self.contexts.get(uid)
+
+  async def new_context(self, uid: int, track_nam: str) -> HandlingContext:
+    self.contexts[uid] = HandlingContext(uid, track_nam)
+    return self.contexts[uid]
+
+  async def put_context(self, context: HandlingContext) -> None:
+    self.contexts[context.uid] = context
+
+  async def clear_context(self, uid: int):
+    self.contexts.pop(uid, None)
+
+
+class TwoStepHandler(BaseHandler):
+  async def handle_0(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  async def handle_1(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+class AsyncStoreTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_async_store_is_awaited(self):
+    store = InMemoryAsyncStore()
+    h = MainHandler(store, TwoStepHandler())
+    self.assertTrue(h.is_async_store)
+    r1 = await h.handle(123, '/TwoStep', None)
+    self.assertFalse(r1.is_terminal)
+    self.assertEqual(1, store.contexts[123].step)
+    r2 = await h.handle(123, 'anything', None)
+    self.assertTrue(r2.is_terminal)
+    self.assertNotIn(123, store.contexts)
+
+  async def test_thread_pool_adapter_overlaps_users(self):
+    inner = SlowDictionaryStore(0.05)
+    store = ThreadPoolContextStore(inner, max_workers=4)
+    h = MainHandler(store, TwoStepHandler())
+    results = await asyncio.gather(*[h.handle(uid, '/TwoStep', None) for uid in range(4)])
+    store.close()
+    self.assertTrue(all(r.handled for r in results))
+    self.assertEqual(4, inner.max_concurrent)
+    for uid in range(4):
+      self.assertEqual(1, inner.contexts[uid].step)
@@ -0,0 +1,74 @@
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number
+from tests import DictionaryBasedContextStore, CountingStore, FormHandler
+from telegram import Update
+
+
+class BoomHandler(BaseHandler):
+
+  @step_number(0)
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('x', 1)
+    raise ValueError('boom')
+
+
+class FuseHandler(BaseHandler):
+
+  @step_number(0)
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def explode(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('x', 2)
+    raise ValueError('boom')
+
+
+class HandleManyTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_bulk_store_calls(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler())
+    results = await h.handle_many([(1, '/Form', None), (2, '/Form', None), (1, 'ali', None),
+                                   (2, 'bob', None), (1, 'done', None), (3, 'hello', None)])
+    self.assertEqual(['get_many', 'put_many'], store.calls)
+    self.assertTrue(results[4].is_terminal)
+    self.assertFalse(results[5].handled)
+    self.assertNotIn(1, store.contexts)
+    self.assertEqual(2, store.contexts[2].step)
+    self.assertEqual('bob', store.contexts[2].get_custom('name'))
+
+  async def test_exception_does_not_lose_batch(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler())
+    results = await h.handle_many([(1, '/Form', None), (1, 'bad', None), (2, '/Form', None)])
+    self.assertIsInstance(results[1], ValueError)
+    self.assertEqual(1, store.contexts[1].step)
+    self.assertEqual(1, store.contexts[2].step)
+
+  async def test_failing_command_keeps_the_current_track(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler(), BoomHandler())
+    await h.handle_many([(1, '/Form', None), (1, 'ali', None)])
+    results = await h.handle_many([(1, '/boom', None)])
+    self.assertIsInstance(results[0], ValueError)
+    ctx = store.contexts[1]
+    self.assertEqual(('form', 2, {'name': 'ali'}), (ctx.track_name, ctx.step, ctx.custom))
+
+  async def test_failing_update_keeps_the_changes_of_earlier_ones(self):
+    store = CountingStore()
+    h = MainHandler(store, FuseHandler())
+    results = await h.handle_many([(1, '/fuse', None), (1, 'go', None)])
+    self.assertTrue(results[0].handled)
+    self.assertIsInstance(results[1], ValueError)
+    ctx = store.contexts[1]
+    self.assertEqual(('fuse', 1, {}), (ctx.track_name, ctx.step, ctx.custom))
+
+  async def test_falls_back_to_per_uid_operations(self):
+    store = DictionaryBasedContextStore()
+    h = MainHandler(store, FormHandler())
+    await h.handle_many([(1, '/Form', None), (1, 'ali', None)])
+    self.assertEqual(2, store.contexts[1].step)
+    results = await h.handle_many([(1, 'done', None)])
+    self.assertTrue(results[0].is_terminal)
+    self.assertNotIn(1, store.contexts)
@@ -0,0 +1,25 @@
+import unittest
+from benchmarks.run import compare, run
+
+
+class BenchmarkTests(unittest.TestCase):
+
+  def test_run_small(self):
+    results = run(users=10, updates=5000, seed=1, number=10, contexts=50, import_repeat=1)
+    self.assertEqual(5000, results['results']['workload']['updates'])
+    self.assertEqual(0, results['results']['workload']['failures'])
+    self.assertGreater(results['results']['workload']['updates_per_sec'], 0)
+    self.assertGreater(results['results']['context_memory']['bytes_per_context'], 0)
+    self.assertIn('binary_codec_round_trip', results['results']['micro'])
+    self.assertFalse(results['results']['cold_start']['imports_telegram'])
+
+  def test_compare(self):
+    baseline = {'results': {'workload': {'updates_per_sec': 1000.0, 'p99_latency_us': 10.0}}}
+    current = {'results': {'workload': {'updates_per_sec': 700.0, 'p99_latency_us': 11.0}}}
+    self.assertEqual([('workload.updates_per_sec', 1000.0, 700.0)], compare(baseline, current, 0.2))
+    current['results']['workload']['p99_latency_us'] = 13.0
+    self.assertEqual(2, len(compare(baseline, current, 0.2)))
+
+
+if __name__ == '__main__':
+  unittest.main()
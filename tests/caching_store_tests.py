@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from botanix.caching_store import CachingContextStore
+from botanix.handling import HandlingContext
+from botanix.sqlite_store import SqliteContextStore
+from tests import CountingStore, FakeClock
+
+
+class CachingContextStoreTests(unittest.TestCase):
+
+  def test_read_through_and_hit(self):
+    backing = CountingStore()
+    backing.put_context(HandlingContext(1, 'form'))
+    backing.calls.clear()
+    store = CachingContextStore(backing)
+    self.assertEqual('form', store.get_active_context(1).track_name)
+    self.assertEqual('form', store.get_active_context(1).track_name)
+    self.assertEqual(['get'], backing.calls)
+    self.assertEqual(1, store.stats.hits)
+    self.assertEqual(1, store.stats.misses)
+
+  def test_cached_context_is_not_shared(self):
+    store = CachingContextStore(CountingStore())
+    store.put_context(HandlingContext(1, 'form'))
+    store.get_active_context(1).put_custom('a', 1)
+    self.assertIsNone(store.get_active_context(1).get_custom('a'))
+
+  def test_ttl_and_lru_eviction(self):
+    clock = FakeClock()
+    store = CachingContextStore(CountingStore(), max_size=2, ttl=10, clock=clock)
+    for uid in range(3):
+      store.put_context(HandlingContext(uid, 'form'))
+    self.assertEqual(1, store.stats.evictions)
+    self.assertEqual(2, len(store))
+    clock.now = 11
+    store.get_active_context(2)
+    self.assertEqual(1, store.stats.expirations)
+    self.assertEqual(1, store.stats.misses)
+
+  def test_clear_invalidates(self):
+    backing = CountingStore()
+    store = CachingContextStore(backing)
+    store.put_context(HandlingContext(1, 'form'))
+    store.clear_context(1)
+    self.assertIsNone(store.get_active_context(1))
+    self.assertNotIn(1, backing.contexts)
+
+  def test_write_behind(self):
+    backing = CountingStore()
+    store = CachingContextStore(backing, write_behind=True, max_pending=3)
+    store.put_context(HandlingContext(1, 'form'))
+    store.put_context(HandlingContext(2, 'form'))
+    self.assertEqual([], backing.calls)
+    self.assertEqual('form', store.get_active_context(2).track_name)
+    store.clear_context(2)
+    store.flush()
+    self.assertEqual(['clear_many', 'put_many'], backing.calls)
+    self.assertIn(1, backing.contexts)
+    self.assertNotIn(2, backing.contexts)
+    for uid in range(3, 6):
+      store.put_context(HandlingContext(uid, 'form'))
+    self.assertEqual(['clear_many', 'put_many', 'put_many'], backing.calls)
+
+
+class WriteBehindSplitCustomTests(unittest.TestCase):
+
+  def test_changed_custom_values_are_flushed(self):
+    with tempfile.TemporaryDirectory() as d:
+      backing = SqliteContextStore(os.path.join(d, 'contexts.db'), split_custom=True)
+      try:
+        backing.put_context(HandlingContext(1, 'form'))
+        store = CachingContextStore(backing, write_behind=True)
+        for key, value in (('name', 'ali'), ('email', 'ali@example.com')):
+          ctx = store.get_active_context(1)
+          ctx.put_custom(key, value)
+          store.put_context(ctx)
+          ctx.mark_clean()
+        store.flush()
+        self.assertEqual({'name': 'ali', 'email': 'ali@example.com'}, backing.get_active_context(1).custom)
+        self.assertEqual(set(), store.get_active_context(1).changed_keys)
+      finally:
+        backing.close()
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from botanix.caching_store import CachingContextStore
+from botanix.context_codecs import BinaryContextCodec, JsonContextCodec
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, VersionConflict, \
+  CompareAndSwapNotSupported, step_number
+from botanix.memory_store import MemoryContextStore
+from botanix.sqlite_store import SqliteContextStore
+from botanix.thread_pool_store import ThreadPoolContextStore
+from tests import DictionaryBasedContextStore
+from telegram import Update
+
+
+class FormHandler(BaseHandler):
+
+  def __init__(self, pause: asyncio.Event = None):
+    super().__init__()
+    self.pause = pause
+    self.calls = 0
+
+  @step_number(0, '/form')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def name(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.calls += 1
+    if self.pause is not None:
+      await self.pause.wait()
+    context.put_custom('name', command)
+    return HandlingResult.success_result()
+
+  @step_number(2)
+  async def email(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('email', command)
+    return HandlingResult.success_result()
+
+
+class AlwaysConflictingStore(MemoryContextStore):
+
+  def put_context(self, context: HandlingContext, expected_version: int = None) -> None:
+    raise VersionConflict('always')
+
+
+class CompareAndSwapStoreTestCase(unittest.TestCase):
+
+  def _assert_compare_and_swap(self, store):
+    ctx = HandlingContext(1, 'form')
+    store.put_context(ctx, 0)
+    self.assertEqual(1, ctx.version)
+    self.assertEqual(1, store.get_active_context(1).version)
+    with self.assertRaises(VersionConflict):
+      store.put_context(HandlingContext(1, 'form'), 0)
+    stale = store.get_active_context(1)
+    ctx.step = 1
+    store.put_context(ctx, 1)
+    self.assertEqual(2, store.get_active_context(1).version)
+    self.assertEqual(1, store.get_active_context(1).step)
+    with self.assertRaises(VersionConflict):
+      store.put_context(stale, stale.version)
+    with self.assertRaises(VersionConflict):
+      store.clear_context(1, 1)
+    store.clear_context(1, 2)
+    self.assertIsNone(store.get_active_context(1))
+    # a missing context is at version 0
+    store.clear_context(1, 0)
+    store.put_context(HandlingContext(1, 'form'), 0)
+    with self.assertRaises(VersionConflict):
+      store.clear_context(1, 0)
+    self.assertIsNotNone(store.get_active_context(1))
+
+  def test_memory_store(self):
+    self._assert_compare_and_swap(MemoryContextStore())
+
+  def test_sqlite_store(self):
+    with tempfile.TemporaryDirectory() as d:
+      store = SqliteContextStore(os.path.join(d, 'contexts.db'))
+      try:
+        self._assert_compare_and_swap(store)
+      finally:
+        store.close()
+
+  def test_sqlite_store_adds_version_to_old_tables(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'contexts.db')
+      conn = sqlite3.connect(path)
+      conn.execute('CREATE TABLE contexts (uid INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, data BLOB NOT NULL)')
+      conn.execute('INSERT INTO contexts VALUES (?, ?, ?)',
+                   (1, 2 ** 40, BinaryContextCodec().encode(HandlingContext(1, 'form'))))
+      conn.commit()
+      conn.close()
+      store = SqliteContextStore(path)
+      try:
+        self.assertEqual(0, store.get_active_context(1).version)
+        store.put_context(HandlingContext(1, 'form'), 0)
+        self.assertEqual(1, store.get_active_context(1).version)
+      finally:
+        store.close()
+
+  def test_caching_store_invalidates_on_conflict(self):
+    backing = MemoryContextStore()
+    cache = CachingContextStore(backing)
+    self.assertTrue(cache.supports_compare_and_swap)
+    self.assertFalse(CachingContextStore(backing, write_behind=True).supports_compare_and_swap)
+    cache.put_context(HandlingContext(1, 'form'), 0)
+    backing.put_context(cache.get_active_context(1), 1)  # written by another node
+    with self.assertRaises(VersionConflict):
+      cache.put_context(cache.get_active_context(1), 1)
+    self.assertEqual(2, cache.get_active_context(1).version)
+
+  def test_codecs_keep_version(self):
+    ctx = HandlingContext(1, 'form')
+    ctx.version = 7
+    for codec in (JsonContextCodec(), BinaryContextCodec()):
+      self.assertEqual(7, codec.decode(codec.encode(ctx)).version)
+
+
+class OptimisticConcurrencyTests(unittest.IsolatedAsyncioTestCase):
+
+  def test_store_without_compare_and_swap_is_rejected(self):
+    with self.assertRaises(CompareAndSwapNotSupported):
+      MainHandler(DictionaryBasedContextStore(), FormHandler(), optimistic_concurrency=True)
+
+  async def test_concurrent_nodes_do_not_lose_steps(self):
+    store = MemoryContextStore()
+    pause = asyncio.Event()
+    slow = FormHandler(pause)
+    node_a = MainHandler(store, slow, optimistic_concurrency=True, conflict_backoff=0)
+    node_b = MainHandler(store, FormHandler(), optimistic_concurrency=True)
+    await node_b.handle(1, '/form', None)
+    task = asyncio.create_task(node_a.handle(1, 'ann@example.com', None))
+    await asyncio.sleep(0)  # node a is now waiting in the name step
+    await node_b.handle(1, 'Ann', None)
+    pause.set()
+    self.assertTrue((await task).handled)
+    ctx = store.get_active_context(1)
+    self.assertEqual({'name': 'Ann', 'email': 'ann@example.com'}, ctx.custom)
+    self.assertEqual(3, ctx.step)
+    self.assertEqual(1, node_a.conflicts)
+
+  async def test_gives_up_after_max_retries(self):
+    store = AlwaysConflictingStore()
+    h = MainHandler(store, FormHandler(), optimistic_concurrency=True, max_conflict_retries=2, conflict_backoff=0)
+    with self.assertRaises(VersionConflict):
+      await h.handle(1, '/form', None)
+    self.assertEqual(3, h.conflicts)
+
+  async def test_handle_many(self):
+    store = MemoryContextStore()
+    h = MainHandler(store, FormHandler(), optimistic_concurrency=True)
+    results = await h.handle_many([(1, '/form', None), (2, '/form', None), (1, 'Ann', None)])
+    self.assertTrue(all(r.handled for r in results))
+    self.assertEqual(2, store.get_active_context(1).step)
+    self.assertEqual(2, store.get_active_context(1).version)
+
+  async def test_thread_pool_store(self):
+    store = ThreadPoolContextStore(MemoryContextStore())
+    h = MainHandler(store, FormHandler(), optimistic_concurrency=True)
+    await h.handle(1, '/form', None)
+    await h.handle(1, 'Ann', None)
+    self.assertEqual(2, (await store.get_active_context(1)).version)
+    store.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from botanix.handling import HandlingContext
+from botanix.handling import HandlingContext, HandlingResult
+from botanix.context_codecs import JsonContextCodec, BinaryContextCodec, ContextCodecError
 
 class SerialisationTestCase(unittest.TestCase):
 
@@ -13,3 +14,56 @@ class SerialisationTestCase(unittest.TestCase):
     self.assertEqual(ctx.uid, ctx2.uid)
     self.assertEqual(ctx.track_name, ctx2.track_name)
     self.assertEqual(ctx.get_custom('one'), ctx2.get_custom('one'))
+
+
+class CodecTestCase(unittest.TestCase):
+
+  def _assert_round_trip(self, codec):
+    ctx = HandlingContext(-1234567890123, 'register', step=3)
+    ctx.put_custom('name', 'Ali')
+    ctx.put_custom('age', 42)
+    ctx.put_custom('big', -2 ** 40)
+    ctx.put_custom('nested', {'tags': ['a', 'b'], 'ok': True, 'score': 1.5, 'none': None})
+    ctx2 = codec.decode(codec.encode(ctx))
+    self.assertEqual(ctx.uid, ctx2.uid)
+    self.assertEqual(ctx.track_name, ctx2.track_name)
+    self.assertEqual(ctx.step, ctx2.step)
+    self.assertEqual(ctx.timestamp, ctx2.timestamp)
+    self.assertEqual(ctx.custom, ctx2.custom)
+    self.assertFalse(ctx2.is_dirty)
+    return ctx
+
+  def test_json_codec(self):
+    self._assert_round_trip(JsonContextCodec())
+
+  def test_binary_codec(self):
+    ctx = self._assert_round_trip(BinaryContextCodec())
+    self.assertLess(len(BinaryContextCodec().encode(ctx)), len(JsonContextCodec().encode(ctx)))
+
+  def test_binary_codec_with_known_tracks(self):
+    codec = BinaryContextCodec(['Register'])
+    self._assert_round_trip(codec)
+    known = codec.encode(HandlingContext(1, 'register'))
+    unknown = BinaryContextCodec().encode(HandlingContext(1, 'register'))
+    self.assertEqual(len(unknown) - len('register') - 1, len(known))
+
+  def test_binary_codec_rejects_unknown_version(self):
+    data = bytearray(BinaryContextCodec().encode(HandlingContext(1, 'register')))
+    data[0] = 99
+    with self.assertRaises(ContextCodecError):
+      BinaryContextCodec().decode(bytes(data))
+
+
+class AllocationTestCase(unittest.TestCase):
+
+  def test_context_is_slotted(self):
+    ctx = HandlingContext(123, 'can')
+    self.assertFalse(hasattr(ctx, '__dict__'))
+    self.assertIsInstance(ctx.timestamp, int)
+
+  def test_common_results_are_shared_and_immutable(self):
+    self.assertIs(HandlingResult.success_result(), HandlingResult.success_result())
+    self.assertIs(HandlingResult.terminal_result(), HandlingResult.terminal_result())
+    self.assertTrue(HandlingResult.terminal_result().is_terminal)
+    with self.assertRaises(AttributeError):
+      HandlingResult.success_result().handled = False
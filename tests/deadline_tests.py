@@ -0,0 +1,148 @@
+import asyncio
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number, deadline
+from botanix.instrumentation import Metrics
+from botanix.memory_store import MemoryContextStore
+from telegram import Update
+
+
+class QuoteHandler(BaseHandler):
+
+  def __init__(self, delay: float = 0):
+    super().__init__()
+    self.delay = delay
+    self.cancelled = 0
+
+  @step_number(0, '/quote')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1, deadline=0.05)
+  async def amount(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('amount', command)
+    context.reply('Fetching prices')
+    try:
+      await asyncio.sleep(self.delay)
+    except asyncio.CancelledError:
+      self.cancelled += 1
+      raise
+    return HandlingResult.success_result()
+
+  @step_number(2)
+  async def confirm(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command == 'timeout':
+      raise TimeoutError('raised by the handler itself')
+    return HandlingResult.terminal_result()
+
+
+@deadline(0.05)
+class SlowHandler(BaseHandler):
+
+  @step_number(0, '/slow')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    await asyncio.sleep(1)
+    return HandlingResult.success_result()
+
+  @step_number(1, deadline=2)
+  async def wait(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+
+class StartHandler(BaseHandler):
+
+  @step_number(0, '/start')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+
+class DeadlineTestCase(unittest.IsolatedAsyncioTestCase):
+
+  def test_deadlines_of_steps_and_tracks(self):
+    self.assertEqual(0.05, QuoteHandler.get_deadline(1))
+    self.assertIsNone(QuoteHandler.get_deadline(2))
+    self.assertEqual(0.05, SlowHandler.get_deadline(0))
+    self.assertEqual(2, SlowHandler.get_deadline(1))
+
+  async def test_step_past_its_deadline_is_cancelled_and_not_stored(self):
+    store = MemoryContextStore()
+    metrics = Metrics()
+    handler = QuoteHandler(delay=1)
+    h = MainHandler(store, handler, instrumentation=metrics)
+    await h.handle(1, '/quote', None)
+    result = await h.handle(1, '100', None)  # queues a reply but no outbox: must not be sent
+    self.assertTrue(result.is_timed_out)
+    self.assertFalse(result.handled)
+    self.assertEqual(1, handler.cancelled)
+    ctx = store.get_active_context(1)
+    self.assertEqual(1, ctx.step)
+    self.assertEqual({}, ctx.custom)
+    self.assertEqual(1, h.timeouts)
+    self.assertEqual({('quote', 1): 1}, metrics.deadlines_exceeded)
+    self.assertIn('botanix_deadline_exceeded_total{track="quote",step="1"} 1', metrics.to_prometheus())
+
+  async def test_new_track_past_its_deadline_is_not_stored(self):
+    store = MemoryContextStore()
+    h = MainHandler(store, QuoteHandler(), SlowHandler())
+    await h.handle(1, '/quote', None)
+    self.assertTrue((await h.handle(1, '/slow', None)).is_timed_out)
+    self.assertEqual('quote', store.get_active_context(1).track_name)
+
+  async def test_timeout_raised_by_a_handler_is_an_error(self):
+    store = MemoryContextStore()
+    store.put_context(HandlingContext(1, 'quote', 2))
+    h = MainHandler(store, QuoteHandler(), default_deadline=1)
+    with self.assertRaises(TimeoutError):
+      await h.handle(1, 'timeout', None)
+    self.assertEqual(0, h.timeouts)
+
+  async def test_default_deadline(self):
+    h = MainHandler(MemoryContextStore(), QuoteHandler(delay=1), default_deadline=0.01)
+    self.assertEqual(0.05, h._deadline('quote', 1))
+    self.assertEqual(0.01, h._deadline('quote', 2))
+
+  async def test_handle_many_restores_the_context(self):
+    store = MemoryContextStore()
+    h = MainHandler(store, QuoteHandler(delay=1))
+    results = await h.handle_many([(1, '/quote', None), (1, '100', None), (2, '/quote', None)])
+    self.assertTrue(results[1].is_timed_out)
+    ctx = store.get_active_context(1)
+    self.assertEqual(1, ctx.step)
+    self.assertEqual({}, ctx.custom)
+    self.assertEqual(1, store.get_active_context(2).step)
+
+
+class LoadSheddingTestCase(unittest.IsolatedAsyncioTestCase):
+
+  async def test_new_tracks_are_rejected_when_overloaded(self):
+    store = MemoryContextStore()
+    metrics = Metrics()
+    h = MainHandler(store, QuoteHandler(delay=0.2), StartHandler(), max_in_flight=2, instrumentation=metrics)
+    await h.handle(1, '/quote', None)
+    busy = [asyncio.create_task(h.handle(1, '100', None))]
+    await asyncio.sleep(0)
+    self.assertEqual(1, h.in_flight)
+    self.assertFalse((await h.handle(2, '/quote', None)).is_overloaded)
+    store.put_context(HandlingContext(3, 'quote', 1))
+    busy.append(asyncio.create_task(h.handle(3, '200', None)))
+    await asyncio.sleep(0)
+    result = await h.handle(4, '/quote', None)
+    self.assertTrue(result.is_overloaded)
+    self.assertIsNone(store.get_active_context(4))
+    self.assertTrue((await h.handle(4, '/start', None)).handled)
+    self.assertTrue((await h.handle(2, '5', None)).is_timed_out)  # a started track is still served
+    await asyncio.gather(*busy)
+    self.assertEqual(0, h.in_flight)
+    self.assertEqual(1, h.shed)
+    self.assertEqual({'quote': 1}, metrics.shed)
+
+  async def test_handle_many_counts_its_updates(self):
+    h = MainHandler(MemoryContextStore(), QuoteHandler(), StartHandler(), max_in_flight=2)
+    results = await h.handle_many([(1, '/quote', None), (2, '/start', None), (3, '/quote', None)])
+    self.assertTrue(results[0].is_overloaded)
+    self.assertTrue(results[1].handled)
+    self.assertTrue(results[2].is_overloaded)
+    self.assertEqual(0, h.in_flight)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,181 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from botanix.context_codecs import BinaryContextCodec, JsonContextCodec
+from botanix.dedup import BloomFilter, UpdateDeduplicator
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number
+from tests import DictionaryBasedContextStore, FakeClock
+from telegram import Update
+
+
+class CountHandler(BaseHandler):
+
+  def __init__(self):
+    super().__init__()
+    self.calls = 0
+
+  @step_number(0, '/count')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.calls += 1
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def more(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.calls += 1
+    return HandlingResult.override_step_result(1)
+
+
+class FlakyHandler(BaseHandler):
+  """
+  Fails, or takes longer than its deadline, the first time it handles an update
+  """
+
+  def __init__(self, slow: bool = False):
+    super().__init__()
+    self.slow = slow
+    self.calls = 0
+
+  @step_number(0, '/flaky', deadline=0.05)
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.calls += 1
+    if self.calls == 1:
+      if not self.slow:
+        raise ConnectionError('store is down')
+      await asyncio.sleep(1)
+    return HandlingResult.success_result()
+
+
+def _update(update_id: int):
+  return SimpleNamespace(update_id=update_id)
+
+
+class BloomFilterTests(unittest.TestCase):
+
+  def test_no_false_negatives(self):
+    f = BloomFilter(1000, 1e-6)
+    for i in range(1000):
+      f.add(i)
+    self.assertTrue(all(i in f for i in range(1000)))
+    self.assertFalse(any(i in f for i in range(1000, 11000)))
+
+
+class UpdateDeduplicatorTests(unittest.TestCase):
+
+  def test_seen(self):
+    d = UpdateDeduplicator()
+    self.assertFalse(d.seen(1))
+    self.assertFalse(d.seen(2))
+    self.assertTrue(d.seen(1))
+    self.assertEqual(1, d.duplicates)
+
+  def test_remembered_beyond_exact_size(self):
+    d = UpdateDeduplicator(exact_size=10, capacity=1000)
+    for i in range(100):
+      d.seen(i)
+    self.assertTrue(d.seen(0))
+
+  def test_forgotten_after_window(self):
+    clock = FakeClock()
+    d = UpdateDeduplicator(window=10, exact_size=1, clock=clock)
+    d.seen(1)
+    d.seen(2)
+    clock.now = 6
+    self.assertFalse(d.seen(3))
+    self.assertTrue(d.seen(1))  # still in the previous filter
+    clock.now = 12
+    self.assertFalse(d.seen(1) and d.seen(2))
+
+
+class MainHandlerDedupTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_duplicate_is_not_handled(self):
+    handler = CountHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    self.assertTrue((await h.handle(1, '/count', _update(10))).handled)
+    r = await h.handle(1, '/count', _update(10))
+    self.assertTrue(r.is_duplicate)
+    self.assertFalse(r.handled)
+    self.assertEqual(1, handler.calls)
+
+  async def test_updates_without_id_are_handled(self):
+    handler = CountHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    await h.handle(1, '/count', None)
+    await h.handle(1, '/count', None)
+    self.assertEqual(2, handler.calls)
+
+  async def test_handle_many(self):
+    handler = CountHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    results = await h.handle_many([(1, '/count', _update(1)), (1, 'a', _update(2)), (1, 'a', _update(2))])
+    self.assertEqual([False, False, True], [r.is_duplicate for r in results])
+    self.assertEqual(2, handler.calls)
+
+  async def test_update_failing_is_handled_when_redelivered(self):
+    handler = FlakyHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    with self.assertRaises(ConnectionError):
+      await h.handle(1, '/flaky', _update(10))
+    self.assertTrue((await h.handle(1, '/flaky', _update(10))).handled)
+    self.assertTrue((await h.handle(1, '/flaky', _update(10))).is_duplicate)
+    self.assertEqual(2, handler.calls)
+
+  async def test_update_timing_out_is_handled_when_redelivered(self):
+    handler = FlakyHandler(slow=True)
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    self.assertTrue((await h.handle(1, '/flaky', _update(10))).is_timed_out)
+    self.assertTrue((await h.handle_many([(1, '/flaky', _update(10))]))[0].handled)
+    self.assertTrue((await h.handle(1, '/flaky', _update(10))).is_duplicate)
+
+  async def test_update_in_progress_is_a_duplicate(self):
+    handler = FlakyHandler(slow=True)
+    h = MainHandler(DictionaryBasedContextStore(), handler, deduplicator=UpdateDeduplicator())
+    first = asyncio.create_task(h.handle(1, '/flaky', _update(10)))
+    await asyncio.sleep(0)
+    self.assertTrue((await h.handle(1, '/flaky', _update(10))).is_duplicate)
+    await first
+    self.assertEqual(1, handler.calls)
+
+  async def test_batch_not_stored_is_handled_when_redelivered(self):
+    class FailingStore(DictionaryBasedContextStore):
+      fail = True
+
+      def put_many(self, contexts: list) -> None:
+        if self.fail:
+          raise ConnectionError('store is down')
+        super().put_many(contexts)
+
+    store = FailingStore()
+    handler = CountHandler()
+    h = MainHandler(store, handler, deduplicator=UpdateDeduplicator())
+    with self.assertRaises(ConnectionError):
+      await h.handle_many([(1, '/count', _update(1))])
+    store.fail = False
+    self.assertTrue((await h.handle_many([(1, '/count', _update(1))]))[0].handled)
+    self.assertEqual(1, len(store.contexts))
+
+  async def test_persisted_update_id(self):
+    store = DictionaryBasedContextStore()
+    handler = CountHandler()
+    h = MainHandler(store, handler, deduplicator=UpdateDeduplicator(persist=True))
+    await h.handle(1, '/count', _update(5))
+    await h.handle(1, 'a', _update(6))
+    self.assertEqual(6, store.contexts[1].last_update_id)
+    # a new process has an empty deduplicator but the context remembers the last update
+    h = MainHandler(store, handler, deduplicator=UpdateDeduplicator(persist=True))
+    self.assertTrue((await h.handle(1, 'a', _update(6))).is_duplicate)
+    self.assertTrue((await h.handle_many([(1, 'a', _update(4))]))[0].is_duplicate)
+    self.assertTrue((await h.handle(1, 'a', _update(7))).handled)
+    self.assertEqual(3, handler.calls)
+
+  def test_codecs_keep_last_update_id(self):
+    ctx = HandlingContext(1, 'count')
+    ctx.record_update(42)
+    for codec in (JsonContextCodec(), BinaryContextCodec()):
+      self.assertEqual(42, codec.decode(codec.encode(ctx)).last_update_id)
+    self.assertIsNone(BinaryContextCodec().decode(BinaryContextCodec().encode(HandlingContext(1, 'count')))
+                      .last_update_id)
+
+
+if __name__ == '__main__':
+  unittest.main()
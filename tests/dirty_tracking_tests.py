@@ -0,0 +1,52 @@
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult
+from tests import CountingStore, FormHandler
+from telegram import Update
+
+
+class StartHandler(BaseHandler):
+  async def handle_0(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+class HandlingContextChangeTrackingTests(unittest.TestCase):
+
+  def test_new_context_is_dirty(self):
+    self.assertTrue(HandlingContext(1, 'form').is_dirty)
+
+  def test_changes_are_tracked(self):
+    ctx = HandlingContext.from_json_string(HandlingContext(1, 'form').to_json_string())
+    self.assertFalse(ctx.is_dirty)
+    ctx.override_step(0)
+    ctx.track_name = 'form'
+    self.assertFalse(ctx.is_dirty)
+    ctx.put_custom('a', 1)
+    self.assertTrue(ctx.is_dirty)
+    ctx.mark_clean()
+    ctx.put_custom('a', 1)
+    self.assertFalse(ctx.is_dirty)
+    ctx.move_to_next()
+    self.assertTrue(ctx.is_dirty)
+
+
+class StoreWriteTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_new_track_is_written_once(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler())
+    await h.handle(1, '/Form', None)
+    self.assertEqual(['get', 'put'], store.calls)
+
+  async def test_unchanged_context_is_not_written(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler())
+    await h.handle(1, '/Form', None)
+    store.calls.clear()
+    await h.handle(1, 'again', None)
+    self.assertEqual(['get'], store.calls)
+
+  async def test_generic_track_without_context_is_not_written(self):
+    store = CountingStore()
+    h = MainHandler(store, FormHandler(), StartHandler())
+    await h.handle(1, '/start', None)
+    self.assertEqual(['get'], store.calls)
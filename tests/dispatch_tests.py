@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult
+from tests import DictionaryBasedContextStore
+from telegram import Update
+
+
+class SlowFormHandler(BaseHandler):
+
+  def __init__(self):
+    super().__init__()
+    self.running = 0
+    self.max_running = 0
+    self.seen = []
+
+  async def _slow(self, command: str):
+    self.running += 1
+    self.max_running = max(self.max_running, self.running)
+    self.seen.append(command)
+    await asyncio.sleep(0.01)
+    self.running -= 1
+
+  async def handle_0(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    await self._slow(command)
+    return HandlingResult.success_result()
+
+  async def handle_1(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    await self._slow(command)
+    return HandlingResult.success_result()
+
+  async def handle_2(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    await self._slow(command)
+    return HandlingResult.terminal_result()
+
+
+class PerUserOrderingTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_same_user_is_serialised(self):
+    handler = SlowFormHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, per_user_ordering=True)
+    await h.handle(1, '/SlowForm', None)
+    r = await asyncio.gather(h.handle(1, 'a', None), h.handle(1, 'b', None))
+    self.assertFalse(r[0].is_terminal)
+    self.assertTrue(r[1].is_terminal)
+    self.assertEqual(['/SlowForm', 'a', 'b'], handler.seen)
+    self.assertEqual(1, handler.max_running)
+    self.assertEqual(0, len(h.user_locks))
+
+  async def test_different_users_run_concurrently(self):
+    handler = SlowFormHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler, per_user_ordering=True)
+    await asyncio.gather(*[h.handle(uid, '/SlowForm', None) for uid in range(5)])
+    self.assertEqual(5, handler.max_running)
+    self.assertEqual(0, len(h.user_locks))
@@ -1,5 +1,5 @@
 import unittest
-from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, track_name, step_number
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, UnhandledMessage, track_name, step_number
 from tests import DictionaryBasedContextStore
 from telegram import Update
 
@@ -58,3 +58,92 @@ class SimpleWorkflowTests(unittest.IsolatedAsyncioTestCase):
     self.assertEqual(1, len(h.step_handlers[0]))
     self.assertEqual(1, len(h.step_handlers[1]))
     self.assertEqual(2, len(h.step_handlers[2]))
+
+
+class StepTableTests(unittest.TestCase):
+
+  def test_step_table_is_shared_by_instances(self):
+    table = CommandThreeHandler.get_step_table()
+    self.assertIs(table, CommandThreeHandler().get_step_table())
+    self.assertEqual([0, 1, 2], sorted(table))
+    self.assertEqual(2, len(table[2]))
+
+  def test_invalid_step_is_rejected_when_class_is_defined(self):
+    with self.assertRaises(ValueError):
+      class BadStepHandler(BaseHandler):
+        @step_number(-1)
+        async def negative(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+          return HandlingResult.success_result()
+
+  def test_duplicate_track_is_rejected(self):
+    with self.assertRaises(ValueError):
+      MainHandler(DictionaryBasedContextStore(), Command1Handler(), Command1Handler())
+
+  def test_command_routing(self):
+    h = MainHandler(DictionaryBasedContextStore(), Command1Handler(), CommandThreeHandler())
+    self.assertEqual(('command3', True), h._route('/Command3', None))
+    self.assertIsNone(h._route('/command1 please', None))
+    with self.assertRaises(UnhandledMessage):
+      h._route('/unknown', None)
+
+
+class MenuHandler(BaseHandler):
+
+  @step_number(0, expected_command='Yes')
+  async def yes(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+  @step_number(0, command_pattern=r'\d+')
+  async def number(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if int(command) > 10:
+      return HandlingResult.unhandled_result('too big')
+    return HandlingResult.override_step_result(int(command))
+
+  @step_number(0, command_pattern=r'[0-9a-f]+')
+  async def hexadecimal(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.override_step_result(int(command, 16))
+
+  @step_number(0)
+  async def anything_else(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.unhandled_result('pick an option')
+
+
+class StepDispatchTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_exact_expected_command(self):
+    result = await MenuHandler().handle('Yes', None, HandlingContext(1, 'menu'))
+    self.assertTrue(result.is_terminal)
+
+  def test_candidates_are_in_declaration_order(self):
+    self.assertEqual(['yes', 'number', 'hexadecimal', 'anything_else'],
+                     [f.__name__ for f in MenuHandler.get_step_table()[0]])
+
+  async def test_pattern_expected_command(self):
+    # number is declared first, hexadecimal would read it as 16
+    result = await MenuHandler().handle('10', None, HandlingContext(1, 'menu'))
+    self.assertEqual(10, result.step_override)
+
+  async def test_falls_through_to_next_candidate(self):
+    # number does not handle it, so it goes on to hexadecimal
+    result = await MenuHandler().handle('11', None, HandlingContext(1, 'menu'))
+    self.assertEqual(17, result.step_override)
+
+  def test_patterns_with_groups_are_tried_one_by_one(self):
+    class RepeatHandler(BaseHandler):
+
+      @step_number(0, command_pattern=r'a+')
+      async def many_a(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+        return HandlingResult.success_result()
+
+      @step_number(0, command_pattern=r'(b)\1')
+      async def double_b(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+        return HandlingResult.success_result()
+
+    index = RepeatHandler.get_step_index()[0]
+    self.assertEqual(['double_b'], [f.__name__ for f in index.candidates('bb')])
+    self.assertEqual(['many_a'], [f.__name__ for f in index.candidates('aaa')])
+
+  async def test_unhandled_result_of_last_candidate_is_returned(self):
+    result = await MenuHandler().handle('nope', None, HandlingContext(1, 'menu'))
+    self.assertFalse(result.handled)
+    self.assertEqual('pick an option', result.unhandled_message)
@@ -0,0 +1,100 @@
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, UnhandledMessage, \
+  step_number
+from botanix.instrumentation import BaseInstrumentation, Histogram, Metrics
+from tests import DictionaryBasedContextStore
+from telegram import Update
+
+
+class OrderHandler(BaseHandler):
+
+  @step_number(0, '/order')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def item(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command == 'boom':
+      raise KeyError(command)
+    if command == 'done':
+      return HandlingResult.terminal_result()
+    return HandlingResult.unhandled_result('Unknown item')
+
+
+class RecordingInstrumentation(BaseInstrumentation):
+
+  def __init__(self):
+    self.transitions = []
+
+  def on_transition(self, uid: int, track_nam: str, from_step: int, to_step: int):
+    self.transitions.append((uid, track_nam, from_step, to_step))
+
+
+class HistogramTests(unittest.TestCase):
+
+  def test_cumulative_counts(self):
+    h = Histogram((0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 5):
+      h.observe(v)
+    self.assertEqual([2, 3, 4], h.cumulative_counts())
+    self.assertEqual(4, h.count)
+
+
+class MetricsTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_counts_results(self):
+    metrics = Metrics()
+    h = MainHandler(DictionaryBasedContextStore(), OrderHandler(), instrumentation=metrics)
+    await h.handle(1, '/order', None)
+    await h.handle(1, 'tea', None)
+    await h.handle(1, 'done', None)
+    with self.assertRaises(UnhandledMessage):
+      await h.handle(1, '/missing', None)
+    await h.handle(2, '/order', None)
+    with self.assertRaises(KeyError):
+      await h.handle(2, 'boom', None)
+    self.assertEqual({('order', 'handled'): 2, ('order', 'unhandled'): 1, ('order', 'terminal'): 1}, metrics.results)
+    self.assertEqual({'': 1}, metrics.unhandled_messages)
+    self.assertEqual({('order', 'KeyError'): 1}, metrics.handler_errors)
+    self.assertEqual(2, metrics.handler_seconds[('order', 0)].count)
+    self.assertEqual(2, metrics.handler_seconds[('order', 1)].count)  # calls which raised are not timed
+    self.assertEqual(6, metrics.store_seconds['get'].count)
+    self.assertEqual(2, metrics.store_seconds['put'].count)
+    self.assertEqual(1, metrics.store_seconds['clear'].count)
+
+  async def test_handle_many(self):
+    metrics = Metrics()
+    h = MainHandler(DictionaryBasedContextStore(), OrderHandler(), instrumentation=metrics)
+    await h.handle_many([(1, '/order', None), (2, '/order', None), (1, 'done', None)])
+    self.assertEqual(1, metrics.store_seconds['get_many'].count)
+    self.assertEqual(1, metrics.store_seconds['put_many'].count)
+    self.assertEqual({('order', 'handled'): 2, ('order', 'terminal'): 1}, metrics.results)
+
+  async def test_transitions(self):
+    instrumentation = RecordingInstrumentation()
+    h = MainHandler(DictionaryBasedContextStore(), OrderHandler(), instrumentation=instrumentation)
+    await h.handle(1, '/order', None)
+    await h.handle(1, 'tea', None)
+    await h.handle(1, 'done', None)
+    self.assertEqual([(1, 'order', 0, 1), (1, 'order', 1, None)], instrumentation.transitions)
+
+  async def test_prometheus_format(self):
+    metrics = Metrics(buckets=(0.5, 1.0))
+    h = MainHandler(DictionaryBasedContextStore(), OrderHandler(), instrumentation=metrics)
+    await h.handle(1, '/order', None)
+    text = metrics.to_prometheus()
+    self.assertIn('# TYPE botanix_handler_seconds histogram\n', text)
+    self.assertIn('botanix_handler_seconds_bucket{track="order",step="0",le="0.5"} 1\n', text)
+    self.assertIn('botanix_handler_seconds_bucket{track="order",step="0",le="+Inf"} 1\n', text)
+    self.assertIn('botanix_handler_seconds_count{track="order",step="0"} 1\n', text)
+    self.assertIn('botanix_results_total{track="order",outcome="handled"} 1\n', text)
+    self.assertIn('botanix_store_seconds_count{operation="put"} 1\n', text)
+
+  def test_label_escaping(self):
+    metrics = Metrics()
+    metrics.on_unhandled_message('a"b\\c', 0)
+    self.assertIn('track="a\\"b\\\\c"', metrics.to_prometheus())
+
+
+if __name__ == '__main__':
+  unittest.main()
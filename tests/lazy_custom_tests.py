@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from botanix.context_codecs import BinaryContextCodec, JsonContextCodec
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, VersionConflict, step_number
+from botanix.sqlite_store import SqliteContextStore
+from telegram import Update
+
+
+class SignupHandler(BaseHandler):
+
+  @step_number(0, '/signup')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def photo(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('photo', command * 1000)
+    return HandlingResult.success_result()
+
+  @step_number(2)
+  async def confirm(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command != 'yes':
+      return HandlingResult.override_step_result(2)
+    return HandlingResult.success_result()
+
+  @step_number(3)
+  async def name(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.put_custom('name', command)
+    return HandlingResult.success_result()
+
+
+class LazyCustomTestCase(unittest.TestCase):
+
+  def test_custom_loads_on_first_use(self):
+    loads = []
+
+    def loader():
+      loads.append(1)
+      return {'name': 'Ann'}
+    ctx = HandlingContext.from_fields(1, 'signup', 2, 0, {})
+    ctx.defer_custom(loader)
+    self.assertFalse(ctx.is_custom_loaded)
+    copy = ctx.copy()
+    self.assertEqual('Ann', ctx.get_custom('name'))
+    self.assertEqual('Ann', ctx.get_custom('name'))
+    self.assertEqual(1, len(loads))
+    self.assertEqual('Ann', copy.get_custom('name'))
+    self.assertEqual(2, len(loads))
+
+  def test_changed_keys(self):
+    ctx = HandlingContext(1, 'signup')
+    self.assertIsNone(ctx.changed_keys)
+    ctx.mark_clean()
+    ctx.put_custom('name', 'Ann')
+    ctx.put_custom('name', 'Ann')
+    ctx.put_custom('email', 'ann@example.com')
+    self.assertEqual({'name', 'email'}, ctx.changed_keys)
+    ctx.custom = {}
+    self.assertIsNone(ctx.changed_keys)
+
+  def test_codecs_encode_values(self):
+    for codec in (JsonContextCodec(), BinaryContextCodec()):
+      for val in (None, 3, 'text', [1, 'a'], {'a': 1.5}):
+        self.assertEqual(val, codec.decode_value(codec.encode_value(val)))
+
+
+class SplitCustomSqliteTestCase(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, 'contexts.db')
+    self.store = SqliteContextStore(self.path, split_custom=True)
+
+  def tearDown(self):
+    self.store.close()
+    self.dir.cleanup()
+
+  def _custom_rows(self) -> dict:
+    conn = sqlite3.connect(self.path)
+    try:
+      return {(uid, key): value for uid, key, value in conn.execute('SELECT uid, key, value FROM context_custom')}
+    finally:
+      conn.close()
+
+  async def test_steps_not_using_custom_values_do_not_read_them(self):
+    h = MainHandler(self.store, SignupHandler())
+    await h.handle(1, '/signup', None)
+    await h.handle(1, 'x', None)
+    self.assertEqual(1000, len(self.store.get_active_context(1).get_custom('photo')))
+    ctx = self.store.get_active_context(1)
+    self.assertFalse(ctx.is_custom_loaded)
+    loaded = []
+    original = self.store._load_custom
+    self.store._load_custom = lambda uid: loaded.append(uid) or original(uid)
+    await h.handle(1, 'no', None)
+    await h.handle(1, 'yes', None)
+    self.assertEqual([], loaded)
+    await h.handle(1, 'Ann', None)
+    self.assertEqual([1], loaded)
+    self.assertEqual({(1, 'photo'), (1, 'name')}, set(self._custom_rows()))
+    ctx = self.store.get_active_context(1)
+    self.assertEqual(4, ctx.step)
+    self.assertEqual({'photo': 'x' * 1000, 'name': 'Ann'}, ctx.custom)
+
+  def test_only_changed_keys_are_written(self):
+    ctx = HandlingContext(1, 'signup')
+    ctx.put_custom('photo', b'large')
+    self.store.put_context(ctx)
+    conn = sqlite3.connect(self.path)
+    conn.execute("UPDATE context_custom SET value = ? WHERE key = 'photo'",
+                 (self.store.codec.encode_value(b'changed elsewhere'),))
+    conn.commit()
+    conn.close()
+    ctx = self.store.get_active_context(1)
+    ctx.put_custom('name', 'Ann')
+    self.store.put_context(ctx)
+    self.assertEqual({'photo': b'changed elsewhere', 'name': 'Ann'}, self.store.get_active_context(1).custom)
+
+  def test_new_context_replaces_custom_values(self):
+    ctx = HandlingContext(1, 'signup')
+    ctx.put_custom('photo', b'large')
+    self.store.put_context(ctx)
+    self.store.put_context(HandlingContext(1, 'other'))
+    self.assertEqual({}, self.store.get_active_context(1).custom)
+    self.assertEqual({}, self._custom_rows())
+
+  def test_clear_and_conflicts(self):
+    ctx = HandlingContext(1, 'signup')
+    ctx.put_custom('name', 'Ann')
+    self.store.put_context(ctx, 0)
+    stale = self.store.get_active_context(1)
+    stale.put_custom('name', 'Bob')
+    ctx = self.store.get_active_context(1)
+    ctx.step = 1
+    self.store.put_context(ctx, ctx.version)
+    with self.assertRaises(VersionConflict):
+      self.store.put_context(stale, stale.version)
+    self.assertEqual('Ann', self.store.get_active_context(1).get_custom('name'))
+    self.store.clear_context(1, 2)
+    self.assertIsNone(self.store.get_active_context(1))
+    self.assertEqual({}, self._custom_rows())
+
+
+if __name__ == '__main__':
+  unittest.main()
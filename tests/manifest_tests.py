@@ -0,0 +1,130 @@
+import importlib
+import inspect
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+from botanix.handling import BaseHandler
+from botanix.manifest import build_manifest, load_manifest, write_manifest
+
+_HANDLERS = '''
+from botanix.handling import BaseHandler, HandlingResult, step_number
+
+class CoffeeHandler(BaseHandler):
+
+  @step_number(0, '/coffee')
+  async def start(self, command, update, context):
+    return HandlingResult.success_result()
+
+  @step_number(1, 'Latte')
+  async def latte(self, command, update, context):
+    return HandlingResult.terminal_result()
+
+  @step_number(1, command_pattern=r'\\d+')
+  async def size(self, command, update, context):
+    return HandlingResult.terminal_result()
+
+  def order_2(self, command, update, context):
+    return HandlingResult.terminal_result()
+'''
+
+
+class ManifestTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    sys.path.insert(0, self.dir.name)
+    self._write_module(_HANDLERS)
+
+  def tearDown(self):
+    sys.path.remove(self.dir.name)
+    sys.modules.pop('coffee_handlers', None)
+    BaseHandler._manifest_entries.clear()
+    self.dir.cleanup()
+
+  def _write_module(self, source: str):
+    sys.modules.pop('coffee_handlers', None)
+    with open(os.path.join(self.dir.name, 'coffee_handlers.py'), 'w') as f:
+      f.write(source)
+    importlib.invalidate_caches()
+
+  def _import(self):
+    sys.modules.pop('coffee_handlers', None)
+    with mock.patch('inspect.getmembers', wraps=inspect.getmembers) as getmembers:
+      module = importlib.import_module('coffee_handlers')
+    return module.CoffeeHandler, getmembers.call_count
+
+  def test_build_manifest(self):
+    manifest = build_manifest(['coffee_handlers'])
+    entry = manifest['handlers']['coffee_handlers.CoffeeHandler']
+    self.assertEqual(['start'], entry['steps']['0'])
+    self.assertEqual({'latte', 'size'}, set(entry['steps']['1']))
+    self.assertEqual(['order_2'], entry['steps']['2'])
+
+  def test_classes_are_not_inspected_with_a_manifest(self):
+    path = os.path.join(self.dir.name, 'manifest.json')
+    write_manifest(['coffee_handlers'], path)
+    inspected, _ = self._import()
+    self.assertEqual(1, load_manifest(path))
+    cls, inspections = self._import()
+    self.assertEqual(0, inspections)
+    self.assertEqual({s: set(f.__name__ for f in funcs) for s, funcs in inspected.get_step_table().items()},
+                     {s: set(f.__name__ for f in funcs) for s, funcs in cls.get_step_table().items()})
+    self.assertEqual('size', next(cls.get_step_index()[1].candidates('12')).__name__)
+
+  def test_stale_manifest_is_ignored(self):
+    path = os.path.join(self.dir.name, 'manifest.json')
+    write_manifest(['coffee_handlers'], path)
+    load_manifest(path)
+    self._write_module(_HANDLERS + textwrap.indent(textwrap.dedent('''
+      def pay_3(self, command, update, context):
+        return HandlingResult.terminal_result()
+    '''), '  '))
+    cls, inspections = self._import()
+    self.assertEqual(1, inspections)
+    self.assertIn(3, cls.get_step_table())
+
+  def test_manifest_is_stale_when_a_step_changes(self):
+    path = os.path.join(self.dir.name, 'manifest.json')
+    write_manifest(['coffee_handlers'], path)
+    load_manifest(path)
+    self._write_module(_HANDLERS.replace("@step_number(1, 'Latte')", "@step_number(2, 'Latte')"))
+    cls, inspections = self._import()
+    self.assertEqual(1, inspections)
+    self.assertEqual(['start'], [f.__name__ for f in cls.get_step_table()[0]])
+    self.assertEqual({'latte', 'order_2'}, set(f.__name__ for f in cls.get_step_table()[2]))
+
+  def test_manifest_is_stale_when_a_base_class_changes(self):
+    base = textwrap.dedent('''
+      class MenuHandler(BaseHandler):
+
+        @step_number(3)
+        async def menu(self, command, update, context):
+          return HandlingResult.terminal_result()
+    ''')
+    self._write_module(_HANDLERS.replace('class CoffeeHandler(BaseHandler)', base + '\nclass CoffeeHandler(MenuHandler)'))
+    path = os.path.join(self.dir.name, 'manifest.json')
+    write_manifest(['coffee_handlers'], path)
+    load_manifest(path)
+    self._write_module(_HANDLERS.replace('class CoffeeHandler(BaseHandler)',
+                                         base.replace('@step_number(3)', '@step_number(4)') +
+                                         '\nclass CoffeeHandler(MenuHandler)'))
+    cls, _ = self._import()
+    self.assertIn(4, cls.get_step_table())
+    self.assertNotIn(3, cls.get_step_table())
+
+
+class ImportTestCase(unittest.TestCase):
+
+  def test_handling_does_not_import_telegram_or_dateutil(self):
+    out = subprocess.run([sys.executable, '-c', 'import sys, botanix.handling; '
+                          'print(sorted(m for m in ("telegram", "dateutil") if m in sys.modules))'],
+                         check=True, capture_output=True, text=True).stdout
+    self.assertEqual('[]', out.strip())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+import time
+import unittest
+from botanix.handling import HandlingContext, MainHandler
+from botanix.memory_store import MemoryContextStore
+from tests import FakeClock, FormHandler, pinned_timezone
+
+
+def _context(uid: int, timestamp: int) -> HandlingContext:
+  ctx = HandlingContext(uid, 'form')
+  ctx.timestamp = timestamp
+  return ctx
+
+
+class MemoryContextStoreTests(unittest.TestCase):
+
+  def test_put_get_clear_per_user(self):
+    store = MemoryContextStore(shards=4)
+    store.put_context(HandlingContext(1, 'form'))
+    store.put_context(HandlingContext(2, 'form'))
+    store.clear_context(1)
+    self.assertIsNone(store.get_active_context(1))
+    self.assertEqual('form', store.get_active_context(2).track_name)
+    self.assertFalse(store.get_active_context(2).is_dirty)
+
+  def test_stored_context_is_not_shared(self):
+    store = MemoryContextStore()
+    store.put_context(HandlingContext(1, 'form'))
+    store.get_active_context(1).override_step(3)
+    self.assertEqual(0, store.get_active_context(1).step)
+
+  def test_evicts_least_recently_written(self):
+    store = MemoryContextStore(max_contexts=2, shards=1)
+    for uid in range(3):
+      store.put_context(HandlingContext(uid, 'form'))
+    self.assertEqual(2, len(store))
+    self.assertEqual(1, store.evictions)
+    self.assertIsNone(store.get_active_context(0))
+
+  def test_lazy_expiry_on_read(self):
+    clock = FakeClock(1000)
+    store = MemoryContextStore(ttl=60, clock=clock)
+    store.put_context(_context(1, 1000))
+    clock.now = 1059
+    self.assertIsNotNone(store.get_active_context(1))
+    clock.now = 1060
+    self.assertIsNone(store.get_active_context(1))
+    self.assertEqual(1, store.expirations)
+
+  def test_sweep_removes_only_expired(self):
+    clock = FakeClock(2000)
+    store = MemoryContextStore(ttl=60, shards=2, clock=clock)
+    for uid in range(10):
+      store.put_context(_context(uid, 1900 if uid < 6 else 1990))
+    self.assertEqual(2, store.sweep(max_per_shard=1))
+    self.assertEqual(4, store.sweep())
+    self.assertEqual(4, len(store))
+
+  def test_expiry_does_not_depend_on_local_time_zone(self):
+    for tz in ('Asia/Tokyo', 'America/Los_Angeles'):
+      with self.subTest(tz=tz), pinned_timezone(tz):
+        store = MemoryContextStore(ttl=3600)
+        store.put_context(HandlingContext(1, 'form'))
+        self.assertIsNotNone(store.get_active_context(1))
+        store.clock = lambda: time.time() + 3601
+        self.assertIsNone(store.get_active_context(1))
+
+
+class MemoryContextStoreWorkflowTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_workflow(self):
+    store = MemoryContextStore(ttl=3600)
+    h = MainHandler(store, FormHandler())
+    await h.handle(1, '/Form', None)
+    self.assertEqual(1, store.get_active_context(1).step)
+    await h.handle(1, 'Ali', None)
+    self.assertEqual('Ali', store.get_active_context(1).get_custom('name'))
+    r = await h.handle(1, 'done', None)
+    self.assertTrue(r.is_terminal)
+    self.assertEqual(0, len(store))
@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult
+from botanix.memory_store import MemoryContextStore
+from botanix.outbox import Outbox, OutgoingMessage
+from telegram import Update
+
+
+class RetryAfter(Exception):
+
+  def __init__(self, retry_after: float):
+    super().__init__('Flood control exceeded')
+    self.retry_after = retry_after
+
+
+class FakeBot:
+
+  def __init__(self, fail_first_with: Exception = None):
+    self.sent = []
+    self.fail_first_with = fail_first_with
+
+  async def send_message(self, chat_id: int, text: str, **kwargs):
+    await asyncio.sleep(0)
+    if self.fail_first_with is not None:
+      ex, self.fail_first_with = self.fail_first_with, None
+      raise ex
+    self.sent.append((chat_id, text, kwargs))
+
+
+class GreetingHandler(BaseHandler):
+  async def handle_0(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.reply('Hello')
+    context.reply('What is your name?')
+    return HandlingResult.success_result()
+
+  async def handle_1(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    context.reply('Oops')
+    raise ValueError('failed')
+
+
+class OutboxTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_replies_are_sent_after_handling(self):
+    bot = FakeBot()
+    outbox = Outbox(bot, coalesce=False, per_chat_rate=1000, per_chat_burst=10)
+    h = MainHandler(MemoryContextStore(), GreetingHandler(), outbox=outbox)
+    await h.handle(1, '/Greeting', None)
+    with self.assertRaises(ValueError):
+      await h.handle(1, 'Ali', None)
+    await outbox.stop()
+    self.assertEqual([(1, 'Hello', {}), (1, 'What is your name?', {})], bot.sent)
+
+  async def test_replies_without_outbox_are_reported(self):
+    h = MainHandler(MemoryContextStore(), GreetingHandler())
+    with self.assertRaises(RuntimeError):
+      await h.handle(1, '/Greeting', None)
+
+  async def test_coalescing_and_per_chat_rate(self):
+    bot = FakeBot()
+    outbox = Outbox(bot, per_chat_rate=20)
+    outbox.submit([OutgoingMessage(1, 'a'), OutgoingMessage(1, 'b'), OutgoingMessage(1, 'c'),
+                   OutgoingMessage(1, 'markup', {'parse_mode': 'HTML'}), OutgoingMessage(2, 'x')])
+    await outbox.stop()
+    self.assertEqual(['a\n\nb\n\nc', 'markup'], [text for chat_id, text, _ in bot.sent if chat_id == 1])
+    self.assertEqual(2, outbox.stats.coalesced)
+    self.assertEqual(3, outbox.stats.sent)
+
+  async def test_retry_after(self):
+    bot = FakeBot(fail_first_with=RetryAfter(0.01))
+    outbox = Outbox(bot)
+    outbox.submit([OutgoingMessage(1, 'a')])
+    await outbox.stop()
+    self.assertEqual([(1, 'a', {})], bot.sent)
+    self.assertEqual(1, outbox.stats.retries)
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import unittest
+import urllib.parse
+from botanix.handling import MainHandler
+from botanix.memory_store import MemoryContextStore
+from botanix.polling import PollingRunner
+from tests import FormHandler, make_update
+
+
+class FakeBotApi:
+  """
+  Serves getUpdates from a list of pending updates, honouring the offset like Telegram does
+  """
+
+  def __init__(self, updates: list, limit: int):
+    self.updates = updates
+    self.limit = limit
+    self.offsets = []
+    self.server = None
+
+  async def start(self) -> str:
+    self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+    return f'http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+
+  async def _serve(self, reader, writer):
+    request_line = (await reader.readline()).decode('latin-1')
+    while (await reader.readline()) not in (b'\r\n', b''):
+      pass
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(request_line.split()[1]).query)
+    offset = int(query['offset'][0]) if 'offset' in query else 0
+    self.offsets.append(offset)
+    self.updates = [u for u in self.updates if u['update_id'] >= offset]
+    batch = self.updates[:self.limit]
+    if len(batch) == 0:
+      await asyncio.sleep(0.01)
+    body = json.dumps({'ok': True, 'result': batch}).encode('utf-8')
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n'
+                 + f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    writer.close()
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+
+class GatedMainHandler(MainHandler):
+  """
+  Holds every batch until `gate` is set
+  """
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.gate = asyncio.Event()
+    self.waiting = 0
+
+  async def handle_many(self, updates) -> list:
+    self.waiting += 1
+    await self.gate.wait()
+    return await super().handle_many(updates)
+
+
+async def _until(condition):
+  while not condition():
+    await asyncio.sleep(0.01)
+
+
+class PollingRunnerTests(unittest.IsolatedAsyncioTestCase):
+
+  async def _run(self, while_blocked, **kwargs):
+    api = FakeBotApi([make_update(1, 7, '/Form'), make_update(2, 8, '/Form'),
+                      make_update(3, 7, 'Ali'), make_update(4, 8, 'Bob')], limit=2)
+    base_url = await api.start()
+    store = MemoryContextStore()
+    main_handler = GatedMainHandler(store, FormHandler())
+    commits = []
+    runner = PollingRunner(main_handler, 'TOKEN', base_url=base_url, timeout=0, on_commit=commits.append,
+                           **kwargs)
+    task = asyncio.create_task(runner.run())
+    await asyncio.wait_for(_until(lambda: main_handler.waiting == 1), 2)
+    await while_blocked(api, runner)
+    main_handler.gate.set()
+    await asyncio.wait_for(_until(lambda: runner.committed_offset == 5), 2)
+    runner.stop()
+    await task
+    await api.stop()
+    self.assertEqual('Ali', store.get_active_context(7).get_custom('name'))
+    self.assertEqual('Bob', store.get_active_context(8).get_custom('name'))
+    self.assertEqual([3, 5], commits)
+    self.assertEqual(4, runner.handled)
+    self.assertEqual([0, 3], api.offsets[:2])
+
+  async def test_pipelined(self):
+    async def while_blocked(api, runner):
+      # the next batch is requested while the first one is still being handled
+      await asyncio.wait_for(_until(lambda: len(api.offsets) == 2), 2)
+      self.assertIsNone(runner.committed_offset)
+
+    await self._run(while_blocked, pipeline=True)
+
+  async def test_not_pipelined_by_default(self):
+    async def while_blocked(api, runner):
+      # the next batch is only requested once the first one has been handled
+      await asyncio.sleep(0.1)
+      self.assertEqual([0], api.offsets)
+      self.assertIsNone(runner.committed_offset)
+
+    await self._run(while_blocked)
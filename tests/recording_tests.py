@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number
+from botanix.memory_store import MemoryContextStore
+from botanix.recording import FakeBot, RecordingMainHandler, UpdateLog, UpdateLogWriter, replay
+from botanix.updates import UpdateView, parse_update
+from telegram import Update
+from tests import make_update
+
+
+class EchoHandler(BaseHandler):
+
+  def __init__(self, bot):
+    super().__init__()
+    self.bot = bot
+    self.updates = []
+
+  @step_number(0, '/echo')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def echo(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.updates.append(update)
+    await self.bot.send_message(context.uid, command)
+    return HandlingResult.terminal_result()
+
+
+class RecordingTests(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, 'updates.log')
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  async def _record(self, messages: list):
+    recorder = RecordingMainHandler(MainHandler(MemoryContextStore(), EchoHandler(FakeBot())),
+                                    UpdateLogWriter(self.path))
+    for i, (uid, text) in enumerate(messages):
+      await recorder.handle(*parse_update(make_update(i, uid, text)))
+    recorder.close()
+
+  async def test_round_trip(self):
+    await self._record([(1, '/echo'), (2, '/echo'), (1, 'héllo')])
+    with UpdateLog(self.path) as log:
+      records = list(log)
+    self.assertEqual([1, 2, 1], [r.uid for r in records])
+    self.assertEqual(['/echo', '/echo', 'héllo'], [r.text for r in records])
+    self.assertEqual(2, records[2].to_update().update_id)
+    self.assertLessEqual(records[0].arrival, records[2].arrival)
+
+  async def test_handle_update(self):
+    recorder = RecordingMainHandler(MainHandler(MemoryContextStore(), EchoHandler(FakeBot())),
+                                    UpdateLogWriter(self.path))
+    self.assertTrue((await recorder.handle_update(UpdateView.from_body(make_update(1, 3, '/echo')))).handled)
+    self.assertFalse((await recorder.handle_update(UpdateView.from_body({'update_id': 2}))).handled)
+    recorder.close()
+    with UpdateLog(self.path) as log:
+      self.assertEqual([(3, '/echo')], [(r.uid, r.text) for r in log])
+
+  def test_none_text_and_update(self):
+    w = UpdateLogWriter(self.path)
+    w.append(5, None, b'', arrival=1.5)
+    w.close()
+    with UpdateLog(self.path) as log:
+      r, = list(log)
+    self.assertEqual((1.5, 5, None, None), (r.arrival, r.uid, r.text, r.to_update()))
+
+  def test_truncated_record_is_skipped(self):
+    w = UpdateLogWriter(self.path)
+    w.append(1, 'a', b'{}')
+    w.append(2, 'b', b'{}')
+    w.close()
+    with open(self.path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.path) - 1)
+    with UpdateLog(self.path) as log:
+      self.assertEqual([1], [r.uid for r in log])
+
+  def test_appends_to_existing_log(self):
+    for uid in (1, 2):
+      w = UpdateLogWriter(self.path)
+      w.append(uid, 'a', b'')
+      w.close()
+    with UpdateLog(self.path) as log:
+      self.assertEqual([1, 2], [r.uid for r in log])
+
+  def test_rejects_other_files(self):
+    with open(self.path, 'wb') as f:
+      f.write(b'not a log')
+    with self.assertRaises(ValueError):
+      UpdateLog(self.path)
+
+  async def test_replay(self):
+    await self._record([(1, '/echo'), (2, '/echo'), (1, 'one'), (2, 'two')])
+    for speed in (None, 1000.0):
+      bot = FakeBot()
+      handler = EchoHandler(bot)
+      with UpdateLog(self.path) as log:
+        stats = await replay(log, MainHandler(MemoryContextStore(), handler, per_user_ordering=True),
+                             speed=speed, batch_size=3)
+      self.assertEqual(4, stats.updates)
+      self.assertEqual(0 if speed is None else 4, len(stats.latencies))
+      self.assertEqual([UpdateView, UpdateView], [type(u) for u in handler.updates])
+      self.assertEqual(0, stats.failed)
+      self.assertEqual({(1, 'one'), (2, 'two')}, {(c, t) for c, t, _ in bot.sent})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from botanix.context_codecs import BinaryContextCodec, JsonContextCodec
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, FollowUp, step_number
+from botanix.memory_store import MemoryContextStore
+from botanix.scheduler import Scheduler, TimingWheel
+from botanix.sqlite_store import SqliteContextStore
+from telegram import Update
+from tests import DictionaryBasedContextStore, FakeClock
+
+
+class RegisterHandler(BaseHandler):
+
+  def __init__(self):
+    super().__init__()
+    self.follow_ups = []
+
+  @step_number(0, '/register')
+  async def start(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.follow_up_result(60)
+
+  @step_number(1)
+  async def name(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command == MainHandler.follow_up_command:
+      self.follow_ups.append((context.step, update.due))
+      context.put_custom('reminded', True)
+      return HandlingResult.override_step_result(1)  # a reminder only, no more follow-up
+    context.put_custom('name', command)
+    return HandlingResult.success_result()
+
+  @step_number(2)
+  async def email(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.terminal_result()
+
+
+class TimingWheelTestCase(unittest.TestCase):
+
+  def test_timers_are_due_in_order(self):
+    w = TimingWheel(tick=1, size=4, levels=2, now=0)
+    for key, when in (('a', 3), ('b', 5), ('c', 14), ('d', 40), ('e', 0)):
+      w.schedule(key, when)
+    self.assertEqual([('e', 0)], w.advance(0))
+    self.assertEqual([('a', 3)], w.advance(4.5))
+    self.assertEqual([('b', 5)], w.advance(13))
+    self.assertEqual([('c', 14)], w.advance(39))
+    self.assertEqual(1, len(w))
+    self.assertEqual([('d', 40)], w.advance(100))
+    self.assertEqual(0, len(w))
+
+  def test_cancel_and_reschedule(self):
+    w = TimingWheel(tick=1, size=4, levels=2, now=0)
+    w.schedule('a', 10)
+    w.schedule('b', 10)
+    self.assertTrue(w.cancel('a'))
+    self.assertFalse(w.cancel('a'))
+    w.schedule('b', 2)
+    self.assertEqual(2, w.when('b'))
+    self.assertEqual([('b', 2)], w.advance(20))
+
+  def test_size_must_be_a_power_of_2(self):
+    with self.assertRaises(ValueError):
+      TimingWheel(size=10)
+
+
+class SchedulerTestCase(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.clock = FakeClock(1000000.0)
+    self.store = MemoryContextStore(clock=self.clock)
+    self.scheduler = Scheduler(tick=1, clock=self.clock)
+    self.handler = RegisterHandler()
+    self.main_handler = MainHandler(self.store, self.handler, scheduler=self.scheduler)
+
+  async def test_follow_up_goes_to_the_current_step(self):
+    await self.main_handler.handle(1, '/register', None)
+    due = self.clock.now + 60
+    self.assertEqual(due, self.store.get_active_context(1).follow_up_at)
+    self.assertEqual(1, self.scheduler.pending)
+    self.clock.now += 59
+    self.assertEqual(0, await self.scheduler.fire_due())
+    self.clock.now += 1
+    self.assertEqual(1, await self.scheduler.fire_due())
+    self.assertEqual([(1, due)], self.handler.follow_ups)
+    ctx = self.store.get_active_context(1)
+    self.assertTrue(ctx.get_custom('reminded'))
+    self.assertIsNone(ctx.follow_up_at)
+    self.assertEqual(0, self.scheduler.pending)
+
+  async def test_answering_cancels_the_follow_up(self):
+    await self.main_handler.handle(1, '/register', None)
+    await self.main_handler.handle(1, 'Ann', None)
+    self.assertEqual(0, self.scheduler.pending)
+    self.assertIsNone(self.store.get_active_context(1).follow_up_at)
+    await self.main_handler.handle(2, '/register', None)
+    await self.main_handler.handle(2, 'Bob', None)
+    await self.main_handler.handle(2, 'bob@example.com', None)
+    self.assertEqual(0, self.scheduler.pending)
+
+  async def test_stale_follow_up_is_ignored(self):
+    await self.main_handler.handle(1, '/register', None)
+    result = await self.main_handler.handle(1, MainHandler.follow_up_command, FollowUp(1, 12))
+    self.assertFalse(result.handled)
+    self.assertEqual([], self.handler.follow_ups)
+
+  async def test_handle_many_sets_follow_ups(self):
+    await self.main_handler.handle_many([(1, '/register', None), (2, '/register', None), (2, 'Bob', None)])
+    self.assertEqual(1, self.scheduler.pending)
+    self.assertIn(1, self.scheduler.wheel)
+
+  async def test_follow_ups_are_recovered_from_the_store(self):
+    await self.main_handler.handle(1, '/register', None)
+    scheduler = Scheduler(tick=1, clock=self.clock)
+    handler = RegisterHandler()
+    MainHandler(self.store, handler, scheduler=scheduler)
+    self.assertEqual(1, await scheduler.recover())
+    self.clock.now += 3600  # down for longer than the follow-up
+    self.assertEqual(1, await scheduler.fire_due())
+    self.assertEqual(1, len(handler.follow_ups))
+
+  async def test_store_without_follow_ups_recovers_none(self):
+    scheduler = Scheduler(tick=1, clock=self.clock)
+    MainHandler(DictionaryBasedContextStore(), RegisterHandler(), scheduler=scheduler)
+    self.assertEqual(0, await scheduler.recover())
+
+  async def test_start_and_stop(self):
+    scheduler = Scheduler(tick=0.01, clock=self.clock)
+    handler = RegisterHandler()
+    main_handler = MainHandler(self.store, handler, scheduler=scheduler)
+    await main_handler.handle(1, '/register', None)
+    await scheduler.start()
+    self.clock.now += 60
+    for _ in range(100):
+      if scheduler.fired > 0:
+        break
+      await asyncio.sleep(0.01)
+    await scheduler.stop()
+    self.assertEqual(1, len(handler.follow_ups))
+
+
+class FollowUpStorageTestCase(unittest.TestCase):
+
+  def test_codecs_keep_follow_up(self):
+    ctx = HandlingContext(1, 'register')
+    ctx.follow_up_at = 1700000000
+    for codec in (JsonContextCodec(), BinaryContextCodec()):
+      self.assertEqual(1700000000, codec.decode(codec.encode(ctx)).follow_up_at)
+      ctx.follow_up_at = None
+      self.assertIsNone(codec.decode(codec.encode(ctx)).follow_up_at)
+      ctx.follow_up_at = 1700000000
+
+  def test_sqlite_store_lists_follow_ups(self):
+    with tempfile.TemporaryDirectory() as d:
+      store = SqliteContextStore(os.path.join(d, 'contexts.db'), split_custom=True)
+      try:
+        ctx = HandlingContext(1, 'register')
+        ctx.follow_up_at = 1700000000
+        store.put_context(ctx)
+        store.put_context(HandlingContext(2, 'register'))
+        self.assertEqual([(1, 1700000000)], store.get_follow_ups())
+        self.assertEqual(1700000000, store.get_active_context(1).follow_up_at)
+      finally:
+        store.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
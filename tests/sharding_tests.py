@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number
+from botanix.instrumentation import Metrics
+from botanix.memory_store import MemoryContextStore
+from botanix.sharding import ShardedRunner
+from botanix.updates import UpdateView
+from telegram import Update
+from tests import make_update_body
+
+
+class CountHandler(BaseHandler):
+
+  @step_number(0, '/count')
+  async def count(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    return HandlingResult.success_result()
+
+  @step_number(1)
+  async def more(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    if command == 'crash':
+      os._exit(3)
+    if command == 'sleep':
+      time.sleep(0.5)  # a busy worker, not reading its pipe
+    return HandlingResult.override_step_result(1)
+
+
+def _new_main_handler(shard: int) -> MainHandler:
+  return MainHandler(MemoryContextStore(), CountHandler(), instrumentation=Metrics())
+
+
+class ShardedRunnerTests(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.runner = ShardedRunner(_new_main_handler, workers=2, max_in_flight=5)
+    await self.runner.start()
+
+  async def asyncTearDown(self):
+    await self.runner.stop()
+
+  async def _wait_done(self, expected: int):
+    for _ in range(500):
+      if sum(w.done for w in self.runner._workers) >= expected:
+        return
+      await asyncio.sleep(0.01)
+    self.fail('updates were not handled')
+
+  async def test_routes_by_uid_and_collects_metrics(self):
+    n = 0
+    for uid in range(1, 5):
+      for text in ('/count', 'a', 'b'):
+        n += 1
+        self.assertTrue(await self.runner.submit(make_update_body(n, uid, text)))
+    self.assertFalse(await self.runner.submit(b'{"update_id": 99}'))
+    await self._wait_done(n)
+    metrics = await self.runner.metrics()
+    self.assertEqual([6, 6], [m['handled'] for m in metrics])
+    self.assertEqual(2, len({m['pid'] for m in metrics}))
+    self.assertIn('botanix_results_total{track="count",outcome="handled"} 6', metrics[0]['prometheus'])
+
+  async def test_handle_accepts_views(self):
+    view = UpdateView.from_body(make_update_body(1, 3, '/count'))
+    self.assertTrue((await self.runner.handle(view.uid, view.text, view)).handled)
+    await self._wait_done(1)
+    self.assertEqual(1, self.runner._workers[1].done)
+
+  async def test_restarts_crashed_worker(self):
+    await self.runner.submit(make_update_body(1, 2, '/count'))
+    await self.runner.submit(make_update_body(2, 2, 'crash'))
+    for _ in range(500):
+      if self.runner._workers[0].restarts == 1:
+        break
+      await asyncio.sleep(0.01)
+    self.assertEqual(1, self.runner._workers[0].restarts)
+    done = sum(w.done for w in self.runner._workers)
+    await self.runner.submit(make_update_body(3, 4, '/count'))
+    await self._wait_done(done + 1)
+    metrics = await self.runner.metrics()
+    self.assertEqual(1, metrics[0]['handled'])  # by the new worker
+    self.assertEqual(1, metrics[0]['restarts'])
+    self.assertGreaterEqual(metrics[0]['lost'], 1)
+
+  async def test_stop_drains(self):
+    for i in range(20):
+      await self.runner.submit(make_update_body(i, i, '/count'))
+    await self.runner.stop()
+    self.assertEqual(20, sum(w.done for w in self.runner._workers))
+    self.assertFalse(any(w.process.is_alive() for w in self.runner._workers))
+
+
+class ShardedRunnerBackPressureTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_busy_worker_does_not_block_the_event_loop(self):
+    runner = ShardedRunner(_new_main_handler, workers=1, max_in_flight=1000)
+    await runner.start()
+    try:
+      await runner.submit(make_update_body(1, 1, '/count'))
+      await runner.submit(make_update_body(2, 1, 'sleep'))
+      gaps = []
+
+      async def tick():
+        last = time.perf_counter()
+        while True:
+          await asyncio.sleep(0.01)
+          now = time.perf_counter()
+          gaps.append(now - last)
+          last = now
+
+      ticker = asyncio.create_task(tick())
+      start = time.perf_counter()
+      for i in range(200):  # several MB, more than the pipe holds
+        await runner.submit(make_update_body(3 + i, 1, 'x' * 32768))
+      self.assertLess(time.perf_counter() - start, 0.3)
+      await asyncio.sleep(0.05)
+      ticker.cancel()
+      self.assertLess(max(gaps), 0.2)
+      for _ in range(500):
+        if runner._workers[0].done == 202:
+          break
+        await asyncio.sleep(0.01)
+      self.assertEqual(202, runner._workers[0].done)
+      self.assertEqual(202, (await runner.metrics())[0]['handled'])
+    finally:
+      await runner.stop()
+
+
+if __name__ == '__main__':
+  unittest.main()
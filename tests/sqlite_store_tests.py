@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from botanix.context_codecs import JsonContextCodec
+from botanix.handling import HandlingContext, MainHandler, VersionConflict
+from botanix.sqlite_store import SqliteContextStore
+from tests import FormHandler, pinned_timezone
+
+
+class SqliteContextStoreTests(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, 'contexts.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_put_get_clear(self):
+    store = SqliteContextStore(self.path)
+    ctx = HandlingContext(1, 'form', step=2)
+    ctx.put_custom('name', 'Ali')
+    store.put_context(ctx)
+    store.put_context(HandlingContext(2, 'form'))
+    ctx2 = store.get_active_context(1)
+    self.assertEqual(2, ctx2.step)
+    self.assertEqual('Ali', ctx2.get_custom('name'))
+    store.clear_context(1)
+    self.assertIsNone(store.get_active_context(1))
+    self.assertEqual([2], list(store.get_many([1, 2, 3])))
+    store.close()
+
+  def test_is_durable(self):
+    store = SqliteContextStore(self.path, codec=JsonContextCodec())
+    store.put_context(HandlingContext(1, 'form'))
+    store.close()
+    store = SqliteContextStore(self.path, codec=JsonContextCodec())
+    self.assertEqual('form', store.get_active_context(1).track_name)
+    store.close()
+
+  def test_expiry(self):
+    now = [10000]
+    store = SqliteContextStore(self.path, ttl=60, clock=lambda: now[0])
+    ctx = HandlingContext(1, 'form')
+    ctx.timestamp = 9950
+    store.put_context(ctx)
+    self.assertIsNotNone(store.get_active_context(1))
+    now[0] = 10010
+    self.assertIsNone(store.get_active_context(1))
+    store.purge_expired()
+    now[0] = 0
+    self.assertIsNone(store.get_active_context(1))
+    store.close()
+
+  def test_expiry_does_not_depend_on_local_time_zone(self):
+    for tz in ('Asia/Tokyo', 'America/Los_Angeles'):
+      with self.subTest(tz=tz), pinned_timezone(tz):
+        store = SqliteContextStore(self.path, ttl=3600)
+        try:
+          store.put_context(HandlingContext(1, 'form'), expected_version=0)
+          store.purge_expired()
+          self.assertIsNotNone(store.get_active_context(1))
+          # a live row is not taken over as if it had expired
+          with self.assertRaises(VersionConflict):
+            store.put_context(HandlingContext(1, 'form'), expected_version=0)
+          store.clock = lambda: time.time() + 3601
+          self.assertIsNone(store.get_active_context(1))
+          store.clear_context(1)
+        finally:
+          store.close()
+
+  def test_failed_put_many_keeps_versions(self):
+    store = SqliteContextStore(self.path, codec=JsonContextCodec())
+    ctx = HandlingContext(1, 'form')
+    store.put_many([ctx])
+    broken = HandlingContext(2, 'form')
+    broken.put_custom('value', object())
+    with self.assertRaises(TypeError):
+      store.put_many([ctx, broken])
+    self.assertEqual((1, 0), (ctx.version, broken.version))
+    store.close()
+
+  def test_group_commit(self):
+    store = SqliteContextStore(self.path, commit_interval=0.05)
+    threads = [threading.Thread(target=store.put_context, args=(HandlingContext(uid, 'form'),))
+               for uid in range(20)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(20, len(store.get_many(list(range(20)))))
+    self.assertLess(store.commits, 20)
+    store.close()
+
+  async def test_workflow(self):
+    store = SqliteContextStore(self.path)
+    h = MainHandler(store, FormHandler())
+    await h.handle(1, '/Form', None)
+    await h.handle(1, 'Ali', None)
+    self.assertEqual('Ali', store.get_active_context(1).get_custom('name'))
+    r = await h.handle(1, 'done', None)
+    self.assertTrue(r.is_terminal)
+    self.assertIsNone(store.get_active_context(1))
+    store.close()
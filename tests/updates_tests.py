@@ -0,0 +1,69 @@
+import json
+import unittest
+from botanix.handling import HandlingContext, MainHandler, BaseHandler, HandlingResult, step_number
+from botanix.updates import UpdateView, parse_update
+from tests import DictionaryBasedContextStore, make_update
+from telegram import Update
+
+
+class PingHandler(BaseHandler):
+
+  def __init__(self):
+    super().__init__()
+    self.updates = []
+
+  @step_number(0, '/ping')
+  async def ping(self, command: str, update: Update, context: HandlingContext) -> HandlingResult:
+    self.updates.append(update)
+    return HandlingResult.terminal_result()
+
+
+class UpdateViewTests(unittest.IsolatedAsyncioTestCase):
+
+  def test_message(self):
+    view = UpdateView.from_body(json.dumps(make_update(10, 7, '/ping')).encode())
+    self.assertEqual((10, 7, 7, '/ping', 1700000000), (view.update_id, view.uid, view.chat_id, view.text, view.date))
+    self.assertIsNone(view._update)
+
+  def test_callback_query(self):
+    view = UpdateView({'update_id': 11, 'callback_query': {'id': 'q', 'from': {'id': 3}, 'data': 'x',
+                                                           'message': {'text': 'pick', 'date': 5, 'chat': {'id': 4}}}})
+    self.assertEqual((3, 4, 'pick', 5), (view.uid, view.chat_id, view.text, view.date))
+
+  def test_channel_post_falls_back_to_chat(self):
+    view = UpdateView({'update_id': 12, 'channel_post': {'text': 'news', 'date': 1, 'chat': {'id': -100}}})
+    self.assertEqual((-100, 'news'), (view.uid, view.text))
+
+  def test_no_user_or_chat(self):
+    view = UpdateView({'update_id': 13, 'poll': {'id': 'p'}})
+    self.assertIsNone(view.uid)
+
+  def test_full_update_is_built_on_access(self):
+    view = UpdateView(make_update(10, 7, '/ping'))
+    self.assertEqual('Ali', view.effective_user.first_name)
+    self.assertIsInstance(view.update, Update)
+    self.assertIs(view.update, view.update)
+
+  def test_custom_loads(self):
+    calls = []
+
+    def loads(body):
+      calls.append(body)
+      return json.loads(body)
+    UpdateView.from_body(json.dumps(make_update(10, 7, '/ping')), loads=loads)
+    self.assertEqual(1, len(calls))
+
+  def test_parse_update(self):
+    uid, text, view = parse_update(make_update(10, 8, 'hi'))
+    self.assertEqual((8, 'hi'), (uid, text))
+
+  async def test_main_handler_accepts_view(self):
+    handler = PingHandler()
+    h = MainHandler(DictionaryBasedContextStore(), handler)
+    self.assertTrue((await h.handle_update(UpdateView(make_update(10, 7, '/ping')))).handled)
+    self.assertIsInstance(handler.updates[0], UpdateView)
+    self.assertFalse((await h.handle_update(UpdateView({'update_id': 1}))).handled)
+
+
+if __name__ == '__main__':
+  unittest.main()
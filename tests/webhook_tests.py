@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+from botanix.handling import MainHandler
+from botanix.memory_store import MemoryContextStore
+from botanix.webhook import WebhookServer
+from tests import FormHandler, make_update_body
+
+
+async def post(port: int, path: str, body: bytes, headers: dict = None) -> int:
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  extra = ''.join(f'{k}: {v}\r\n' for k, v in (headers or {}).items())
+  writer.write(f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n'
+               f'Connection: close\r\n{extra}\r\n'.encode('latin-1') + body)
+  await writer.drain()
+  status = int((await reader.readline()).split()[1])
+  writer.close()
+  return status
+
+
+class WebhookServerTests(unittest.IsolatedAsyncioTestCase):
+
+  async def test_updates_are_handled(self):
+    store = MemoryContextStore()
+    server = WebhookServer(MainHandler(store, FormHandler(), per_user_ordering=True),
+                           path='/hook', host='127.0.0.1', port=0, workers=4, secret_token='s3cret')
+    await server.start()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}
+    self.assertEqual(200, await post(server.port, '/hook', make_update_body(1, 42, '/Form'), headers))
+    self.assertEqual(200, await post(server.port, '/hook', make_update_body(2, 42, 'Ali'), headers))
+    self.assertEqual(403, await post(server.port, '/hook', make_update_body(3, 42, 'Bob')))
+    self.assertEqual(404, await post(server.port, '/other', make_update_body(4, 42, 'Bob'), headers))
+    await server.stop()
+    self.assertEqual('Ali', store.get_active_context(42).get_custom('name'))
+    self.assertEqual(2, server.stats.handled)
+
+  async def test_stop_closes_kept_alive_connections(self):
+    store = MemoryContextStore()
+    server = WebhookServer(MainHandler(store, FormHandler()), host='127.0.0.1', port=0, workers=1)
+    await server.start()
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    body = make_update_body(1, 1, '/Form')
+    writer.write(f'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    self.assertIn(b' 200 ', await reader.readline())
+    await asyncio.wait_for(server.stop(), 2)
+    await asyncio.wait_for(reader.read(), 2)  # the server closed the connection
+    writer.close()
+    self.assertEqual(1, store.get_active_context(1).step)
+
+  async def test_sheds_load_when_queue_is_full(self):
+    store = MemoryContextStore()
+    server = WebhookServer(MainHandler(store, FormHandler()), host='127.0.0.1', port=0,
+                           workers=0, queue_size=1)
+    await server.start()
+    self.assertEqual(200, await post(server.port, '/', make_update_body(1, 1, '/Form')))
+    self.assertEqual(503, await post(server.port, '/', make_update_body(2, 2, '/Form')))
+    self.assertEqual(1, server.stats.shed)
+    await server.stop(drain=False)